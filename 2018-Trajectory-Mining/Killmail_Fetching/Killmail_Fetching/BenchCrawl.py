@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""Offline ZKBSpider Crawl Benchmark
+
+Runs a CrawlSeqRegionsPP.py-style crawl (ZKBCrawlScheduler, one spider per
+region/year/month) against the local ZKillBoard API stand-in of zkbstub.py,
+instead of zkillboard.com, and reports the end-to-end time and the requests
+per second the crawl managed.
+
+Synthetic fixtures are written to a temporary folder first (see
+`zkbstub.make_fixtures`), and the crawl writes its CSV files there too.
+`pages` is the number of Killmail API pages of every region/month, or a list
+of page counts handed out to the months in turn, to bench a crawl of uneven
+months. With `longest_first`, the months are queued longest first (see
+crawlplan.py), as if their page counts were known from an earlier run.
+Every `full_last_every`-th month ends on a full page, so its spider has to
+retry the empty page after it (see EMPTY_PAGE_DETECTION in settings.py).
+Everything that would hide the crawler's own speed is turned off: no
+robots.txt, AutoThrottle, download delay, price store or checkpoints, and no
+global rate limit unless `rate_limit` is given. A `rate_limit` is the
+starting rate of AdaptiveRateController (extensions.py); give the stand-in a
+`capacity` to see the controller find it.
+
+Run from the Killmail_Fetching project folder with:
+    $python -m Killmail_Fetching.BenchCrawl
+
+"""
+import logging
+import os
+import shutil
+import tempfile
+import time
+from itertools import cycle
+
+from scrapy.crawler import CrawlerRunner
+from scrapy.utils.log import configure_logging
+from scrapy.utils.project import get_project_settings
+from twisted.internet import reactor
+
+from Killmail_Fetching.CrawlSeqRegionsPP import ZKBCrawlScheduler
+from Killmail_Fetching.crawlplan import CrawlPlan
+from Killmail_Fetching.zkbstub import ZKBStubServer, make_fixtures
+
+
+def main(regions=('10000002',), max_spiders=37, pages=2, page_size=100,
+         latency=0.02, jitter=0.01, error_rate=0.0, capacity=None,
+         rate_limit=None, longest_first=True, full_last_every=5,
+         keep=False):
+    settings = get_project_settings()  # Needs scrapy.cfg, so load it first
+    workdir = tempfile.mkdtemp(prefix='zkbbench_')
+    os.chdir(workdir)
+    os.makedirs('tmpdata')  # Output folder of the spiders' CSV files
+
+    stub = ZKBStubServer(os.path.join(workdir, 'fixtures'), latency=latency,
+                         jitter=jitter, error_rate=error_rate,
+                         capacity=capacity)
+    settings.setdict({
+        'ZKB_API_ROOT': stub.start(),
+        'ROBOTSTXT_OBEY': False,
+        'AUTOTHROTTLE_ENABLED': False,
+        'DOWNLOAD_DELAY': 0,
+        'GLOBAL_RATE_LIMIT': rate_limit,
+        'PRICE_STORE_URI': None,
+        'CHECKPOINT_JOURNAL': None,
+        'CRAWL_HISTORY': None,
+        'TELEMETRY_URI': 'crawl_metrics.jl',
+        'EMPTY_PAGE_BACKOFF': 0.1,
+        'KILLMAIL_PAGE_SIZE': page_size,
+        'LOG_LEVEL': 'WARNING',
+    }, priority='cmdline')
+
+    configure_logging(settings)
+    runner = CrawlerRunner(settings)
+    scheduler = ZKBCrawlScheduler(runner, max_spiders=max_spiders)
+    plan = CrawlPlan.from_settings(settings, list(regions))
+    page_counts = cycle([pages] if isinstance(pages, int) else pages)
+    url_pages = {unit.start_urls[0]: next(page_counts) for unit in plan.units}
+    if longest_first:  # Exact costs, as estimated from an earlier run
+        for unit in plan.units:
+            unit.cost = url_pages[unit.start_urls[0]]
+    scheduler.queue_plan(plan)
+    killmails = make_fixtures(stub.fixtures, list(url_pages), pages=url_pages,
+                              page_size=page_size,
+                              full_last_every=full_last_every)
+    print(f"Fixtures: {len(plan)} spiders | {killmails} killmails | "
+          f"{workdir}")
+
+    def crawl():
+        d = scheduler.start()
+        d.addBoth(lambda _: reactor.stop())
+
+    start = time.time()
+    reactor.callWhenRunning(crawl)
+    reactor.run()  # Blocks until every spider has closed
+    elapsed = time.time() - start
+    stub.stop()
+
+    # Rows written to the spiders' CSV files (without header lines)
+    rows = 0
+    for filename in os.listdir('tmpdata'):
+        with open(os.path.join('tmpdata', filename), 'rb') as csv_file:
+            rows += sum(1 for _ in csv_file) - 1
+
+    counts = stub.counts
+    print(f"End-to-end time  : {elapsed:10.2f} s")
+    print(f"Requests         : {counts['requests']:10d} "
+          f"({counts['kills']} killmail pages, {counts['prices']} price "
+          f"pages, {counts['errors']} injected errors, "
+          f"{counts['throttled']} throttled)")
+    print(f"Requests/sec     : {counts['requests'] / elapsed:10.2f}")
+    print(f"Killmails/sec    : {rows / elapsed:10.2f} "
+          f"({rows}/{killmails} written)")
+    print(f"Metrics          : {os.path.join(workdir, 'crawl_metrics.jl')}")
+
+    if not keep:
+        os.chdir(tempfile.gettempdir())
+        shutil.rmtree(workdir, ignore_errors=True)
+        logging.info(f"Removed {workdir}")
+
+
+if __name__ == "__main__":
+    main(keep=True)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Nearest-Date Item Price Lookup Micro-Benchmark
+
+Compares the original linear `ZKBSpider.get_nearest_price` scan, which calls
+`datetime.strptime` on every date of a Price API page for every lookup, to
+the pre-indexed `PriceHistory` (prices.py), which converts the dates of an
+item to ordinal days once and answers every lookup with a binary search.
+
+The benchmark uses a synthetic price history shaped like the Price API (one
+price per day for several years, with a few missing days), and looks up the
+price of random killmail dates, some of which are missing from the history.
+
+Run from the Killmail_Fetching project folder with:
+    $python -m Killmail_Fetching.BenchPriceLookup
+
+"""
+import random
+import timeit
+from datetime import datetime, timedelta
+
+from Killmail_Fetching.prices import PriceHistory
+
+
+def get_nearest_price(item_info, api_prices):
+    """Original linear nearest-date lookup of ZKBSpider, kept here as the
+    baseline of the benchmark.
+
+    """
+    price = (f"Item ID: {item_info[0]}, Date: {item_info[1]},"
+             f" URL: {item_info[2]}")
+    req_date = datetime.strptime(item_info[1], '%Y-%m-%d')  # Requested Date
+    prev_date = req_date
+    max_diff = timedelta().max
+
+    # Walk through all dates listed in API and compare to kmail date
+    count = 1
+    end = len(api_prices)  # If count hits end, use prev date in list
+    for date in api_prices:
+        try:
+            cur_date = datetime.strptime(date, '%Y-%m-%d')
+            diff = req_date - cur_date
+
+            # Difference b/w dates increased above max or end is reached
+            if max_diff < diff or count == end:
+                final_date = datetime.strftime(prev_date, '%Y-%m-%d')
+                try:
+                    price = api_prices[final_date]
+                finally:  # If price cannot be obtained, still break
+                    break
+            else:  # Difference b/w dates can be smaller
+                max_diff = diff
+                prev_date = cur_date
+
+        except ValueError:  # key in API could not be processed as date
+            pass  # Skip that row!!
+
+        finally:
+            count += 1  # Increment counter
+
+    return price
+
+
+def make_api_prices(start, days, missing=0.02, seed=0):
+    """Creates a fake Price API page with one price per day from `start`, with
+    a `missing` fraction of the days left out.
+
+    """
+    rng = random.Random(seed)
+    api_prices = {}
+    for n in range(days):
+        if rng.random() >= missing:
+            day = start + timedelta(days=n)
+            api_prices[day.strftime('%Y-%m-%d')] = round(rng.uniform(1, 1e6), 2)
+    api_prices['currentPrice'] = 1.0  # Non-date key, as on the real API
+    return api_prices
+
+
+def main(years=3, lookups=1000, repeat=3):
+    start = datetime(2015, 5, 1)
+    api_prices = make_api_prices(start, 365 * years)
+    rng = random.Random(1)
+    dates = [(start + timedelta(days=rng.randrange(365 * years)))
+             .strftime('%Y-%m-%d') for _ in range(lookups)]
+    item_info = ('11317', None, 'https://zkillboard.com/api/prices/11317/')
+
+    def linear():
+        for date in dates:
+            get_nearest_price((item_info[0], date, item_info[2]), api_prices)
+
+    def build():
+        return PriceHistory.from_api(api_prices)
+
+    history = build()
+
+    def indexed():
+        for date in dates:
+            history.get(date)
+
+    print(f"History: {len(api_prices)} API rows | Lookups: {lookups}")
+    t_linear = min(timeit.repeat(linear, number=1, repeat=repeat))
+    t_build = min(timeit.repeat(build, number=1, repeat=repeat))
+    t_indexed = min(timeit.repeat(indexed, number=1, repeat=repeat))
+    print(f"Linear strptime scan : {t_linear * 1e6 / lookups:10.2f} us/lookup")
+    print(f"PriceHistory build   : {t_build * 1e3:10.2f} ms/item (once)")
+    print(f"PriceHistory lookup  : {t_indexed * 1e6 / lookups:10.2f} us/lookup")
+    print(f"Speedup per lookup   : {t_linear / t_indexed:10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,15 +4,17 @@
 ====================IMPORTANT====================READ BELOW====================
 
 IF USING MAC:
-    Must run `$ulimit -Sn 10,000`!! Must allow MANY open files at the
-    same time or the system will crash horribly :(
+    Open CSV files are capped by EXPORT_MAX_OPEN_FILES in settings.py, but
+    every spider still holds network connections open. If the system runs
+    out of file descriptors, run `$ulimit -Sn 10,000`!!
 
 CHECK SETTINGS.PY!!!
 This is where project wide settings are enabled. Currently enabled settings:
     ROBOTSTXT_OBEY = True
     COOKIES_ENABLED = False
-    AUTOTHROTTLE_ENABLED = True
-    ^^See https://doc.scrapy.org/en/latest/topics/autothrottle.html
+    GLOBAL_RATE_LIMIT = 50
+    ^^Shared by all spiders, see GlobalRateLimitMiddleware in middlewares.py.
+      AUTOTHROTTLE_ENABLED must stay False while it is set!
     LOG_LEVEL = 'INFO'
     ^^See https://doc.scrapy.org/en/latest/topics/settings.html#log-level
 
@@ -22,7 +24,15 @@ This script scrapes all pages of a given month/year URL path, and SEQUENTIALLY
 queues regions to be scraped. Thus, 37 concurrent spiders will each crawl a
 unique month from 05-2015 to 05-2018 for a single regionID. Then, the script
 will establish the next 37 spiders to concurrently crawl the same time span for
-the next regionID, until all regions have been scraped.
+the next regionID, until all regions have been scraped. Regions and months are
+set by CRAWL_REGION_IDS, CRAWL_START and CRAWL_END in settings.py.
+
+If USE_WORK_QUEUE is True, regions are not crawled in lock-step batches.
+Instead, every region/year/month is a unit of work in one queue, 37 spiders
+are kept crawling at all times, and the next unit is sent crawling as soon as
+any spider closes, so one busy month no longer holds up the next region.
+Units are queued longest first, going by the pages each took in earlier runs
+(see crawlplan.py).
 
 Extraction API:
     https://github.com/zKillboard/zKillboard/wiki/API-(Killmails)
@@ -32,64 +42,20 @@ Created on: 07-12-2018
 Last Modified: 07-17-2018
 """
 import logging
+from collections import deque
 
 from scrapy.crawler import CrawlerRunner
 from scrapy.utils.log import configure_logging
 from scrapy.utils.project import get_project_settings
 from twisted.internet import reactor, defer
+from twisted.python.failure import Failure
 
-from spiders.zkbspider import ZKBSpider
-
-
-class ZKBPage(object):
-    """Creates and updates path modifiers used in requests made by spiders.
-
-    URLS for each spider are relative to 4 sets of path element:identifier
-    strings > RegionID : ``str`` | year : ``str`` | month : ``str`` |
-    page : ``str``
-
-    Every time `self.update_path_modifiers` is called, `self.path_elem` is
-    updated with the next month and/or year sequentially from the previous
-    month/year. If end date is reached, self.path_elem is set to None.
-
-    Dates are from 05/2015 to 05/2018.
-
-    """
-
-    def __init__(self, region_id):
-        # Lists of path element strings to populate new URLs string with
-        self.months = ['06', '07', '08', '09', '10', '11', '12', '01', '02',
-                       '03', '04']
-        self.months_itr = iter(self.months)
-        self.years = ['2016', '2017', '2018']
-        self.years_itr = iter(self.years)
-
-        # Starting path elements
-        self.path_elem = [
-            'https:', '', 'zkillboard.com', 'api', 'kills', 'region_id',
-            region_id, 'year', '2015', 'month', '05', 'page', '1', ''
-        ]
-
-    def update_path_modifiers(self):
-        """Updates instance path elements until end date is reached.
+from Killmail_Fetching.crawlplan import CrawlPlan
+from Killmail_Fetching.spiders.zkbspider import ZKBSpider
 
-        Important fields:
-            page: self.path_elem[-2]  month: self.path_elem[-4]
-            year: self.path_elem[-6]  regionID: self.path_elem[-8]
-
-        """
-        # If current month/year is end date, stop generating path elements
-        if self.path_elem[-4] == '05' and self.path_elem[-6] == '2018':
-            self.path_elem = None
-        else:
-            try:
-                self.path_elem[-4] = next(self.months_itr)
-            except StopIteration:  # Months have run out!
-                self.path_elem[-4] = '05'  # Start in May again
-                self.months_itr = iter(self.months)  # Create new month iterator
-            finally:
-                if self.path_elem[-4] == '01':  # If January, get next year
-                    self.path_elem[-6] = next(self.years_itr)
+# Crawl region/year/month units from one work queue, instead of region by
+# region in lock-step batches (see ZKBCrawlScheduler)
+USE_WORK_QUEUE = True
 
 
 class ZKBCrawlingManager(object):
@@ -98,8 +64,8 @@ class ZKBCrawlingManager(object):
     """
     def __init__(self, runner):
         self.runner = runner
-        # Region iterable
-        self.regions = iter(['10000002', '10000016', '10000033', '10000069'])
+        # Region iterable, CRAWL_REGION_IDS in settings.py
+        self.regions = iter(runner.settings.getlist('CRAWL_REGION_IDS'))
         # Base Spider name with URI root folder
         self.base_spider = 'zkbspider_tmpdata'
 
@@ -115,23 +81,15 @@ class ZKBCrawlingManager(object):
 
         try:
             region_id = next(self.regions)
-            page = ZKBPage(region_id)  # Create new page element class
+            # Every month of the region, longest first
+            plan = CrawlPlan.from_settings(self.runner.settings, [region_id],
+                                           base_spider=self.base_spider)
 
             # Create and add ZKBSpiders to the crawl
-            while page.path_elem is not None:
-                # Unique spider name by output folder
-                name = (f'{self.base_spider}/{region_id}{page.path_elem[-6]}'
-                        f'{page.path_elem[-4]}')
-
-                # List of URLS for spider to crawl
-                start_urls = ['/'.join(page.path_elem)]
-
-                # Add instance of ZKBSpider with scrapy.Spider kwargs
-                spiders[name] = {'spider': ZKBSpider(),
-                                 'start_urls': start_urls}
-
-                # Get next set of path elements
-                page.update_path_modifiers()
+            for unit in plan:
+                # Add ZKBSpider with scrapy.Spider kwargs
+                spiders[unit.name] = {'spider': ZKBSpider,
+                                      'start_urls': unit.start_urls}
 
         except StopIteration:  # No more spiders to be generated!
             pass
@@ -189,6 +147,74 @@ class ZKBCrawlingManager(object):
             spiders = crawling_manager.generate_spiders()
 
 
+class ZKBCrawlScheduler(object):
+    """Keeps `max_spiders` spiders crawling at once from a queue of
+    region/year/month units, sending the next unit crawling as soon as any
+    spider closes.
+
+    """
+    def __init__(self, runner, max_spiders=37):
+        self.runner = runner
+        self.max_spiders = max_spiders
+        # Queue of units of work: (spider name, list of starting URLS, dict
+        # of other spider kwargs)
+        self.units = deque()
+        # Number of spiders crawling right now
+        self.active = 0
+        # Fires once the queue is empty and every spider has closed
+        self.finished = defer.Deferred()
+
+    def queue_plan(self, plan):
+        """Adds every unit of `plan` (see crawlplan.py) to the queue, longest
+        first.
+
+        """
+        for unit in plan:
+            self.queue_unit(unit.name, unit.start_urls, **unit.kwargs)
+
+    def queue_unit(self, name, start_urls, **kwargs):
+        """Adds one unit of work to the queue: a spider named `name` crawling
+        from `start_urls`, with any other ZKBSpider attributes in `kwargs`
+        (e.g. `min_killmail_id`, see CrawlTailPP.py).
+
+        """
+        self.units.append((name, start_urls, kwargs))
+
+    def start(self):
+        """Sends the first `max_spiders` units crawling. Returns a `Deferred`
+        that fires once every unit in the queue has been crawled.
+
+        """
+        self.launch_spiders()
+        return self.finished
+
+    def launch_spiders(self):
+        """Sends units crawling until `max_spiders` spiders are active or the
+        queue is empty.
+
+        """
+        while self.active < self.max_spiders and self.units:
+            name, start_urls, kwargs = self.units.popleft()
+            logging.info(f"{name} will start crawling from {start_urls} | "
+                         f"{len(self.units)} units left in the queue")
+            self.active += 1
+            d = self.runner.crawl(ZKBSpider, name=name,
+                                  start_urls=start_urls, **kwargs)
+            d.addBoth(self.spider_closed, name)
+
+        if self.active == 0 and not self.finished.called:
+            self.finished.callback(None)
+
+    def spider_closed(self, result, name):
+        """Called when a spider closes; sends the next unit crawling.
+
+        """
+        self.active -= 1
+        if isinstance(result, Failure):
+            logging.error(f"{name} failed: {result.getErrorMessage()}")
+        self.launch_spiders()
+
+
 if __name__ == "__main__":
     # Settings list with custom DOWNLOAD_DELAY:
     # The amount of time (in secs) that the downloader should wait before
@@ -203,25 +229,46 @@ if __name__ == "__main__":
 
     # This script runs 37 concurrent spiders 4 times.
     # USER_AGENT limit (using $scrapy bench): ~3000 pages/m | 50 pages/s
-    # 3000 pages/m / 37 spiders ~= 81 pages/m per spider MAXIMUM!!
-    # @ 0.75s delay, delay is b/w 0.5*0.66 == 0.33s and 0.99s == 1.5*0.66, or
-    # 60 s / 0.33 s/page == 182 pages/m and 61 pages/m == 60 s/ 0.99 s/page.
-    # Spiders will try to reach (fluctuate) around 60/0.66 == 90 pages/m, with
-    # Autothrottle spiders usually get around 75 pages/m
+    # The limit is enforced for all 37 spiders together by
+    # GlobalRateLimitMiddleware (GLOBAL_RATE_LIMIT in settings.py), so no
+    # per-spider delay is needed: spiders that finish early leave their share
+    # of the 50 pages/s to the spiders still crawling. If the middleware is
+    # disabled, use 3000 pages/m / 37 spiders ~= 81 pages/m per spider, i.e.
+    # a 0.7 second delay, instead!
     settings = get_project_settings()
-    settings.set('DOWNLOAD_DELAY', 0.7)
+    settings.set('DOWNLOAD_DELAY', 0 if settings.get('GLOBAL_RATE_LIMIT')
+                 else 0.7)
 
     configure_logging()  # Set up logging machine
     r = CrawlerRunner(settings)  # Create new runner
 
-    # Create a crawling manager
-    crawling_manager = ZKBCrawlingManager(r)
-
-    try:
-        crawling_manager.begin_crawling()  # Generate Spiders for crawling
-        reactor.run()  # Start the Reactor
-    except StopIteration:  # Early return call from entering 'n' in prompt
-        pass
-    finally:
-        if reactor.running:
-            reactor.stop()  # Shutdown the reactor
+    if USE_WORK_QUEUE:
+        # Queue every region/year/month, longest first, and keep 37 spiders
+        # crawling
+        scheduler = ZKBCrawlScheduler(r, max_spiders=37)
+        scheduler.queue_plan(CrawlPlan.from_settings(settings))
+
+        # Determine if crawl should commence
+        begin = input(f'{len(scheduler.units)} units queued! Begin crawling? '
+                      f'(y/n) >')
+        while not (begin == 'y' or begin == 'n'):
+            begin = input('Begin crawling? (y/n) >')
+
+        if begin == 'y':
+            scheduler.start().addBoth(lambda _: reactor.stop())
+            reactor.run()  # script will block here until crawling is finished
+        else:
+            print('Goodbye! Shutting down...')
+
+    else:
+        # Create a crawling manager
+        crawling_manager = ZKBCrawlingManager(r)
+
+        try:
+            crawling_manager.begin_crawling()  # Generate Spiders for crawling
+            reactor.run()  # Start the Reactor
+        except StopIteration:  # Early return call from entering 'n' in prompt
+            pass
+        finally:
+            if reactor.running:
+                reactor.stop()  # Shutdown the reactor
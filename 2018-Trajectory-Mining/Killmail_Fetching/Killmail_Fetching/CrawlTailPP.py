@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""ZKillBoard Killmail and Item Price Extraction Script (Tail)
+
+====================IMPORTANT====================READ BELOW====================
+
+CHECK SETTINGS.PY!!!
+This is where project wide settings are enabled. Currently enabled settings:
+    ROBOTSTXT_OBEY = True
+    COOKIES_ENABLED = False
+    GLOBAL_RATE_LIMIT = 50
+    ^^Shared by all spiders, see GlobalRateLimitMiddleware in middlewares.py.
+      AUTOTHROTTLE_ENABLED must stay False while it is set!
+    LOG_LEVEL = 'INFO'
+    ^^See https://doc.scrapy.org/en/latest/topics/settings.html#log-level
+
+====================IMPORTANT====================READ ABOVE====================
+
+This script refreshes a dataset crawled by CrawlSeqRegionsPP.py or
+CrawlConcPP.py with only the killmails posted since, instead of crawling
+every month again.
+
+The CSV files already in DATA_DIR (plain, compressed or rotated, see
+outputs.py) are read to find the newest killmail exported for every region:
+every file lists killmails newest first, so only its first row is read. Then
+one spider per month is queued for each region, from the month of that
+killmail up to the current month. Each spider is given the killmail's ID as
+`min_killmail_id`, so it stops at the first page reaching a killmail that
+was already exported, rather than crawling the rest of the month (see
+ZKBSpider).
+
+New killmails are written to new files next to the old ones, e.g.
+10000002201805-tail20190424120000.csv, so nothing already exported is
+touched. Regions with no files in DATA_DIR are skipped; crawl them with
+CrawlSeqRegionsPP.py first.
+
+A tail crawl that died before all of its spiders finished is resumed by the
+next run (with a CHECKPOINT_JOURNAL): it keeps the run's ID, so its spiders
+have the same names and resume from their checkpoints (see checkpoints.py),
+and the run's files are left out when looking for the newest killmails. They
+only hold the newest killmails of an unfinished crawl, and would hide the
+killmails it had yet to fetch.
+
+Killmails posted to ZKillBoard late, with an ID older than the newest one
+exported, are not picked up by a tail crawl.
+
+Extraction API:
+    https://github.com/zKillboard/zKillboard/wiki/API-(Killmails)
+
+"""
+import csv
+import gzip
+import io
+import logging
+import os
+import re
+from datetime import datetime
+
+from scrapy.crawler import CrawlerRunner
+from scrapy.utils.log import configure_logging
+from scrapy.utils.project import get_project_settings
+from twisted.internet import reactor
+
+from Killmail_Fetching.CrawlSeqRegionsPP import ZKBCrawlScheduler
+from Killmail_Fetching.checkpoints import CrawlJournal
+from Killmail_Fetching.crawlplan import CrawlPlan
+
+try:  # Only needed to read files written with EXPORT_COMPRESSION = 'zstd'
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Folder of the CSV files written by the spiders (see ZKBCrawlScheduler)
+DATA_DIR = 'tmpdata'
+
+# <regionID><year><month>[-tail<run ID>][-chunk#].csv[.gz|.zst], the part
+# before the chunk number being the name of the spider that wrote the file
+CSV_FILENAME = re.compile(r'^((\d{8})\d{6}(?:-tail([^-.]+))?)(?:-\d+)?'
+                          r'\.csv(?:\.gz|\.zst)?$')
+
+
+def open_csv(uri):
+    """Opens an exported CSV file for reading as text, decompressing it if
+    need be.
+
+    """
+    if uri.endswith('.gz'):
+        return gzip.open(uri, 'rt', encoding='utf-8', newline='')
+    if uri.endswith('.zst'):
+        if zstandard is None:
+            raise OSError(f"zstandard is needed to read {uri}")
+        reader = zstandard.ZstdDecompressor().stream_reader(open(uri, 'rb'))
+        return io.TextIOWrapper(reader, encoding='utf-8', newline='')
+    return open(uri, 'r', encoding='utf-8', newline='')
+
+
+def read_newest_killmail(uri):
+    """Returns (killmail_id, killmail_time) of the newest killmail in an
+    exported CSV file, i.e. its first row that is not an error row, or None
+    if the file has no killmails.
+
+    """
+    with open_csv(uri) as csv_file:
+        for row in csv.DictReader(csv_file):
+            try:
+                return int(row['killmail_id']), row['killmail_time']
+            except (KeyError, ValueError):  # ERR row, see ZKBSpider
+                continue
+    return None
+
+
+def find_unfinished_runs(data_dir, journal):
+    """Returns the IDs of the tail crawls with CSV files in `data_dir` whose
+    spider has no `done` checkpoint in `journal`, oldest first.
+
+    """
+    # Spider names without their folder, as in the file names
+    checkpoints = {name.split('/')[-1]: checkpoint
+                   for name, checkpoint in journal.load().items()}
+    runs = set()
+    for filename in os.listdir(data_dir):
+        match = CSV_FILENAME.match(filename)
+        if match is None or match.group(3) is None:  # Not a tail crawl file
+            continue
+        checkpoint = checkpoints.get(match.group(1))
+        if checkpoint is None or not checkpoint['done']:
+            runs.add(match.group(3))
+    return sorted(runs)
+
+
+def find_newest_killmails(data_dir, skip_runs=()):
+    """Returns the newest killmail exported for every region with CSV files
+    in `data_dir`, e.g. newest['10000002'] = (72000000,
+    '2018-05-31T23:59:12Z'), leaving out the files of the tail crawls in
+    `skip_runs`.
+
+    """
+    newest = {}
+    for filename in sorted(os.listdir(data_dir)):
+        match = CSV_FILENAME.match(filename)
+        if match is None or match.group(3) in skip_runs:
+            continue
+        region_id = match.group(2)
+        uri = os.path.join(data_dir, filename)
+        try:
+            killmail = read_newest_killmail(uri)
+        except (OSError, EOFError, csv.Error) as e:  # Cut short by a crash?
+            logging.warning(f"UNABLE TO READ {uri}: {e}! SKIPPING FILE...")
+            continue
+        if killmail is not None and killmail > newest.get(region_id, (0,)):
+            newest[region_id] = killmail
+    return newest
+
+
+def plan_tail(region_id, killmail, run_id, now, api_root):
+    """Returns the `CrawlPlan` of every month of `region_id` that may have
+    killmails newer than `killmail` = (killmail_id, killmail_time): from the
+    month of `killmail_time` (a Killmail API time string) up to `now`.
+
+    """
+    killmail_id, killmail_time = killmail
+    start = (int(killmail_time[:4]), int(killmail_time[5:7]))
+    # New output files for every run, but the same ones for a resumed run
+    return CrawlPlan([region_id], start, (now.year, now.month),
+                     api_root=api_root, name_suffix=f'-tail{run_id}',
+                     spider_kwargs={'min_killmail_id': killmail_id})
+
+
+if __name__ == "__main__":
+    # See CrawlSeqRegionsPP.py for the DOWNLOAD_DELAY used without the global
+    # rate limit
+    settings = get_project_settings()
+    settings.set('DOWNLOAD_DELAY', 0 if settings.get('GLOBAL_RATE_LIMIT')
+                 else 0.7)
+
+    configure_logging()  # Set up logging machine
+    r = CrawlerRunner(settings)  # Create new runner
+    scheduler = ZKBCrawlScheduler(r, max_spiders=37)
+
+    now = datetime.utcnow()  # killmail_time is UTC
+    run_id = now.strftime('%Y%m%d%H%M%S')
+    unfinished = []
+    if settings.get('CHECKPOINT_JOURNAL'):
+        journal = CrawlJournal(settings.get('CHECKPOINT_JOURNAL'))
+        unfinished = find_unfinished_runs(DATA_DIR, journal)
+    else:
+        logging.warning("CHECKPOINT_JOURNAL IS NOT SET! A TAIL CRAWL THAT "
+                        "DIES MID-CRAWL CAN'T BE RESUMED, AND LEAVES A GAP "
+                        "IN THE KILLMAILS...")
+    for old_run_id in unfinished[:-1]:
+        logging.warning(f"TAIL CRAWL {old_run_id} NEVER FINISHED! IGNORING "
+                        f"ITS FILES...")
+    if unfinished:
+        run_id = unfinished[-1]
+        logging.info(f"Resuming unfinished tail crawl {run_id}")
+    newest = find_newest_killmails(DATA_DIR, skip_runs=unfinished)
+    for region in settings.getlist('CRAWL_REGION_IDS'):
+        if region not in newest:
+            logging.warning(f"NO KILLMAILS OF REGION {region} FOUND IN "
+                            f"{DATA_DIR}! SKIPPING REGION...")
+            continue
+        logging.info(f"Region {region}: newest killmail is "
+                     f"#{newest[region][0]} at {newest[region][1]}")
+        scheduler.queue_plan(plan_tail(region, newest[region], run_id, now,
+                                       settings.get('ZKB_API_ROOT')))
+
+    # Determine if crawl should commence
+    begin = input(f'{len(scheduler.units)} units queued! Begin crawling? '
+                  f'(y/n) >')
+    while not (begin == 'y' or begin == 'n'):
+        begin = input('Begin crawling? (y/n) >')
+
+    if begin == 'y':
+        scheduler.start().addBoth(lambda _: reactor.stop())
+        reactor.run()  # script will block here until crawling is finished
+    else:
+        print('Goodbye! Shutting down...')
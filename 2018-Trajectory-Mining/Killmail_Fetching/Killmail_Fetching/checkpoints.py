@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""Resumable Crawl Checkpoints for ZKBSpider
+
+Every time a spider has sent all killmails of a Killmail API page to the Item
+Pipeline, it sends the `page_exported` signal. The pipeline flushes the
+spider's output file and appends a checkpoint for the spider to the crawl
+journal, a JSON-lines file set by `CHECKPOINT_JOURNAL` in settings.py:
+
+    {"spider": "zkbspider_tmpdata/10000002201505",
+     "url": "https://zkillboard.com/api/kills/.../page/12/",
+     "offset": 24681357, "done": false, "chunk": 0, "rows": 2400,
+     "killmails": 200}
+
+If CrawlConcPP.py or CrawlSeqRegionsPP.py dies mid-crawl, running it again
+resumes every spider from the page after its last checkpoint (spiders whose
+checkpoint is `done` do not crawl at all), and the pipeline cuts the output
+file back to `offset` (dropping rows of a half-exported page) and appends to
+it instead of overwriting it. `killmails` (the number of killmails on the
+checkpointed page) tells a resumed spider whether an empty next page is the
+end of its month (see ZKBSpider.confirm_empty_page).
+
+ColumnarExportPipeline writes its Parquet part files less often than the CSV
+pipeline checkpoints, and records the page its newest part ends on in the
+same journal:
+
+    {"spider": "zkbspider_tmpdata/10000002201505",
+     "parquet": "https://zkillboard.com/api/kills/.../page/10/"}
+
+("parquet": null before the first part), and again the page it resumes from
+when it is opened. A spider then resumes from its last checkpoint at or
+before that page, so the rows of the pages after it, which only the CSV file
+held, are written to both outputs again instead of being lost from the
+Parquet tables. Positions past the last checkpoint (part files renamed
+before the checkpoint was written) are ignored, and their part files are
+deleted by the resumed spider.
+
+"""
+import json
+import os
+import re
+
+# Signal sent by ZKBSpider once all killmails of a page have been sent to the
+# Item Pipeline. Arguments: spider, url (the page), done (True when the page
+# was the end of the spider's month), killmails (on the page, None if unknown
+# or if done).
+page_exported = object()
+
+
+class CrawlJournal(object):
+    """Append-only JSON-lines journal of spider checkpoints. The last line
+    written for a spider is its checkpoint, unless a Parquet position written
+    after it is behind it (see above).
+
+    """
+
+    def __init__(self, uri):
+        self.uri = uri
+
+    @staticmethod
+    def page(url):
+        """Returns the page number of the Killmail API page at `url`.
+
+        """
+        return int(re.search(r"/page/(\d+)/?$", url).group(1))
+
+    def load(self):
+        """Returns the checkpoint of every spider in the journal, e.g.
+        checkpoints[spider_name] = {'spider': ..., 'url': ..., ...}
+
+        """
+        history = {}  # All checkpoints of every spider, oldest first
+        positions = {}  # All Parquet positions of every spider, oldest first
+        if not os.path.exists(self.uri):
+            return {}
+
+        with open(self.uri, 'r', encoding='utf-8') as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:  # Line cut short by a crash, skip it!
+                    continue
+                if 'parquet' in entry:
+                    positions.setdefault(entry['spider'], []).append(
+                        self.page(entry['parquet'])
+                        if entry['parquet'] is not None else 0)
+                else:
+                    history.setdefault(entry['spider'], []).append(entry)
+
+        checkpoints = {}
+        for spider_name, entries in history.items():
+            if spider_name not in positions:
+                checkpoints[spider_name] = entries[-1]
+                continue
+            # The newest part file not past the last checkpoint (later ones
+            # are deleted on resume) ...
+            last_page = self.page(entries[-1]['url'])
+            parquet_page = next((page for page in
+                                 reversed(positions[spider_name])
+                                 if page <= last_page), 0)
+            # ... and the newest checkpoint the Parquet tables are complete up
+            # to
+            for checkpoint in reversed(entries):
+                if self.page(checkpoint['url']) <= parquet_page:
+                    checkpoints[spider_name] = checkpoint
+                    break
+        return checkpoints
+
+    def get(self, spider_name):
+        """Returns the checkpoint of `spider_name`, or None.
+
+        """
+        return self.load().get(spider_name)
+
+    def record(self, spider_name, url, offset=None, done=False, chunk=None,
+               rows=None, killmails=None):
+        """Appends a checkpoint for `spider_name` to the journal. `chunk` and
+        `rows` are the number of the spider's output file and the rows
+        written to it (see outputs.py), `killmails` the number of killmails
+        on the page at `url`.
+
+        """
+        checkpoint = {'spider': spider_name, 'url': url, 'offset': offset,
+                      'done': done, 'chunk': chunk, 'rows': rows,
+                      'killmails': killmails}
+        with open(self.uri, 'a', encoding='utf-8') as journal:
+            journal.write(json.dumps(checkpoint) + '\n')
+
+    def record_parquet(self, spider_name, url):
+        """Appends the Parquet position of `spider_name` to the journal: the
+        page its newest part file ends on (None if it has none yet).
+
+        """
+        position = {'spider': spider_name, 'parquet': url}
+        with open(self.uri, 'a', encoding='utf-8') as journal:
+            journal.write(json.dumps(position) + '\n')
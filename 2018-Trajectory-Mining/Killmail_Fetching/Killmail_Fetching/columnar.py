@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""Columnar Layout of Exported Killmails
+
+ProcessBasedExportPipeline writes the nested `victim`, `attackers` and `zkb`
+fields of a killmail to CSV as Python literals, which have to be parsed back
+with `literal_eval` before they can be used. ColumnarExportPipeline instead
+splits every killmail into four normalized, typed tables, all keyed by
+killmail_id:
+
+    killmails  -> one row per killmail (time, location, zkb info)
+    victims    -> one row per killmail (victim info and position)
+    items      -> one row per item dropped/destroyed by the victim,
+                  including the items inside containers (see below)
+    attackers  -> one row per attacker on the killmail
+
+Items inside a container (e.g. the cargo of a ship in a ship maintenance bay)
+are nested in the container's own `items` list. They get their own rows,
+linked to the container's row: `item_index` numbers the item rows of a
+killmail from 0, and `parent_item` is the `item_index` of the container (null
+for items fitted to or carried by the victim's ship). ZKBSpider only prices
+the outermost items, so nested items have no `total_price`.
+
+This module only defines the tables' columns and how a killmail dict is
+flattened into rows; it does not need pyarrow.
+
+"""
+from datetime import datetime
+
+# Columns of each table, as (column name, column type), in order. Column types
+# are mapped to Arrow types by ColumnarExportPipeline.
+TABLE_COLUMNS = {
+    'killmails': [
+        ('killmail_id', 'int64'),
+        ('killmail_time', 'timestamp'),
+        ('solar_system_id', 'int64'),
+        ('moon_id', 'int64'),
+        ('war_id', 'int64'),
+        ('location_id', 'int64'),
+        ('hash', 'string'),
+        ('fitted_value', 'float64'),
+        ('total_value', 'float64'),
+        ('points', 'int64'),
+        ('npc', 'bool'),
+        ('solo', 'bool'),
+        ('awox', 'bool'),
+    ],
+    'victims': [
+        ('killmail_id', 'int64'),
+        ('character_id', 'int64'),
+        ('corporation_id', 'int64'),
+        ('alliance_id', 'int64'),
+        ('faction_id', 'int64'),
+        ('ship_type_id', 'int64'),
+        ('damage_taken', 'int64'),
+        ('x', 'float64'),
+        ('y', 'float64'),
+        ('z', 'float64'),
+    ],
+    'items': [
+        ('killmail_id', 'int64'),
+        ('item_type_id', 'int64'),
+        ('flag', 'int64'),
+        ('singleton', 'int64'),
+        ('quantity_destroyed', 'int64'),
+        ('quantity_dropped', 'int64'),
+        ('total_price', 'float64'),
+        ('item_index', 'int64'),
+        ('parent_item', 'int64'),
+    ],
+    'attackers': [
+        ('killmail_id', 'int64'),
+        ('character_id', 'int64'),
+        ('corporation_id', 'int64'),
+        ('alliance_id', 'int64'),
+        ('faction_id', 'int64'),
+        ('ship_type_id', 'int64'),
+        ('weapon_type_id', 'int64'),
+        ('damage_done', 'int64'),
+        ('final_blow', 'bool'),
+        ('security_status', 'float64'),
+    ],
+}
+
+# ZKB quick info keys -> killmails table columns
+ZKB_COLUMNS = {
+    'locationID': 'location_id',
+    'hash': 'hash',
+    'fittedValue': 'fitted_value',
+    'totalValue': 'total_value',
+    'points': 'points',
+    'npc': 'npc',
+    'solo': 'solo',
+    'awox': 'awox',
+}
+
+
+def is_number(value):
+    return (type(value) is float or type(value) is int)
+
+
+def flatten_items(items, killmail_id, parent_item, item_rows):
+    """Appends a row for each of `items` and the items nested in them to
+    `item_rows`, depth first. `parent_item` is the item_index of the
+    container of `items` (None if they are not in one).
+
+    """
+    for item in items:
+        item_row = dict(item, killmail_id=killmail_id,
+                        item_index=len(item_rows), parent_item=parent_item)
+        # Price is a string with lookup info if it could not be found
+        if not is_number(item_row.get('total_price')):
+            item_row['total_price'] = None
+        item_rows.append(item_row)
+        flatten_items(item.get('items', []), killmail_id,
+                      item_row['item_index'], item_rows)
+
+
+def flatten_killmail(killmail):
+    """Splits a killmail dict (as sent to the Item Pipelines) into rows of
+    each table in TABLE_COLUMNS. Returns a dict of lists of row dicts, e.g.
+    rows['items'] = [{'killmail_id': 12345678, 'item_type_id': 2048, ...}]
+
+    Missing keys are left out of the rows (they become nulls). Raises
+    ValueError if the killmail is an error row written by ZKBSpider when a
+    page could not be parsed.
+
+    """
+    victim = killmail.get('victim')
+    if not isinstance(victim, dict):  # ERR row, see ZKBSpider
+        raise ValueError(f"Not a killmail: {killmail.get('killmail_id')}")
+    killmail_id = killmail['killmail_id']
+
+    row = {
+        'killmail_id': killmail_id,
+        'killmail_time': datetime.strptime(killmail['killmail_time'],
+                                           '%Y-%m-%dT%H:%M:%SZ'),
+        'solar_system_id': killmail.get('solar_system_id'),
+        'moon_id': killmail.get('moon_id'),
+        'war_id': killmail.get('war_id'),
+    }
+    zkb = killmail.get('zkb') or {}
+    for key, column in ZKB_COLUMNS.items():
+        row[column] = zkb.get(key)
+
+    victim_row = dict(victim, killmail_id=killmail_id)
+    position = victim.get('position') or {}
+    for axis in ('x', 'y', 'z'):
+        victim_row[axis] = position.get(axis)
+
+    item_rows = []
+    flatten_items(victim.get('items', []), killmail_id, None, item_rows)
+
+    attacker_rows = [dict(attacker, killmail_id=killmail_id)
+                     for attacker in killmail.get('attackers', [])]
+
+    return {'killmails': [row], 'victims': [victim_row],
+            'items': item_rows, 'attackers': attacker_rows}
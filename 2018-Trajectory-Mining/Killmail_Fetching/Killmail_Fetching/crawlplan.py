@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""Crawl Plans: What Each Spider Crawls, and in Which Order
+
+A `CrawlPlan` expands a list of region IDs and a date range into
+`CrawlUnit`s, one per region/year/month, i.e. one ZKBSpider each:
+
+    plan = CrawlPlan(['10000002', '10000016'], start=(2015, 5),
+                     end=(2018, 5))
+    plan.estimate_costs('crawl_history.jl')
+    for unit in plan:
+        runner.crawl(ZKBSpider, name=unit.name, start_urls=unit.start_urls,
+                     **unit.kwargs)
+
+Months differ wildly in size (a busy month of The Forge is hundreds of pages,
+a quiet month of a small region a handful), and a crawl that keeps a fixed
+number of spiders busy (see ZKBCrawlScheduler) is only done once its longest
+unit is. Starting the longest units first keeps one big month from being
+left to run on its own at the end of the crawl.
+
+So each unit has a `cost`: the number of Killmail API pages expected for it,
+taken from the crawl history of earlier runs by `estimate_costs`. The crawl
+history (CRAWL_HISTORY in settings.py) is a JSON-lines file of the pages of
+every region/month crawled to its end, written by CrawlHistoryRecorder (see
+extensions.py) as each spider finishes its month:
+
+    {"region_id": "10000002", "year": 2015, "month": 5, "pages": 87}
+
+Units with no history cost the average of their region's known units (or of
+all known units). Iterating a plan yields its units, highest cost first;
+units of equal cost stay in region/date order, which is also the order of
+every unit until there is a crawl history.
+
+`CrawlPlan.from_settings` creates the plan set up by CRAWL_REGION_IDS,
+CRAWL_START and CRAWL_END in settings.py, as CrawlConcPP.py and
+CrawlSeqRegionsPP.py do.
+
+"""
+import json
+import os
+import re
+
+# Region, year, month and page number of a Killmail API URL:
+# .../region_id/10000002/year/2015/month/05/page/12/
+PAGE_URL = re.compile(r'/region_id/(\d+)/year/(\d+)/month/(\d+)'
+                      r'/page/(\d+)/?$')
+
+
+class CrawlUnit(object):
+    """One month of one region, crawled by one spider.
+
+    """
+
+    def __init__(self, region_id, year, month, name, start_url, kwargs=None,
+                 cost=None):
+        self.region_id = region_id
+        self.year = year
+        self.month = month
+        self.name = name  # Unique spider name, with output folder
+        self.start_urls = [start_url]  # Page 1 of the month
+        self.kwargs = kwargs or {}  # Other ZKBSpider attributes
+        self.cost = cost  # Expected Killmail API pages, None if unknown
+
+    def __repr__(self):
+        return f"CrawlUnit({self.name!r}, cost={self.cost})"
+
+
+class CrawlPlan(object):
+    """Every region/month from `start` to `end` (both (year, month), both
+    included) of `region_ids`, as `CrawlUnit`s. See the module docstring.
+
+    Spiders are named `base_spider`/<regionID><year><month>`name_suffix`,
+    and crawl from `api_root` (ZKB_API_ROOT in settings.py). `spider_kwargs`
+    are passed on to every spider of the plan.
+
+    """
+
+    def __init__(self, region_ids, start=(2015, 5), end=(2018, 5),
+                 api_root='https://zkillboard.com/api/',
+                 base_spider='zkbspider_tmpdata', name_suffix='',
+                 spider_kwargs=None):
+        self.units = []
+        for region_id in region_ids:
+            for year, month in month_range(start, end):
+                name = (f'{base_spider}/{region_id}{year}{month:02d}'
+                        f'{name_suffix}')
+                path_elem = api_root.rstrip('/').split('/') + [
+                    'kills', 'region_id', region_id, 'year', str(year),
+                    'month', f'{month:02d}', 'page', '1', ''
+                ]
+                self.units.append(CrawlUnit(region_id, year, month, name,
+                                            '/'.join(path_elem),
+                                            dict(spider_kwargs or {})))
+
+    @classmethod
+    def from_settings(cls, settings, region_ids=None, **kwargs):
+        """Creates the plan set up in settings.py: CRAWL_REGION_IDS (unless
+        `region_ids` is given) from CRAWL_START to CRAWL_END, from
+        ZKB_API_ROOT, with costs estimated from CRAWL_HISTORY if set.
+        Other `kwargs` are passed on to `CrawlPlan()`.
+
+        """
+        if region_ids is None:
+            region_ids = settings.getlist('CRAWL_REGION_IDS')
+        plan = cls(region_ids, parse_month(settings.get('CRAWL_START')),
+                   parse_month(settings.get('CRAWL_END')),
+                   api_root=settings.get('ZKB_API_ROOT'), **kwargs)
+        history_uri = settings.get('CRAWL_HISTORY')
+        if history_uri:
+            plan.estimate_costs(history_uri)
+        return plan
+
+    def __len__(self):
+        return len(self.units)
+
+    def __iter__(self):
+        """Yields the units, highest cost first.
+
+        """
+        # sorted() is stable, so equal costs keep region/date order
+        return iter(sorted(self.units, key=lambda unit: -(unit.cost or 0)))
+
+    def estimate_costs(self, history_uri):
+        """Sets the cost of every unit from the crawl history at
+        `history_uri`: the number of pages of its month when it was last
+        crawled to the end. Units missing from the history get the average
+        cost of their region's other units, or of all units found (None if
+        the history is empty or missing).
+
+        """
+        history = CrawlHistory(history_uri).load()
+        known = {}  # Region ID -> list of costs found in the history
+        for unit in self.units:
+            pages = history.get((unit.region_id, unit.year, unit.month))
+            unit.cost = pages
+            if pages is not None:
+                known.setdefault(unit.region_id, []).append(pages)
+
+        every = [cost for costs in known.values() for cost in costs]
+        for unit in self.units:
+            if unit.cost is not None:
+                continue
+            costs = known.get(unit.region_id) or every
+            unit.cost = sum(costs) / len(costs) if costs else None
+
+
+class CrawlHistory(object):
+    """Append-only JSON-lines file of the number of Killmail API pages of
+    every region/month crawled to its end, see the module docstring. The
+    last line written for a region/month is its page count.
+
+    """
+
+    def __init__(self, uri):
+        self.uri = uri
+
+    def load(self):
+        """Returns the page count of every region/month in the history, e.g.
+        pages[('10000002', 2015, 5)] = 87
+
+        """
+        pages = {}
+        if not os.path.exists(self.uri):
+            return pages
+
+        with open(self.uri, 'r', encoding='utf-8') as history:
+            for line in history:
+                try:
+                    entry = json.loads(line)
+                    key = (entry['region_id'], entry['year'], entry['month'])
+                    pages[key] = entry['pages']
+                except (ValueError, KeyError):  # Cut short by a crash, skip!
+                    continue
+        return pages
+
+    def record(self, url):
+        """Appends the page count of a month crawled to its end: the pages
+        before `url`, the (empty) Killmail API page past the end of the
+        month. Does nothing if `url` is not a Killmail API page URL.
+
+        """
+        match = PAGE_URL.search(url)
+        if match is None:
+            return
+        region_id, year, month, page = match.groups()
+        entry = {'region_id': region_id, 'year': int(year),
+                 'month': int(month), 'pages': int(page) - 1}
+        with open(self.uri, 'a', encoding='utf-8') as history:
+            history.write(json.dumps(entry) + '\n')
+
+
+def parse_month(month_str):
+    """Converts a 'YYYY-MM' string (e.g. CRAWL_START) to (year, month).
+
+    """
+    year, month = month_str.split('-')
+    return int(year), int(month)
+
+
+def month_range(start, end):
+    """Returns (year, month) of every month from `start` to `end`, both
+    (year, month) and both included.
+
+    """
+    year, month = start
+    months = []
+    while (year, month) <= tuple(end):
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+"""Crawl Telemetry, Adaptive Rate Control and Crawl History for ZKBSpider
+
+Crawl Telemetry
+---------------
+
+`CrawlTelemetry` is a Scrapy extension that appends a snapshot of every
+spider's crawl metrics to a JSON-lines file (TELEMETRY_URI in settings.py)
+every TELEMETRY_INTERVAL seconds, and once more when the spider closes:
+
+    {"time": "2019-04-24T12:00:00", "spider": "zkbspider_10000002201505",
+     "final": false, "elapsed": 60.0,
+     "pages_per_min": 41.0, "responses_per_min": 130.0,
+     "killmails_per_min": 8200.0,
+     "latency_mean": 0.42, "latency_hist": {"<=0.1s": 3, "<=0.25s": 40, ...},
+     "price_cache_hits": 150231, "price_cache_misses": 2041,
+     "price_cache_hit_rate": 0.9866, "coalesced_price_requests": 310,
+     "empty_page_retries": 1, "http_retries": 4,
+     "response_bytes": 51234567, "csv_bytes": 40123456,
+     "file_bytes": 6012345, "rate_limit": 50.0}
+
+Rates are over the last interval, everything else is a running total. The
+counters are kept in the crawler's stats (see
+https://doc.scrapy.org/en/latest/topics/stats.html), filled in by ZKBSpider
+(zkb/...), the export pipelines (export/...), the middlewares (coalesce/...)
+and this extension (telemetry/...).
+
+Comparing snapshots of two crawls shows whether a change to DOWNLOAD_DELAY,
+AUTOTHROTTLE or GLOBAL_RATE_LIMIT actually sped the crawl up.
+
+Adaptive Rate Control
+---------------------
+
+`AdaptiveRateController` tunes the requests-per-second budget shared by all
+spiders of the process (GlobalRateLimitMiddleware) to what the API actually
+sustains, instead of a hand-picked GLOBAL_RATE_LIMIT. Every
+ADAPTIVE_RATE_INTERVAL seconds it looks at the responses downloaded by every
+spider since the last look (additive increase, multiplicative decrease):
+
+    - If any was a 429 (Too Many Requests), or more than ERROR_RATIO of them
+      failed (5xx, 408 or a download error), the rate is multiplied by
+      ADAPTIVE_RATE_DECREASE.
+    - Else, if the spiders used up the budget and the mean latency is still
+      flat (within LATENCY_TOLERANCE times the lowest mean latency seen), the
+      rate is raised by ADAPTIVE_RATE_INCREASE requests per second.
+    - Else the rate is kept.
+
+The rate stays between ADAPTIVE_RATE_MIN and ADAPTIVE_RATE_MAX, starting at
+GLOBAL_RATE_LIMIT. GLOBAL_RATE_LIMIT is the API's own limit, so the rate is
+never raised above it either, whatever ADAPTIVE_RATE_MAX is. A 429 or 503
+response with a Retry-After header also holds every request of the process
+back for that long, right away.
+
+Crawl History
+-------------
+
+`CrawlHistoryRecorder` appends the number of Killmail API pages of every
+month a spider crawls to its end to the crawl history (CRAWL_HISTORY in
+settings.py), which `CrawlPlan` uses to start the longest months first in
+later crawls (see crawlplan.py). Tail crawls (see CrawlTailPP.py) are not
+recorded, since they only crawl the newest pages of a month.
+
+"""
+import json
+import logging
+import time
+from bisect import bisect_left
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+
+from Killmail_Fetching.checkpoints import page_exported
+from Killmail_Fetching.crawlplan import CrawlHistory
+from Killmail_Fetching.middlewares import GlobalRateLimitMiddleware
+
+# Upper bounds (seconds) of the response latency histogram buckets
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+LATENCY_LABELS = ([f"<={bound}s" for bound in LATENCY_BUCKETS]
+                  + [f">{LATENCY_BUCKETS[-1]}s"])
+
+# Fraction of failed downloads in an interval that makes the controller back
+# off, even without a 429
+ERROR_RATIO = 0.05
+# Mean latency counts as flat up to this many times the lowest mean seen
+LATENCY_TOLERANCE = 1.5
+# The budget counts as used up when downloads reach this fraction of it
+BUSY_RATIO = 0.8
+# Longest Retry-After (seconds) honored, in case of a bogus header
+MAX_RETRY_AFTER = 300
+
+
+class CrawlTelemetry(object):
+    """Writes periodic metrics of the crawler's spider, see the module
+    docstring. Disabled if TELEMETRY_URI is not set.
+
+    """
+
+    def __init__(self, stats, uri, interval=60.0):
+        self.stats = stats
+        self.uri = uri
+        self.interval = interval
+        self.task = None
+        self.last_time = None
+        self.last_counts = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        uri = crawler.settings.get('TELEMETRY_URI')
+        if not uri:
+            raise NotConfigured
+        ext = cls(crawler.stats, uri,
+                  crawler.settings.getfloat('TELEMETRY_INTERVAL', 60.0))
+        crawler.signals.connect(ext.spider_opened,
+                                signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed,
+                                signal=signals.spider_closed)
+        crawler.signals.connect(ext.response_received,
+                                signal=signals.response_received)
+        return ext
+
+    def spider_opened(self, spider):
+        self.last_time = time.time()
+        self.last_counts = self.counts()
+        self.task = task.LoopingCall(self.write_metrics, spider)
+        self.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        if self.task is not None and self.task.running:
+            self.task.stop()
+        self.write_metrics(spider, final=True)
+
+    def response_received(self, response, request, spider):
+        # Set by Scrapy's downloader: seconds from sending the request to
+        # receiving the response headers
+        latency = request.meta.get('download_latency')
+        if latency is None:
+            return
+        label = LATENCY_LABELS[bisect_left(LATENCY_BUCKETS, latency)]
+        self.stats.inc_value(f'telemetry/latency/{label}')
+        self.stats.inc_value('telemetry/latency/count')
+        self.stats.inc_value('telemetry/latency/sum', latency)
+
+    def counts(self):
+        """Counters the per-minute rates are computed from.
+
+        """
+        get = self.stats.get_value
+        return {
+            'pages': get('zkb/pages', 0),
+            'responses': get('response_received_count', 0),
+            'killmails': get('zkb/killmails', 0),
+        }
+
+    def write_metrics(self, spider, final=False):
+        """Appends the current metrics of `spider` to the metrics file.
+
+        """
+        get = self.stats.get_value
+        now = time.time()
+        elapsed = now - self.last_time
+        counts = self.counts()
+        minutes = elapsed / 60 or 1  # No division by 0 on a quick close
+
+        hits = get('zkb/price_cache/hits', 0)
+        misses = get('zkb/price_cache/misses', 0)
+        latency_count = get('telemetry/latency/count', 0)
+
+        metrics = {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'spider': spider.name,
+            'final': final,
+            'elapsed': round(elapsed, 3),
+        }
+        for key in counts:
+            rate = (counts[key] - self.last_counts[key]) / minutes
+            metrics[f'{key}_per_min'] = round(rate, 2)
+        metrics.update({
+            'latency_mean': (round(get('telemetry/latency/sum', 0)
+                                   / latency_count, 4)
+                             if latency_count else None),
+            'latency_hist': {label: get(f'telemetry/latency/{label}', 0)
+                             for label in LATENCY_LABELS},
+            'price_cache_hits': hits,
+            'price_cache_misses': misses,
+            'price_cache_hit_rate': (round(hits / (hits + misses), 4)
+                                     if hits + misses else None),
+            'coalesced_price_requests': get('coalesce/waited', 0),
+            'empty_page_retries': get('zkb/empty_page/retries', 0),
+            'http_retries': get('retry/count', 0),
+            'response_bytes': get('downloader/response_bytes', 0),
+            'csv_bytes': get('export/csv_bytes', 0),
+            'file_bytes': get('export/file_bytes', 0),
+            'rate_limit': get('adaptive_rate/rate'),
+        })
+
+        with open(self.uri, 'a', encoding='utf-8') as metrics_file:
+            metrics_file.write(json.dumps(metrics) + '\n')
+        self.last_time = now
+        self.last_counts = counts
+
+
+class AdaptiveRateController(object):
+    """Raises or lowers the global rate limit of the process from the
+    responses its spiders get, see the module docstring. Disabled unless
+    both ADAPTIVE_RATE_ENABLED and GLOBAL_RATE_LIMIT are set.
+
+    Every crawler gets its own controller, which counts its spider's
+    downloads. The rate itself is adjusted once per interval for the whole
+    process, from the counts of every controller.
+
+    """
+    # Shared b/w all crawlers (and so all spiders) in the process!
+    controllers = []  # Controllers of the spiders crawling right now
+    task = None  # Adjusts the rate every interval while spiders crawl
+    best_latency = None  # Lowest mean latency of an interval so far
+
+    def __init__(self, stats, interval=5.0, min_rate=1.0, max_rate=100.0,
+                 increase=1.0, decrease=0.5):
+        self.stats = stats
+        self.interval = interval
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.reset()
+        self.last_exceptions = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        rate = settings.getfloat('GLOBAL_RATE_LIMIT')
+        if not (settings.getbool('ADAPTIVE_RATE_ENABLED') and rate):
+            raise NotConfigured
+        # Never go over the API's limit, only back off from it and recover
+        max_rate = min(settings.getfloat('ADAPTIVE_RATE_MAX', rate), rate)
+        ext = cls(crawler.stats,
+                  settings.getfloat('ADAPTIVE_RATE_INTERVAL', 5.0),
+                  settings.getfloat('ADAPTIVE_RATE_MIN', 1.0),
+                  max_rate,
+                  settings.getfloat('ADAPTIVE_RATE_INCREASE', 1.0),
+                  settings.getfloat('ADAPTIVE_RATE_DECREASE', 0.5))
+        crawler.signals.connect(ext.spider_opened,
+                                signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed,
+                                signal=signals.spider_closed)
+        # Sent by the downloader for every response it downloads, before
+        # RetryMiddleware turns 429s and 5xx into retries (and before
+        # PriceRequestCoalescingMiddleware hands out copies)
+        crawler.signals.connect(ext.response_downloaded,
+                                signal=signals.response_downloaded)
+        return ext
+
+    def reset(self):
+        """Starts counting a new interval.
+
+        """
+        self.downloads = 0
+        self.throttled = 0  # 429s
+        self.errors = 0  # 5xx, 408 and download errors
+        self.latency_sum = 0.0
+        self.latency_count = 0
+
+    def spider_opened(self, spider):
+        cls = self.__class__
+        cls.controllers.append(self)
+        if cls.task is None:
+            cls.task = task.LoopingCall(cls.adjust)
+            cls.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        cls = self.__class__
+        cls.controllers.remove(self)
+        if not cls.controllers and cls.task is not None:
+            if cls.task.running:
+                cls.task.stop()
+            cls.task = None
+
+    def response_downloaded(self, response, request, spider):
+        self.downloads += 1
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            self.latency_sum += latency
+            self.latency_count += 1
+        status = response.status
+        if status == 429:
+            self.throttled += 1
+        elif status >= 500 or status == 408:
+            self.errors += 1
+
+        if status in (429, 503):
+            seconds = retry_after(response)
+            bucket = GlobalRateLimitMiddleware.bucket
+            if seconds and bucket is not None:
+                logging.warning(f"{status} FROM {request.url}! HOLDING ALL "
+                                f"REQUESTS FOR {seconds:.1f} SECONDS...")
+                bucket.hold(seconds)
+                self.stats.inc_value('adaptive_rate/retry_after_holds')
+
+    @classmethod
+    def adjust(cls):
+        """Adjusts the rate of the global token bucket from the downloads of
+        every spider over the last interval.
+
+        """
+        bucket = GlobalRateLimitMiddleware.bucket
+        if bucket is None or not cls.controllers:
+            return
+        config = cls.controllers[0]  # Same settings for every crawler
+
+        downloads = throttled = errors = latency_count = 0
+        latency_sum = 0.0
+        for c in cls.controllers:
+            # Download errors are only counted in the crawler's stats
+            total = c.stats.get_value('downloader/exception_count', 0)
+            exceptions, c.last_exceptions = total - c.last_exceptions, total
+            downloads += c.downloads
+            throttled += c.throttled
+            errors += c.errors + exceptions
+            latency_sum += c.latency_sum
+            latency_count += c.latency_count
+            c.reset()
+
+        rate = bucket.rate
+        latency = latency_sum / latency_count if latency_count else None
+        if latency is not None and (cls.best_latency is None
+                                    or latency < cls.best_latency):
+            cls.best_latency = latency
+
+        if throttled or errors > ERROR_RATIO * max(downloads, 1):
+            new_rate = max(config.min_rate, rate * config.decrease)
+        elif (latency is not None
+              and downloads >= BUSY_RATIO * rate * config.interval
+              and latency <= LATENCY_TOLERANCE * cls.best_latency):
+            new_rate = min(config.max_rate, rate + config.increase)
+        else:
+            new_rate = rate
+
+        if new_rate != rate:
+            logging.info(f"Global rate limit: {rate:.1f} -> {new_rate:.1f} "
+                         f"requests/s ({downloads} downloads, {throttled} "
+                         f"throttled, {errors} errors in "
+                         f"{config.interval}s)")
+            bucket.set_rate(new_rate)
+        for c in cls.controllers:
+            c.stats.set_value('adaptive_rate/rate', new_rate)
+            if new_rate < rate:
+                c.stats.inc_value('adaptive_rate/decreases')
+            elif new_rate > rate:
+                c.stats.inc_value('adaptive_rate/increases')
+
+
+class CrawlHistoryRecorder(object):
+    """Records the page count of the month of the crawler's spider to the
+    crawl history once the spider has crawled it to the end, see the module
+    docstring. Disabled if CRAWL_HISTORY is not set.
+
+    """
+
+    def __init__(self, history):
+        self.history = history
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        uri = crawler.settings.get('CRAWL_HISTORY')
+        if not uri:
+            raise NotConfigured
+        ext = cls(CrawlHistory(uri))
+        crawler.signals.connect(ext.page_exported, signal=page_exported)
+        return ext
+
+    def page_exported(self, spider, url, done):
+        if done and getattr(spider, 'min_killmail_id', None) is None:
+            self.history.record(url)
+
+
+def retry_after(response):
+    """Returns the seconds to wait given by the Retry-After header of
+    `response` (in seconds or an HTTP date), at most MAX_RETRY_AFTER, or
+    None if it has none.
+
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    value = value.decode('latin-1').strip()
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError):  # Neither seconds nor a date
+            return None
+        seconds = when.timestamp() - time.time()
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
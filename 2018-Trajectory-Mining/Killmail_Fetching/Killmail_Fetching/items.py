@@ -7,6 +7,10 @@
 
 import scrapy
 
+# Fields (dict keys) of a killmail exported by the Item Pipelines, in order
+KILLMAIL_FIELDS = ['killmail_id', 'killmail_time', 'victim', 'attackers',
+                   'solar_system_id', 'moon_id', 'war_id', 'zkb']
+
 # NOT IMPLEMENTED YET
 class DataList(scrapy.Item):
     # define the fields for your item here like:
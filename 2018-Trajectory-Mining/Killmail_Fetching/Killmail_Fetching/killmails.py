@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Streaming Decoding of ZKillBoard Killmail API Pages
+
+A Killmail API page is one JSON array of killmail objects. Instead of
+decoding the whole array with `json.loads`, `iter_killmails` decodes the page
+one killmail at a time and keeps only the top-level fields that the Item
+Pipeline exports. So a tail crawl (see CrawlTailPP.py) stops decoding a page
+at the first killmail an earlier run already has, and fields the API adds
+are dropped as the page is decoded.
+
+See https://docs.python.org/3/library/json.html#json.JSONDecoder.raw_decode
+
+"""
+import json
+import re
+
+DECODER = json.JSONDecoder()
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def iter_json_array(text):
+    """Yields the elements of the JSON array in `text` one at a time, decoding
+    each element only when it is asked for. Raises ValueError if `text` is
+    not a JSON array.
+
+    """
+    idx = WHITESPACE.match(text, 0).end()
+    if text[idx:idx + 1] != '[':
+        raise ValueError(f"Expecting '[' at char {idx}")
+    idx = WHITESPACE.match(text, idx + 1).end()
+    if text[idx:idx + 1] == ']':  # Empty array
+        return
+
+    while True:
+        element, idx = DECODER.raw_decode(text, idx)
+        yield element
+
+        idx = WHITESPACE.match(text, idx).end()
+        delimiter = text[idx:idx + 1]
+        if delimiter == ']':  # End of array
+            return
+        if delimiter != ',':
+            raise ValueError(f"Expecting ',' or ']' at char {idx}")
+        idx = WHITESPACE.match(text, idx + 1).end()
+
+
+def iter_killmails(text, fields):
+    """Yields a dict for every killmail on a Killmail API page, decoded
+    when it is asked for and holding only the keys in `fields` (any other
+    key is dropped as the killmail is decoded).
+
+    """
+    for killmail in iter_json_array(text):
+        yield {field: killmail[field] for field in fields if field in killmail}
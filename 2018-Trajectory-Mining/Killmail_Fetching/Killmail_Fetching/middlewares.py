@@ -5,7 +5,11 @@
 # See documentation in:
 # https://doc.scrapy.org/en/latest/topics/spider-middleware.html
 
+import time
+
 from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import defer, reactor
 
 
 class KillmailFetchingSpiderMiddleware(object):
@@ -101,3 +105,296 @@ class KillmailFetchingDownloaderMiddleware(object):
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class TokenBucket(object):
+    """Token bucket refilled at `rate` tokens per second, holding at most
+    `burst` tokens.
+
+    Taking a token never fails: when the bucket is empty the token is
+    borrowed from the future, and the caller is told how long to wait for
+    it. Callers are therefore spaced out in the order they asked, at exactly
+    `rate` per second once the burst is used up.
+
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.held_until = self.stamp  # End of the longest hold so far
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self):
+        """Takes one token and returns the number of seconds to wait before
+        using it (0 if a token was available).
+
+        """
+        self.refill()
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def set_rate(self, rate):
+        """Changes the refill rate from now on (see AdaptiveRateController).
+
+        """
+        self.refill()  # Tokens up to now are refilled at the old rate
+        self.rate = rate
+
+    def hold(self, seconds):
+        """Makes callers wait at least `seconds` from now for their next
+        token (e.g. for a Retry-After header). Holds do not add up; the
+        longest one wins.
+
+        Callers already waiting for a token aren't affected by the tokens,
+        they check `held` before using it (see `wait`).
+
+        """
+        self.refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+        self.held_until = max(self.held_until, time.monotonic() + seconds)
+
+    def held(self):
+        """Returns the seconds left of the current hold (0 if none).
+
+        """
+        return max(0, self.held_until - time.monotonic())
+
+
+def wait(delay, bucket=None, take=False):
+    """Returns a `Deferred` fired after `delay` seconds, without blocking the
+    reactor.
+
+    If `bucket` is put on hold in the meantime (e.g. for a Retry-After
+    header), the `Deferred` is only fired after the hold. With `take`, a new
+    token is taken from `bucket` once the hold is over, so the held callers
+    are spaced out again instead of all firing at once.
+
+    """
+    d = defer.Deferred()
+
+    def fire():
+        held = bucket.held() if bucket is not None else 0
+        if held > 0:
+            reactor.callLater(max(bucket.take(), held) if take else held,
+                              fire)
+        else:
+            d.callback(None)
+
+    reactor.callLater(delay, fire)
+    return d
+
+
+class GlobalRateLimitMiddleware(KillmailFetchingDownloaderMiddleware):
+    """Holds every request of every spider in the process to one shared
+    requests-per-second budget (GLOBAL_RATE_LIMIT), with a token bucket.
+
+    All crawlers of a `CrawlerProcess`/`CrawlerRunner` share the class token
+    bucket, so when some spiders finish early, their share of the budget is
+    used by the spiders still crawling, instead of hand-tuning
+    DOWNLOAD_DELAY to (API limit / number of spiders). A request that has to
+    wait for a token is held back with a `Deferred`, without blocking the
+    reactor.
+
+    AutoThrottle can't be enabled along with it (see settings.py): it would
+    add its own per-slot delays on top of the shared budget.
+
+    """
+    # Shared b/w all crawlers (and so all spiders) in the process!
+    bucket = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        rate = crawler.settings.getfloat('GLOBAL_RATE_LIMIT')
+        if not rate:
+            raise NotConfigured
+        if crawler.settings.getbool('AUTOTHROTTLE_ENABLED'):
+            raise ValueError("GLOBAL_RATE_LIMIT and AUTOTHROTTLE_ENABLED "
+                             "can't both be set, disable one of them in "
+                             "settings.py")
+        if cls.bucket is None:
+            burst = crawler.settings.getint('GLOBAL_RATE_BURST', 1)
+            cls.bucket = TokenBucket(rate, max(burst, 1))
+
+        s = cls()
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        return s
+
+    def process_request(self, request, spider):
+        delay = self.bucket.take()
+        if delay <= 0:
+            return None
+
+        # Continue processing the request once its token is available, or
+        # with a new token if the bucket was put on hold in the meantime
+        return wait(delay, self.bucket, take=True)
+
+
+class RequestDelayMiddleware(KillmailFetchingDownloaderMiddleware):
+    """Holds back a request by `request.meta['delay']` seconds before it is
+    downloaded (used by ZKBSpider to back off when retrying empty pages),
+    without blocking the reactor.
+
+    """
+
+    def process_request(self, request, spider):
+        delay = request.meta.get('delay')
+        if not delay:
+            return None
+
+        # Only delay the request once, not every time it is retried. It
+        # takes its token from GlobalRateLimitMiddleware after the delay (or
+        # after the hold, if the bucket is put on hold in the meantime)
+        del request.meta['delay']
+        return wait(delay, GlobalRateLimitMiddleware.bucket)
+
+
+class PriceRequestCoalescingMiddleware(KillmailFetchingDownloaderMiddleware):
+    """Downloads each Price API page once for all spiders in the process at a
+    time (requests with `request.meta['coalesce'] = True, see ZKBSpider).
+
+    The first request for a URL (the leader) is downloaded as usual. Requests
+    for the same URL made while the leader is in flight wait for it with a
+    `Deferred`, and each gets its own copy of the leader's response, instead
+    of being downloaded again.
+
+    Requests are coalesced by their URL when first seen, kept in
+    `request.meta['coalesce_key']`, so a leader is still matched with its
+    waiters if it is redirected. If the leader fails, its response is not a
+    200, it is dropped or its spider closes, only the first waiter is
+    downloaded on its own, as the new leader, and the others keep waiting
+    for it (instead of all hitting the API at once). A waiter that has
+    waited COALESCE_TIMEOUT seconds gives up and is downloaded on its own.
+
+    """
+    # Shared b/w all crawlers (and so all spiders) in the process! Example...
+    # waiting[key] = [(Deferred, request, spider, timeout call) of requests
+    #                 waiting for the leader of key]
+    # leaders[key] = spider of the leader of key
+    waiting = {}
+    leaders = {}
+
+    def __init__(self, stats=None, timeout=60.0):
+        self.stats = stats
+        self.timeout = timeout
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('COALESCE_PRICE_REQUESTS'):
+            raise NotConfigured
+        s = cls(crawler.stats,
+                crawler.settings.getfloat('COALESCE_TIMEOUT', 60.0))
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.request_dropped,
+                                signal=signals.request_dropped)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_request(self, request, spider):
+        if not request.meta.get('coalesce'):
+            return None
+        if request.meta.get('coalesce_leader'):  # Retry/redirect of a leader
+            return None
+
+        key = request.meta.setdefault('coalesce_key', request.url)
+        if key not in self.waiting:  # Nothing in flight, lead the download
+            self.lead(key, request, spider)
+            return None
+
+        # Wait for the leader's response (or None to download on our own)
+        d = defer.Deferred()
+        timeout = reactor.callLater(self.timeout, self.give_up, key, d)
+        self.waiting[key].append((d, request, spider, timeout))
+        if self.stats is not None:
+            self.stats.inc_value('coalesce/waited')
+        return d
+
+    def process_response(self, request, response, spider):
+        if request.meta.get('coalesce_leader'):
+            key = request.meta['coalesce_key']
+            if response.status == 200:
+                self.release(key, response)
+            else:
+                self.promote(key)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        if request.meta.get('coalesce_leader'):
+            self.promote(request.meta['coalesce_key'])
+
+    def request_dropped(self, request, spider):
+        if request.meta.get('coalesce_leader'):
+            self.promote(request.meta['coalesce_key'])
+
+    def spider_closed(self, spider, reason):
+        cls = self.__class__
+        for key in list(cls.waiting):
+            # Forget the spider's own waiters, their downloads are gone
+            waiters = []
+            for waiter in cls.waiting[key]:
+                if waiter[2] is spider:
+                    if waiter[3].active():
+                        waiter[3].cancel()
+                else:
+                    waiters.append(waiter)
+            cls.waiting[key] = waiters
+            if cls.leaders.get(key) is spider:
+                self.promote(key)
+
+    def lead(self, key, request, spider):
+        """Makes `request` the leader of `key`.
+
+        """
+        self.waiting.setdefault(key, [])
+        self.leaders[key] = spider
+        request.meta['coalesce_leader'] = True
+
+    def release(self, key, response):
+        """Hands a copy of `response` to every request waiting for `key`.
+
+        """
+        self.leaders.pop(key, None)
+        for d, _, _, timeout in self.waiting.pop(key, []):
+            if timeout.active():
+                timeout.cancel()
+            d.callback(response.replace())
+
+    def promote(self, key):
+        """Downloads the first request waiting for `key` on its own, as the
+        new leader, after its leader failed. The others keep waiting.
+
+        """
+        waiters = self.waiting.get(key)
+        if not waiters:
+            self.waiting.pop(key, None)
+            self.leaders.pop(key, None)
+            return
+        d, request, spider, timeout = waiters.pop(0)
+        if timeout.active():
+            timeout.cancel()
+        self.lead(key, request, spider)
+        if self.stats is not None:
+            self.stats.inc_value('coalesce/promoted')
+        d.callback(None)
+
+    def give_up(self, key, d):
+        """Downloads a request on its own after waiting COALESCE_TIMEOUT
+        seconds for the leader of `key`.
+
+        """
+        waiters = self.waiting.get(key, [])
+        for waiter in waiters:
+            if waiter[0] is d:
+                waiters.remove(waiter)
+                break
+        if self.stats is not None:
+            self.stats.inc_value('coalesce/timeouts')
+        d.callback(None)
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""Compressed, Rotating CSV Output Files for the Export Pipelines
+
+`RotatingOutput` is the file ProcessBasedExportPipeline (and
+BufferedExportPipeline) hands to its CsvItemExporter. Depending on
+settings.py it:
+
+    - compresses the CSV as it is written (EXPORT_COMPRESSION = 'gzip' or
+      'zstd', the latter needing `$pip install zstandard`), and
+    - starts a new file once the current one is bigger than
+      EXPORT_MAX_FILE_BYTES, e.g. 10000002201505.csv.gz,
+      10000002201505-0001.csv.gz, 10000002201505-0002.csv.gz, ...
+
+Every file starts with the CSV header line, so each can be read on its own,
+e.g. pandas.read_csv('10000002201505-0001.csv.gz'). When either option is
+on, a manifest (10000002201505.manifest.json) lists the files of the spider
+in order, with their size and number of rows.
+
+Compressed data is ended (a gzip member or zstd frame is closed) at every
+checkpoint, so a file can be cut back to any checkpoint and appended to (see
+checkpoints.py). gzip and zstd both read files of several members/frames as
+one stream.
+
+Files are not kept open for the whole crawl. All outputs in a process share
+one `FilePool`, which keeps at most EXPORT_MAX_OPEN_FILES files open, closes
+the least recently written one when another is needed, and reopens files in
+append mode when they are written to again. So CrawlConcPP.py can run many
+more spiders than the open file limit (`$ulimit -n`) allows. Each output has
+its own lock, so outputs of different spiders are written by their threads in
+parallel.
+
+"""
+import gzip
+import io
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+try:  # Only needed for EXPORT_COMPRESSION = 'zstd'
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# File extension of each compression
+EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+class FilePool(object):
+    """Bounded LRU of open output files, shared by all RotatingOutputs of a
+    process. Each open file has an owner (a RotatingOutput), which is told to
+    end its compressed data before its file is closed.
+
+    Outputs are written from the reactor thread and from
+    BufferedExportPipeline's worker threads. Every RotatingOutput method
+    that writes holds the output's own `lock`, so outputs are written in
+    parallel, and the pool's `lock` is only held while files are opened and
+    closed. A file is only closed by the pool if its owner's lock is free,
+    i.e. while no other thread is writing to it.
+
+    """
+
+    def __init__(self, max_open=512):
+        self.max_open = max_open
+        self.files = OrderedDict()  # uri -> (file, owner), oldest first
+        self.lock = threading.Lock()
+
+    def get(self, uri, owner):
+        """Returns `uri` opened for appending, opening it (and closing the
+        least recently used file, if too many are open) if need be.
+
+        """
+        with self.lock:
+            try:
+                file, _ = self.files[uri]
+                self.files.move_to_end(uri)
+                return file
+            except KeyError:  # Not open, or closed by the pool
+                pass
+            self.make_room()
+            file = open(uri, 'ab')
+            self.files[uri] = (file, owner)
+            return file
+
+    def make_room(self):
+        """Closes the least recently used files until another one can be
+        opened. Files being written by another thread right now are skipped
+        (trying to wait for them could deadlock), so if all of them are,
+        more than `max_open` files stay open for a moment.
+
+        """
+        for uri in list(self.files):
+            if len(self.files) < self.max_open:
+                return
+            file, owner = self.files[uri]
+            if not owner.lock.acquire(blocking=False):
+                continue
+            try:
+                del self.files[uri]
+                owner.end_stream()
+                file.close()
+            finally:
+                owner.lock.release()
+
+    def discard(self, uri):
+        """Closes `uri`, if it is open.
+
+        """
+        with self.lock:
+            try:
+                file, _ = self.files.pop(uri)
+            except KeyError:
+                return
+            file.close()
+
+
+class RotatingOutput(io.RawIOBase):
+    """Binary file-like CSV output of a spider, compressed and split into
+    size-bounded files as set up in the module docstring.
+
+    `base` is the path of the first file without extensions, e.g.
+    '10000002201505'. `header` is the CSV header line (bytes) written at the
+    start of every file.
+
+    """
+
+    # Open files of all outputs in the process, see ProcessBasedExportPipeline
+    pool = FilePool()
+
+    def __init__(self, base, header, compression=None, max_bytes=None):
+        super().__init__()
+        if compression == 'zstd' and zstandard is None:
+            logging.warning("EXPORT_COMPRESSION IS 'zstd', BUT ZSTANDARD IS "
+                            "NOT INSTALLED! USING 'gzip' INSTEAD...")
+            compression = 'gzip'
+        if compression not in EXTENSIONS:
+            raise ValueError(f"Unknown EXPORT_COMPRESSION: {compression!r}")
+        self.base = base
+        self.header = header
+        self.lock = threading.RLock()  # Held while writing, see FilePool
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.manifest_uri = f"{base}.manifest.json"
+        self.stream = None  # Compressor writing to self.raw, if any
+        self.chunk = 0  # Number of the current file
+        self.rows = 0  # Rows written to the current file (by the pipeline)
+        self.files = []  # Manifest entries of the files before the current
+        self.full = False  # Move on to a new file before the next write
+        self.bytes_written = 0  # CSV bytes written, before compression
+        self.disk_bytes = 0  # Size of all files on disk, as of last checkpoint
+
+    # ======================================================================= #
+    # File-like Methods (used by CsvItemExporter's TextIOWrapper)
+    # ======================================================================= #
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        with self.lock:
+            if self.full:  # Only checked at checkpoints, at a page boundary
+                self.rotate()
+            raw = self.raw  # Reopens the file if the pool closed it
+            if self.stream is None:  # Start a new gzip member/zstd frame
+                self.stream = self.open_stream(raw)
+            self.stream.write(b)
+            self.bytes_written += len(b)
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            with self.lock:
+                self.end_stream()
+                self.write_manifest()
+                self.pool.discard(self.uri(self.chunk))
+        super().close()
+
+    @property
+    def raw(self):
+        """Current file on disk, opened for appending by the pool.
+
+        """
+        return self.pool.get(self.uri(self.chunk), self)
+
+    # ======================================================================= #
+    # Checkpoints, Rotation and Resuming
+    # ======================================================================= #
+
+    def uri(self, chunk):
+        """Path of file number `chunk` of the spider.
+
+        """
+        number = f"-{chunk:04d}" if chunk else ''
+        return f"{self.base}{number}.csv{EXTENSIONS[self.compression]}"
+
+    def open(self, checkpoint=None):
+        """Opens the output, either as a new first file, or resumed from
+        `checkpoint` (a crawl journal entry): the checkpoint's file is cut
+        back to the checkpoint and appended to, and files after it are
+        deleted.
+
+        A new first file overwrites the first file of an earlier run, so the
+        earlier run's other files and manifest are deleted too, instead of
+        being mixed up with the new ones.
+
+        """
+        if checkpoint is None:
+            self.remove_files(1)
+            if os.path.exists(self.manifest_uri):
+                os.remove(self.manifest_uri)
+            self.files = []
+            self.start_file(0)
+            return
+
+        chunk = checkpoint.get('chunk') or 0
+        uri = self.uri(chunk)
+        if not os.path.exists(uri):
+            logging.warning(f"{uri} IS MISSING, BUT IT IS RESUMING FROM A "
+                            f"CHECKPOINT! STARTING A NEW FILE...")
+            self.files = self.read_manifest()[:chunk]
+            self.start_file(chunk)
+            return
+
+        # Remove files written after the checkpoint
+        self.remove_files(chunk + 1)
+
+        self.files = self.read_manifest()[:chunk]
+        self.chunk = chunk
+        self.rows = checkpoint.get('rows') or 0
+        with open(uri, 'r+b') as raw:
+            raw.truncate(checkpoint['offset'])
+        if not checkpoint['offset']:
+            self.write_raw(self.header)
+        with self.lock:  # The pool may close the file otherwise
+            self.full = bool(self.max_bytes
+                             and self.raw.tell() >= self.max_bytes)
+
+    def remove_files(self, chunk):
+        """Deletes file number `chunk` and the files after it, if any.
+
+        """
+        while os.path.exists(self.uri(chunk)):
+            os.remove(self.uri(chunk))
+            chunk += 1
+
+    def start_file(self, chunk):
+        """Starts file number `chunk`, beginning with the CSV header line.
+
+        """
+        self.chunk = chunk
+        self.rows = 0
+        self.full = False
+        open(self.uri(chunk), 'wb').close()  # New, empty file
+        self.write_raw(self.header)
+
+    def rotate(self):
+        """Closes the current file and starts the next one.
+
+        """
+        self.end_stream()
+        self.files.append(self.manifest_entry())
+        self.pool.discard(self.uri(self.chunk))
+        self.start_file(self.chunk + 1)
+
+    def write_raw(self, b):
+        # Header goes in its own gzip member/zstd frame
+        self.write(b)
+        self.end_stream()
+
+    def checkpoint(self):
+        """Ends the compressed data written so far, so the current file can be
+        cut back to here. If the current file is too big, the next row starts
+        a new file. Returns the position to record in the crawl journal as a
+        dict: {'chunk': ..., 'offset': ..., 'rows': ...}
+
+        """
+        with self.lock:
+            self.end_stream()
+            raw = self.raw
+            raw.flush()
+            offset = raw.tell()
+            self.full = bool(self.max_bytes and offset >= self.max_bytes)
+            self.disk_bytes = sum(f['bytes'] for f in self.files) + offset
+            self.write_manifest()
+        return {'chunk': self.chunk, 'offset': offset, 'rows': self.rows}
+
+    # ======================================================================= #
+    # Compression
+    # ======================================================================= #
+
+    def open_stream(self, raw):
+        if self.compression == 'gzip':
+            return gzip.GzipFile(fileobj=raw, mode='wb', mtime=0)
+        if self.compression == 'zstd':
+            compressor = zstandard.ZstdCompressor()
+            return compressor.stream_writer(raw, closefd=False)
+        return raw
+
+    def end_stream(self):
+        """Closes the current gzip member/zstd frame, if any. Also called by
+        the pool right before it closes the file.
+
+        """
+        if self.stream is None:
+            return
+        if self.compression == 'gzip':
+            self.stream.close()  # Leaves self.raw open
+        elif self.compression == 'zstd':
+            self.stream.flush(zstandard.FLUSH_FRAME)
+        self.stream = None
+
+    # ======================================================================= #
+    # Manifest
+    # ======================================================================= #
+
+    def manifest_entry(self):
+        return {'file': os.path.basename(self.uri(self.chunk)),
+                'bytes': self.raw.tell(), 'rows': self.rows}
+
+    def read_manifest(self):
+        try:
+            with open(self.manifest_uri, 'r', encoding='utf-8') as manifest:
+                return json.load(manifest)['files']
+        except (OSError, ValueError, KeyError):  # Missing or cut short
+            return []
+
+    def write_manifest(self):
+        if not (self.compression or self.max_bytes):
+            return
+        manifest = {
+            'compression': self.compression,
+            'files': self.files + [self.manifest_entry()],
+        }
+        # Replace the manifest in one step, so it is never half-written
+        tmp_uri = f"{self.manifest_uri}.tmp"
+        with open(tmp_uri, 'w', encoding='utf-8') as tmp:
+            json.dump(manifest, tmp, indent=2)
+        os.replace(tmp_uri, self.manifest_uri)
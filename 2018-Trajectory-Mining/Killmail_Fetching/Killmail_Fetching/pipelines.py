@@ -6,30 +6,89 @@
 # See: https://doc.scrapy.org/en/latest/topics/item-pipeline.html
 
 import logging
+import os
+import queue
+import re
+import threading
+from scrapy.exceptions import NotConfigured
 from scrapy.exporters import CsvItemExporter
+from twisted.internet import defer, reactor, threads
+
+try:  # Only needed by ColumnarExportPipeline
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+from Killmail_Fetching.checkpoints import CrawlJournal, page_exported
+from Killmail_Fetching.columnar import TABLE_COLUMNS, flatten_killmail
+from Killmail_Fetching.items import KILLMAIL_FIELDS
+from Killmail_Fetching.outputs import RotatingOutput
 
 
 class ProcessBasedExportPipeline(object):
     """Distribute each killmail to a unique CSV file according to which spider
     sent the killmail.
 
+    If CHECKPOINT_JOURNAL is set, every page the spider finishes is
+    checkpointed to the crawl journal (see checkpoints.py), and a spider that
+    resumes from a checkpoint has its CSV file cut back to the checkpoint and
+    appended to, instead of overwritten.
+
+    The CSV file may be compressed (EXPORT_COMPRESSION) and split into
+    size-bounded files (EXPORT_MAX_FILE_BYTES), see outputs.py. It is only
+    kept open while it is among the EXPORT_MAX_OPEN_FILES files of the
+    process written to most recently.
+
     """
 
-    def __init__(self):
+    def __init__(self, journal=None, compression=None, max_bytes=None):
         self.file = None
         self.fields = None
         self.exporter = None
+        self.journal = journal
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.stats = None  # Crawler stats, for CrawlTelemetry
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        uri = crawler.settings.get('CHECKPOINT_JOURNAL')
+        pipeline = cls(
+            CrawlJournal(uri) if uri else None,
+            compression=crawler.settings.get('EXPORT_COMPRESSION'),
+            max_bytes=crawler.settings.getint('EXPORT_MAX_FILE_BYTES') or None
+        )
+        crawler.signals.connect(pipeline.page_exported, signal=page_exported)
+        pipeline.stats = crawler.stats
+        # Shared b/w all crawlers (and so all spiders) in the process!
+        RotatingOutput.pool.max_open = crawler.settings.getint(
+            'EXPORT_MAX_OPEN_FILES', 512)
+        return pipeline
 
     def open_spider(self, spider):
-        # Unique filepath based on spider's name
-        uri = f"{spider.name.split('_')[-1]}.csv"
-        self.file = open(uri, 'wb')
         # CSV Header Fields (dict keys) accepted by the pipeline
-        self.fields = ['killmail_id', 'killmail_time', 'victim', 'attackers',
-                       'solar_system_id', 'moon_id', 'war_id', 'zkb']
+        self.fields = KILLMAIL_FIELDS
+        # Unique filepath based on spider's name
+        self.file = RotatingOutput(
+            spider.name.split('_')[-1],
+            header=(','.join(self.fields) + '\r\n').encode('utf-8'),
+            compression=self.compression,
+            max_bytes=self.max_bytes
+        )
+        # Last checkpoint of the spider from a previous run, if any. If there
+        # is one, rows after the checkpoint are dropped, then the file is
+        # appended to
+        checkpoint = None
+        if self.journal is not None:
+            checkpoint = self.journal.get(spider.name)
+        self.file.open(checkpoint)
         # Use built-in exporter with pre-defined header fields
-        self.exporter = CsvItemExporter(self.file, include_headers_line=True,
-                                        fields_to_export=self.fields)
+        self.exporter = CsvItemExporter(
+            self.file,
+            include_headers_line=False,  # Written by RotatingOutput
+            fields_to_export=self.fields
+        )
         self.exporter.start_exporting()
 
     def close_spider(self, spider):
@@ -48,7 +107,37 @@ class ProcessBasedExportPipeline(object):
         #   'war_id': 123456
         #   'zkb': { `ZKB quick info on killmail` }
         # }
-        for field in item:
+        self.clean_item(item)
+        self.export_item(item)
+        return item
+
+    def export_item(self, item):
+        self.write_item(item)
+        self.update_stats(rows=1)
+
+    def write_item(self, item):
+        self.exporter.export_item(item)
+        self.file.rows += 1
+
+    def update_stats(self, rows=0, csv_bytes=None, file_bytes=None):
+        """Adds `rows` to the rows exported, and sets the bytes written so far
+        (if given), in the crawler stats.
+
+        """
+        if self.stats is None:
+            return
+        if rows:
+            self.stats.inc_value('export/rows', rows)
+        if csv_bytes is not None:
+            self.stats.set_value('export/csv_bytes', csv_bytes)
+        if file_bytes is not None:
+            self.stats.set_value('export/file_bytes', file_bytes)
+
+    def clean_item(self, item):
+        """Removes fields the CSV header doesn't have from `item`.
+
+        """
+        for field in list(item):  # Copy keys, fields are deleted in the loop
             if field not in self.fields:
                 logging.warning(
                     f"UNEXPECTED FIELD ({field}) IN KILLMAIL "
@@ -56,5 +145,372 @@ class ProcessBasedExportPipeline(object):
                     f"FIELD..."
                 )
                 del item[field]
-        self.exporter.export_item(item)
+
+    def page_exported(self, spider, url, done, killmails=None):
+        """Flushes the CSV file and checkpoints the page the spider just
+        finished to the crawl journal.
+
+        """
+        self.record_checkpoint(spider.name, url, done, killmails)
+
+    def record_checkpoint(self, spider_name, url, done, killmails=None):
+        # Page boundary of the CSV file, even without a journal (see outputs)
+        position = self.file.checkpoint()
+        self.update_stats(csv_bytes=self.file.bytes_written,
+                          file_bytes=self.file.disk_bytes)
+        if self.journal is not None:
+            self.journal.record(spider_name, url, done=done,
+                                killmails=killmails, **position)
+
+
+class BufferedExportPipeline(ProcessBasedExportPipeline):
+    """ProcessBasedExportPipeline that writes the CSV file on a worker thread,
+    so formatting nested killmail dicts doesn't hold up the Twisted reactor
+    (and every other spider in the process).
+
+    Items are collected into batches of EXPORT_BATCH_SIZE killmails, which
+    are put on a queue holding at most EXPORT_QUEUE_BATCHES batches. The
+    worker thread takes batches off the queue in order and exports them.
+    Page checkpoints (see checkpoints.py) go through the same queue, so the
+    journal only records a page once all of its killmails are on disk.
+
+    If the worker falls behind and the queue is full, process_item returns a
+    Deferred that fires once the batch is queued, so Scrapy stops sending the
+    spider's items (see CONCURRENT_ITEMS) until the worker catches up.
+
+    Crawler stats aren't thread-safe, so the worker hands its counts back to
+    the reactor thread (once per batch) instead of updating them itself.
+
+    """
+
+    def __init__(self, journal=None, compression=None, max_bytes=None,
+                 batch_size=100, queue_batches=8):
+        super().__init__(journal, compression, max_bytes)
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_batches)
+        self.waiting = []  # (entry, Deferred) not yet put on the queue
+        self.batch = []
+        self.worker = None
+        self.spider_name = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        uri = crawler.settings.get('CHECKPOINT_JOURNAL')
+        pipeline = cls(
+            CrawlJournal(uri) if uri else None,
+            compression=crawler.settings.get('EXPORT_COMPRESSION'),
+            max_bytes=crawler.settings.getint('EXPORT_MAX_FILE_BYTES') or None,
+            batch_size=crawler.settings.getint('EXPORT_BATCH_SIZE', 100),
+            queue_batches=crawler.settings.getint('EXPORT_QUEUE_BATCHES', 8)
+        )
+        crawler.signals.connect(pipeline.page_exported, signal=page_exported)
+        pipeline.stats = crawler.stats
+        # Shared b/w all crawlers (and so all spiders) in the process!
+        RotatingOutput.pool.max_open = crawler.settings.getint(
+            'EXPORT_MAX_OPEN_FILES', 512)
+        return pipeline
+
+    def open_spider(self, spider):
+        super().open_spider(spider)
+        self.spider_name = spider.name
+        self.worker = threading.Thread(
+            target=self.write_batches,
+            name=f"export-{spider.name}",
+            daemon=True
+        )
+        self.worker.start()
+
+    def close_spider(self, spider):
+        self.queue_batch()
+        d = self.enqueue(None)  # Tells the worker to stop
+        # Wait for the worker to finish writing without blocking the reactor
+        d.addCallback(lambda _: threads.deferToThread(self.worker.join))
+        d.addCallback(lambda _: super(BufferedExportPipeline,
+                                      self).close_spider(spider))
+        return d
+
+    def process_item(self, item, spider):
+        self.clean_item(item)
+        self.batch.append(item)
+        if len(self.batch) < self.batch_size:
+            return item
+        d = self.queue_batch()
+        d.addCallback(lambda _: item)
+        return d
+
+    def page_exported(self, spider, url, done, killmails=None):
+        """Queues a checkpoint of the page the spider just finished, written
+        to the crawl journal by the worker after the page's killmails.
+
+        """
+        self.queue_batch()
+        self.enqueue(('checkpoint', url, done, killmails))
+
+    def queue_batch(self):
+        """Puts the current batch of items on the queue. Returns a Deferred
+        that fires once it is on the queue.
+
+        """
+        batch, self.batch = self.batch, []
+        if not batch:
+            return defer.succeed(None)
+        return self.enqueue(('items', batch))
+
+    def enqueue(self, entry):
+        """Puts `entry` on the queue for the worker, in order. Returns a
+        Deferred that fires once it is on the queue (right away, unless the
+        queue is full).
+
+        """
+        if not self.waiting:
+            try:
+                self.queue.put_nowait(entry)
+                return defer.succeed(None)
+            except queue.Full:
+                pass
+        d = defer.Deferred()
+        self.waiting.append((entry, d))
+        return d
+
+    def refill(self):
+        """Moves waiting entries onto the queue while it has room. Called on
+        the reactor thread every time the worker takes an entry.
+
+        """
+        while self.waiting:
+            entry, d = self.waiting[0]
+            try:
+                self.queue.put_nowait(entry)
+            except queue.Full:
+                return
+            self.waiting.pop(0)
+            d.callback(None)
+
+    def update_stats(self, rows=0, csv_bytes=None, file_bytes=None):
+        """Updates the crawler stats on the reactor thread (only called by the
+        worker).
+
+        """
+        reactor.callFromThread(super().update_stats, rows, csv_bytes,
+                               file_bytes)
+
+    def write_batches(self):
+        """Worker thread: exports queued batches and records queued
+        checkpoints, until it gets None.
+
+        """
+        while True:
+            entry = self.queue.get()
+            reactor.callFromThread(self.refill)  # Room for a waiting entry
+            if entry is None:
+                return
+            try:
+                if entry[0] == 'items':
+                    written = 0
+                    try:
+                        for item in entry[1]:
+                            self.write_item(item)
+                            written += 1
+                    finally:
+                        self.update_stats(rows=written)
+                else:  # Checkpoint
+                    _, url, done, killmails = entry
+                    self.record_checkpoint(self.spider_name, url, done,
+                                           killmails)
+            except Exception:  # Keep writing, or the spider would hang
+                logging.exception(f"UNABLE TO EXPORT {entry[0].upper()} "
+                                  f"FOR {self.spider_name}!")
+
+
+class ColumnarExportPipeline(object):
+    """Write each killmail to normalized, typed Parquet tables (killmails,
+    victims, items, attackers; see columnar.py), one set of tables per
+    spider, alongside the CSV file of ProcessBasedExportPipeline.
+
+    Rows are buffered in per-column lists and written out as a new part file
+    of every table at the first page checkpoint (see checkpoints.py) after
+    COLUMNAR_BATCH_SIZE killmails, and when the spider closes. Tables are
+    written to COLUMNAR_EXPORT_DIR/<table>/<spider>-<page>.parquet, <page>
+    being the last page in the part, so each table folder can be read as one
+    dataset, e.g. pyarrow.parquet.read_table('parquet/items',
+    columns=['item_type_id', 'total_price']).
+
+    Part files only ever hold whole pages. Each is written under a temporary
+    name starting with '_' (skipped by Parquet dataset readers) and renamed
+    once complete. With a CHECKPOINT_JOURNAL, the page the newest part ends
+    on is then recorded in the journal, and a resumed spider crawls again
+    from its last checkpoint at or before that page, so the rows a crash
+    lost from the buffer are written again. Part files past the checkpoint
+    it resumes from (renamed before the journal caught up with them) are
+    deleted, as are the rows of a page the spider didn't finish when it
+    closes. A spider that starts over (no checkpoint) deletes its part files
+    of an earlier run first.
+
+    Needs pyarrow (`$pip install pyarrow`). Disabled if pyarrow is missing or
+    COLUMNAR_EXPORT_DIR is not set.
+
+    """
+
+    def __init__(self, export_dir, batch_size=10000, journal=None):
+        self.export_dir = export_dir
+        self.batch_size = batch_size
+        self.journal = journal
+        self.schemas = {table: self.arrow_schema(columns)
+                        for table, columns in TABLE_COLUMNS.items()}
+        self.name = None
+        self.url = None  # Page of the last checkpoint
+        self.page = 0  # ... and its number
+        self.columns = {}
+        self.buffered = 0
+        self.marks = {}  # Rows of every table buffered at the last checkpoint
+        self.marked = 0  # Killmails buffered at the last checkpoint
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        export_dir = crawler.settings.get('COLUMNAR_EXPORT_DIR')
+        if not export_dir:
+            raise NotConfigured
+        if pa is None:
+            logging.warning("COLUMNAR_EXPORT_DIR IS SET, BUT PYARROW IS NOT "
+                            "INSTALLED! COLUMNAR EXPORT DISABLED...")
+            raise NotConfigured
+        uri = crawler.settings.get('CHECKPOINT_JOURNAL')
+        pipeline = cls(export_dir,
+                       crawler.settings.getint('COLUMNAR_BATCH_SIZE', 10000),
+                       CrawlJournal(uri) if uri else None)
+        crawler.signals.connect(pipeline.page_exported, signal=page_exported)
+        return pipeline
+
+    @staticmethod
+    def arrow_schema(columns):
+        types = {
+            'int64': pa.int64(),
+            'float64': pa.float64(),
+            'bool': pa.bool_(),
+            'string': pa.string(),
+            'timestamp': pa.timestamp('s', tz='UTC'),
+        }
+        return pa.schema([(name, types[kind]) for name, kind in columns])
+
+    def open_spider(self, spider):
+        # Unique filename based on spider's name, as for the CSV file (but
+        # without its folder, the table folders are in COLUMNAR_EXPORT_DIR)
+        self.name = os.path.basename(spider.name.split('_')[-1])
+        checkpoint = (self.journal.get(spider.name)
+                      if self.journal is not None else None)
+        if checkpoint is not None:
+            self.url = checkpoint['url']
+            self.page = CrawlJournal.page(self.url)
+        else:
+            self.url = None
+            self.page = 0
+        part = re.compile(rf"(_?){re.escape(self.name)}-(\d+)\.parquet"
+                          rf"(\.inprogress)?")
+        for table in TABLE_COLUMNS:
+            table_dir = os.path.join(self.export_dir, table)
+            os.makedirs(table_dir, exist_ok=True)
+            for filename in os.listdir(table_dir):
+                match = part.fullmatch(filename)
+                if match is None:
+                    continue
+                path = os.path.join(table_dir, filename)
+                if match.group(3):  # Left behind by a crash, never complete
+                    logging.warning(f"REMOVING {path}, LEFT HALF-WRITTEN BY "
+                                    f"A CRASHED RUN! ITS PAGES ARE CRAWLED "
+                                    f"AGAIN IF THE CRAWL IS RESUMED...")
+                    os.remove(path)
+                elif checkpoint is None:  # Starting over, drop old parts
+                    os.remove(path)
+                elif int(match.group(2)) > self.page:
+                    logging.warning(f"REMOVING {path}, WRITTEN AFTER THE "
+                                    f"CHECKPOINT {spider.name} RESUMES FROM! "
+                                    f"ITS PAGES ARE CRAWLED AGAIN...")
+                    os.remove(path)
+        if self.journal is not None:  # Parts deleted above no longer count
+            self.journal.record_parquet(spider.name, self.url)
+        self.clear_columns()
+
+    def close_spider(self, spider):
+        if self.journal is not None:
+            # Rows of an unfinished page, crawled again on resume
+            self.drop_unmarked()
+            if self.write_part(self.page):
+                self.journal.record_parquet(spider.name, self.url)
+        else:  # Rows of an unfinished page go with the page after the last
+            self.write_part(self.page + (self.buffered > self.marked))
+
+    def page_exported(self, spider, url, done):
+        """Marks the end of a page in the buffered rows, and writes them out
+        as a part file once there are enough of them (recording the page in
+        the crawl journal).
+
+        """
+        self.url = url
+        self.page = CrawlJournal.page(url)
+        self.mark()
+        if self.buffered >= self.batch_size or done:
+            self.write_part(self.page)
+            if self.journal is not None:
+                self.journal.record_parquet(spider.name, url)
+
+    def process_item(self, item, spider):
+        try:
+            rows = flatten_killmail(item)
+        except (KeyError, TypeError, ValueError) as e:
+            logging.warning(f"UNABLE TO WRITE KILLMAIL "
+                            f"{item.get('killmail_id')} TO COLUMNAR TABLES "
+                            f"({e}). SKIPPING...")
+            return item
+
+        for table, table_rows in rows.items():
+            columns = self.columns[table]
+            for row in table_rows:
+                for name, values in columns.items():
+                    values.append(row.get(name))
+        self.buffered += 1
         return item
+
+    def clear_columns(self):
+        self.columns = {
+            table: {name: [] for name, _ in columns}
+            for table, columns in TABLE_COLUMNS.items()
+        }
+        self.buffered = 0
+        self.mark()
+
+    def mark(self):
+        """Remembers the buffered rows as those of finished pages.
+
+        """
+        self.marks = {table: len(next(iter(columns.values())))
+                      for table, columns in self.columns.items()}
+        self.marked = self.buffered
+
+    def drop_unmarked(self):
+        """Drops the rows buffered since the last page checkpoint.
+
+        """
+        for table, columns in self.columns.items():
+            for values in columns.values():
+                del values[self.marks[table]:]
+        self.buffered = self.marked
+
+    def write_part(self, page):
+        """Writes the buffered rows of every table to their part file ending
+        on `page`, as one row group each. Returns False if there are no rows.
+
+        """
+        if not self.buffered:
+            return False
+        filename = f"{self.name}-{page}.parquet"
+        for table, columns in self.columns.items():
+            schema = self.schemas[table]
+            arrays = [pa.array(columns[field.name], type=field.type)
+                      for field in schema]
+            table_dir = os.path.join(self.export_dir, table)
+            tmp_path = os.path.join(table_dir, f"_{filename}.inprogress")
+            pq.write_table(pa.Table.from_arrays(arrays, schema=schema),
+                           tmp_path)
+            os.replace(tmp_path, os.path.join(table_dir, filename))
+        self.clear_columns()
+        return True
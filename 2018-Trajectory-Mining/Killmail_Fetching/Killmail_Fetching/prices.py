@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""Item Price Histories and Persistent Price Storage for ZKBSpider
+
+Every page of the ZKillBoard Price API holds the whole date -> price history
+of one item. `PriceHistory` keeps that history as sorted arrays, so the price
+of the item on any date can be answered locally by binary search.
+
+`PageItems` flattens the items of every victim on a Killmail API page into
+parallel arrays, so the prices of a page are looked up once per (item ID,
+date) and written back to the items in one pass.
+
+Item prices scraped from the ZKillBoard Price API are written to a SQLite
+database keyed by (item_id, date), so that every spider in a process, and
+every later run of CrawlConcPP.py or CrawlSeqRegionsPP.py, can reuse the
+prices that have already been downloaded.
+
+The database location is set by `PRICE_STORE_URI` in settings.py. Set it to
+None to keep prices in memory only.
+
+See https://docs.python.org/3/library/sqlite3.html for more info.
+
+"""
+import sqlite3
+from array import array
+from bisect import bisect_left
+from datetime import date
+
+
+def to_ordinal(date_str):
+    """Converts a 'YYYY-MM-DD' string to its proleptic Gregorian ordinal day
+    (see `datetime.date.toordinal`). Raises ValueError if `date_str` is not
+    a date. Much faster than `datetime.strptime` for this one format.
+
+    """
+    if len(date_str) != 10 or date_str[4] != '-' or date_str[7] != '-':
+        raise ValueError(f"Not a YYYY-MM-DD date: {date_str!r}")
+    return date(int(date_str[:4]), int(date_str[5:7]),
+                int(date_str[8:10])).toordinal()
+
+
+class PriceHistory(object):
+    """Sorted date -> price history of a single item, indexed for lookups.
+
+    `days` is an integer array of ordinal days (see `to_ordinal`) in
+    chronological order and `prices` holds the price on each of those days.
+    Both are built once per item, so every lookup afterwards is a binary
+    search over integers, without parsing any date strings in the history.
+
+    """
+
+    def __init__(self, days, prices):
+        self.days = days
+        self.prices = prices
+
+    def __len__(self):
+        return len(self.days)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Creates a history from (date_str, price) rows, in any order. Rows
+        whose date is not a date, or whose price is not a number, are
+        skipped.
+
+        """
+        indexed = []
+        for date_str, price in rows:
+            if not (type(price) is float or type(price) is int):
+                continue
+            try:
+                indexed.append((to_ordinal(date_str), price))
+            except (TypeError, ValueError):  # key could not be processed
+                continue
+        indexed.sort()
+        return cls(array('l', [day for day, _ in indexed]),
+                   array('d', [price for _, price in indexed]))
+
+    @classmethod
+    def from_api(cls, api_prices):
+        """Creates a history from a parsed Price API page, e.g.
+        {'2018-01-01': 1234.5, ...}.
+
+        """
+        return cls.from_rows(api_prices.items())
+
+    def items(self):
+        """Yields the (date_str, price) rows of the history in order.
+
+        """
+        for day, price in zip(self.days, self.prices):
+            yield date.fromordinal(day).isoformat(), price
+
+    def get(self, date_str, max_distance=None):
+        """Returns the price on `date_str`, or the price on the nearest date
+        in the history if `date_str` is missing (the earlier date wins a
+        tie).
+
+        Raises KeyError if the history is empty, `date_str` is not a date, or
+        the nearest date is more than `max_distance` days away (no cutoff if
+        `max_distance` is None).
+
+        """
+        try:
+            day = to_ordinal(date_str)
+        except (TypeError, ValueError):
+            raise KeyError(date_str)
+
+        days = self.days
+        i = bisect_left(days, day)
+        if i < len(days) and days[i] == day:  # Exact date
+            return self.prices[i]
+        if not days:
+            raise KeyError(date_str)
+
+        # Nearest date is either right before or right after `date_str`
+        if i == 0:
+            nearest = 0
+        elif i == len(days) or day - days[i - 1] <= days[i] - day:
+            nearest = i - 1
+        else:
+            nearest = i
+
+        if max_distance is not None:
+            if abs(days[nearest] - day) > max_distance:  # Too far away
+                raise KeyError(date_str)
+        return self.prices[nearest]
+
+
+class PageItems(object):
+    """Every item of every victim on a killmail page, as parallel arrays.
+
+    Position `n` is one item: `items[n]` is its dict in the page's data
+    (where `total_price` is written), `quantities[n]` the quantity destroyed
+    or dropped, and `keys[n]` its (item_id, date) price key, the date being
+    the day of its killmail.
+
+    """
+
+    def __init__(self, data):
+        self.items = []
+        self.quantities = array('q')
+        self.keys = []
+
+        for killmail in data:
+            date_str = killmail['killmail_time'].split('T')[0]
+            for item in killmail['victim']['items']:
+                # Item is either destroyed or dropped, always one of those
+                # keys (0 if neither, no quantity info)
+                quantity = item.get('quantity_destroyed',
+                                    item.get('quantity_dropped', 0))
+                self.items.append(item)
+                self.quantities.append(quantity)
+                self.keys.append((str(item['item_type_id']), date_str))
+
+    def __len__(self):
+        return len(self.items)
+
+    def group(self):
+        """Returns the positions of the items by price key, e.g.
+        groups[(item_id, date)] = [3, 17, 18], in order of first appearance.
+
+        """
+        groups = {}
+        for n, key in enumerate(self.keys):
+            try:
+                groups[key].append(n)
+            except KeyError:
+                groups[key] = [n]
+        return groups
+
+    def scatter(self, positions, price):
+        """Writes the total price of the items at `positions` given `price`,
+        the price of one unit. If the price wasn't found, `price` is a string
+        with info about the attempted lookup, and is written as is.
+
+        """
+        items = self.items
+        if type(price) is float or type(price) is int:
+            quantities = self.quantities
+            for n in positions:
+                items[n]['total_price'] = price * quantities[n]
+        else:
+            for n in positions:
+                items[n]['total_price'] = price
+
+
+class PriceStore(object):
+    """SQLite-backed table of item prices keyed by (item_id, date).
+
+    Items whose whole price history has been stored are listed in the
+    `histories` table. Other items may still have single (item_id, date)
+    rows written by older versions of the spider.
+
+    Only real prices (ints and floats) are stored. The 'price not found'
+    strings used by ZKBSpider are left out on purpose, so that a future run
+    gets another chance to find the price.
+
+    """
+
+    def __init__(self, uri):
+        self.uri = uri
+        # Spiders share one store, all on the Twisted reactor thread
+        self.conn = sqlite3.connect(uri)
+        # Let other processes read the store while this one is writing
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS prices ('
+            '  item_id TEXT NOT NULL,'
+            '  date TEXT NOT NULL,'
+            '  price REAL NOT NULL,'
+            '  PRIMARY KEY (item_id, date)'
+            ')'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS histories ('
+            '  item_id TEXT PRIMARY KEY'
+            ')'
+        )
+        self.conn.commit()
+
+    def load(self):
+        """Returns every stored price of items without a whole price history
+        as a dict of dicts, e.g. prices[item_id][date_str] = price
+
+        """
+        prices = {}
+        for item_id, date_str, price in self.conn.execute(
+                'SELECT item_id, date, price FROM prices WHERE item_id NOT IN '
+                '(SELECT item_id FROM histories)'):
+            try:
+                prices[item_id][date_str] = price
+            except KeyError:  # item_id has no date dict yet
+                prices[item_id] = {date_str: price}
+        return prices
+
+    def get(self, item_id, date_str):
+        """Returns the stored price of `item_id` on `date_str`. Raises KeyError
+        if no price is stored.
+
+        """
+        row = self.conn.execute(
+            'SELECT price FROM prices WHERE item_id = ? AND date = ?',
+            (item_id, date_str)
+        ).fetchone()
+        if row is None:
+            raise KeyError((item_id, date_str))
+        return row[0]
+
+    def load_histories(self):
+        """Returns every stored whole price history as a dict, e.g.
+        histories[item_id] = PriceHistory
+
+        """
+        rows = {}
+        for item_id, date_str, price in self.conn.execute(
+                'SELECT p.item_id, p.date, p.price FROM prices p '
+                'JOIN histories h ON p.item_id = h.item_id '
+                'ORDER BY p.item_id, p.date'):
+            try:
+                rows[item_id].append((date_str, price))
+            except KeyError:  # item_id has no rows yet
+                rows[item_id] = [(date_str, price)]
+
+        histories = {}
+        for (item_id,) in self.conn.execute('SELECT item_id FROM histories'):
+            histories[item_id] = PriceHistory.from_rows(rows.get(item_id, []))
+        return histories
+
+    def get_history(self, item_id):
+        """Returns the stored whole price history of `item_id`. Raises
+        KeyError if it has not been stored.
+
+        """
+        if self.conn.execute('SELECT 1 FROM histories WHERE item_id = ?',
+                             (item_id,)).fetchone() is None:
+            raise KeyError(item_id)
+        rows = self.conn.execute(
+            'SELECT date, price FROM prices WHERE item_id = ? ORDER BY date',
+            (item_id,)
+        ).fetchall()
+        return PriceHistory.from_rows(rows)
+
+    def save_history(self, item_id, history):
+        """Replaces everything stored for `item_id` with its whole price
+        history, in one transaction.
+
+        """
+        with self.conn:  # Commits, or rolls back on error
+            self.conn.execute('DELETE FROM prices WHERE item_id = ?',
+                              (item_id,))
+            self.conn.executemany(
+                'INSERT INTO prices (item_id, date, price) VALUES (?, ?, ?)',
+                [(item_id, date_str, price)
+                 for date_str, price in history.items()]
+            )
+            self.conn.execute(
+                'INSERT OR IGNORE INTO histories (item_id) VALUES (?)',
+                (item_id,)
+            )
+
+    def close(self):
+        self.conn.close()
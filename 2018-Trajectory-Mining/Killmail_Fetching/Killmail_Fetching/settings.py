@@ -54,25 +54,93 @@ DEFAULT_REQUEST_HEADERS = {
 
 # Enable or disable downloader middlewares
 # See https://doc.scrapy.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
-#    'Killmail_Fetching.middlewares.KillmailFetchingDownloaderMiddleware': 543,
-#}
+DOWNLOADER_MIDDLEWARES = {
+    'Killmail_Fetching.middlewares.PriceRequestCoalescingMiddleware': 541,
+    'Killmail_Fetching.middlewares.RequestDelayMiddleware': 542,
+    'Killmail_Fetching.middlewares.GlobalRateLimitMiddleware': 543,
+}
+
+# Requests per second allowed for ALL spiders of a process together, enforced
+# by GlobalRateLimitMiddleware. USER_AGENT limit (using $scrapy bench):
+# ~3000 pages/m | 50 pages/s. Set to None to disable the global limit.
+GLOBAL_RATE_LIMIT = 50
+# Requests that may be sent back-to-back before the rate limit kicks in
+GLOBAL_RATE_BURST = 10
+
+# Tune GLOBAL_RATE_LIMIT while crawling (see AdaptiveRateController): raise it
+# by ADAPTIVE_RATE_INCREASE requests/s every ADAPTIVE_RATE_INTERVAL seconds
+# while latency is flat, multiply it by ADAPTIVE_RATE_DECREASE on 429s or
+# errors, and keep it between ADAPTIVE_RATE_MIN and ADAPTIVE_RATE_MAX.
+# ADAPTIVE_RATE_MAX is capped at GLOBAL_RATE_LIMIT, the API's own limit
+ADAPTIVE_RATE_ENABLED = True
+ADAPTIVE_RATE_INTERVAL = 5.0
+ADAPTIVE_RATE_INCREASE = 1.0
+ADAPTIVE_RATE_DECREASE = 0.5
+ADAPTIVE_RATE_MIN = 5
+ADAPTIVE_RATE_MAX = 50
+
+# Download a Price API page once for every spider of the process waiting on
+# it at the same time (see PriceRequestCoalescingMiddleware)
+COALESCE_PRICE_REQUESTS = True
+# Seconds a request waits for another spider's download of the same page
+# before it is downloaded on its own
+COALESCE_TIMEOUT = 60
 
 # Enable or disable extensions
 # See https://doc.scrapy.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
+EXTENSIONS = {
 #    'scrapy.extensions.telnet.TelnetConsole': None,
-#}
+    'Killmail_Fetching.extensions.CrawlTelemetry': 500,
+    'Killmail_Fetching.extensions.AdaptiveRateController': 510,
+    'Killmail_Fetching.extensions.CrawlHistoryRecorder': 520,
+}
+
+# JSON-lines file every spider's crawl metrics are appended to, by
+# CrawlTelemetry (see extensions.py). Set to None to disable telemetry.
+TELEMETRY_URI = 'crawl_metrics.jl'
+# Seconds between metrics snapshots of a spider
+TELEMETRY_INTERVAL = 60
 
 # Configure item pipelines
 # See https://doc.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
-    'Killmail_Fetching.pipelines.ProcessBasedExportPipeline': 500,
+    'Killmail_Fetching.pipelines.BufferedExportPipeline': 500,
+    'Killmail_Fetching.pipelines.ColumnarExportPipeline': 510,
 }
 
+# Killmails BufferedExportPipeline collects before handing them to its
+# writer thread, and most batches that may wait for the writer at once
+EXPORT_BATCH_SIZE = 100
+EXPORT_QUEUE_BATCHES = 8
+
+# Compression of the CSV files written by the export pipelines: None, 'gzip'
+# or 'zstd' (needs zstandard), see outputs.py
+EXPORT_COMPRESSION = None
+# Size (bytes on disk) after which a spider's CSV output moves on to a new
+# file, e.g. 10000002201505-0001.csv. None to keep one file per spider
+EXPORT_MAX_FILE_BYTES = None
+
+# Most CSV files the export pipelines of a process keep open at once (the
+# least recently written file is closed, and reopened when needed)
+EXPORT_MAX_OPEN_FILES = 512
+
+# Folder of the typed Parquet tables written by ColumnarExportPipeline (see
+# columnar.py), alongside the CSV files. Needs pyarrow. Set to None to only
+# write CSV files.
+COLUMNAR_EXPORT_DIR = None
+# Killmails buffered per Parquet part file (written at the next page
+# checkpoint after this many). With a CHECKPOINT_JOURNAL, a crashed crawl
+# resumes from the last page written to the Parquet tables.
+COLUMNAR_BATCH_SIZE = 10000
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://doc.scrapy.org/en/latest/topics/autothrottle.html
-AUTOTHROTTLE_ENABLED = True
+# Disabled while GLOBAL_RATE_LIMIT is set: AutoThrottle adds its own delay
+# (AUTOTHROTTLE_START_DELAY) to every download slot and tunes each slot on
+# its own, so GLOBAL_RATE_LIMIT would never be the actual limit and the two
+# would fight each other. AdaptiveRateController tunes the global limit
+# instead. GlobalRateLimitMiddleware refuses to run with both enabled.
+AUTOTHROTTLE_ENABLED = False
 # The initial download delay
 #AUTOTHROTTLE_START_DELAY = 5
 # The maximum download delay to be set in case of high latencies
@@ -90,7 +158,53 @@ AUTOTHROTTLE_ENABLED = True
 #HTTPCACHE_DIR = 'httpcache'
 #HTTPCACHE_IGNORE_HTTP_CODES = []
 #HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.FilesystemCacheStorage'
-RETRY_HTTP_CODES = [500, 502, 503, 504, 408, 400]
+# 429: Too Many Requests, retried once the rate limit has backed off
+RETRY_HTTP_CODES = [500, 502, 503, 504, 408, 400, 429]
+
+# Root URL of the ZKillBoard Killmail and Price APIs. Point it at a local
+# stand-in (see zkbstub.py) to benchmark crawls without zkillboard.com
+ZKB_API_ROOT = 'https://zkillboard.com/api/'
+
+# Regions and months ('YYYY-MM', both included) crawled by CrawlConcPP.py and
+# CrawlSeqRegionsPP.py, one spider per region/month (see crawlplan.py)
+CRAWL_REGION_IDS = ['10000002', '10000016', '10000033', '10000069']
+CRAWL_START = '2015-05'
+CRAWL_END = '2018-05'
+# Page count of every region/month crawled to its end (see crawlplan.py),
+# used to start the longest months first. Set to None to start them in
+# region/date order.
+CRAWL_HISTORY = 'crawl_history.jl'
+
+# Persistent item price database shared by all spiders and runs (see
+# prices.py). Set to None to keep prices in memory only.
+PRICE_STORE_URI = 'itemprices.db'
+# Furthest (in days) the nearest date in an item's price history may be from
+# the killmail date and still be used for its price. None for no cutoff.
+PRICE_MAX_DATE_DISTANCE = None
+
+# Decode Killmail API pages one killmail at a time, keeping only the fields
+# exported by the Item Pipeline, instead of json.loads-ing the whole page. A
+# tail crawl stops decoding at the first killmail it already has (see
+# killmails.py).
+KILLMAIL_STREAMING_PARSE = False
+
+# Journal of the last fully exported page of every spider (see
+# checkpoints.py). Re-running a crawl resumes each spider from its last
+# checkpoint. Set to None to always crawl (and overwrite CSVs) from page 1.
+CHECKPOINT_JOURNAL = 'crawl_journal.jl'
+
+# How a spider decides an empty Killmail API page is the end of its month:
+# 'retry' requests the empty page 10 times before giving up, 'conditional'
+# only takes it as the end if the previous page was not full, and otherwise
+# retries it (with an exponential backoff). A month whose empty page is still
+# empty after the retries is taken as finished too.
+EMPTY_PAGE_DETECTION = 'conditional'
+# Most killmails the Killmail API returns on one page
+KILLMAIL_PAGE_SIZE = 200
+# Most times an ambiguous empty page is requested again
+EMPTY_PAGE_MAX_RETRIES = 1
+# Seconds to wait before the first retry (doubled after every retry)
+EMPTY_PAGE_BACKOFF = 1.0
 
 # Configure amount of information to be logged while crawling
 # See https://doc.scrapy.org/en/latest/topics/settings.html#log-level
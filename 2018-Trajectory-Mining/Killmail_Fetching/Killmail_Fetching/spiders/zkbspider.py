@@ -7,8 +7,9 @@ CHECK SETTINGS.PY!!!
 This is where project wide settings are enabled. Currently enabled settings:
     ROBOTSTXT_OBEY = True
     COOKIES_ENABLED = False
-    AUTOTHROTTLE_ENABLED = True
-    ^^See https://doc.scrapy.org/en/latest/topics/autothrottle.html
+    GLOBAL_RATE_LIMIT = 50
+    ^^Shared by all spiders, see GlobalRateLimitMiddleware in middlewares.py.
+      AUTOTHROTTLE_ENABLED must stay False while it is set!
     LOG_LEVEL = 'INFO'
     ^^See https://doc.scrapy.org/en/latest/topics/settings.html#log-level
 
@@ -23,10 +24,14 @@ Created on: 06-25-2018
 Last Modified: 07-17-2018
 """
 import json
-from datetime import datetime, timedelta
 from logging import debug, info, warning
 
-from scrapy import Spider, Request
+from scrapy import Spider, Request, signals
+
+from Killmail_Fetching.checkpoints import CrawlJournal, page_exported
+from Killmail_Fetching.items import KILLMAIL_FIELDS
+from Killmail_Fetching.killmails import iter_killmails
+from Killmail_Fetching.prices import PageItems, PriceHistory, PriceStore
 
 
 class ZKBSpider(Spider):
@@ -44,68 +49,82 @@ class ZKBSpider(Spider):
         1) Parses response from the Killmail API page
            'https://zkillboard.com/api/kills/regionID/#/year/#/month/#/page/#/'
            as a JSON string, converting the string to a list of dicts and
-           storing that list to a class data list. If the page returned an
+           keeping that list as the page data list. If the page returned an
            empty list, the algorithm skips to step 5. Otherwise, proceeds
            as follows:
 
-        2) For each dict (aka single killmail) in the list, a sub-list of
-           items that were in the victim's ship is parsed; for each item, the
-           price of that item on the date of the killmail's creation (contained
-           in the parent dict) is looked up in the spider's class price dict:
+        2) The items that were in the victim's ship of every dict (aka
+           single killmail) in the list are flattened into parallel arrays of
+           item dicts, quantities and (item id, date of the killmail's
+           creation) keys (see PageItems). Items are grouped by key, and the
+           price of every key is looked up once in the spider's class price
+           dict:
 
                a) If the class price dict has the price for the date
-                  requested, that price is multiplied by the quantity_dropped
-                  or quantity_destroyed integer supplied with the item info
-                  sub-list, and the total price is added to that item's info
-                  sub-list in the class data list.
-
-               b) If the class price dict does not have the price for the
-                  item on the date requested, the indexes of the item and
-                  killmail dicts in each's parent list is recorded, along with
-                  the item id and date requested, in a class lookup dict,
-                  keyed by the item id, then date, then location indexes.
-
-        3) Once all items have been parsed, and lists updated, the class lookup
-           table is attempted to be iterated over by item ID. If the inital
-           request to grab the next item ID fails, then no prices need to be
-           looked up, and the algorithm proceeeds to step 4. Else, the
-           algorithm enters the 'Price Lookup' protocol below:
-
-               a) A GET Request is made to the grabbed item's Price API page
-                  at 'https://zkillboard.com/api/prices/item_id/', and the
-                  response is parsed and converted from a JSON string to a list
-                  of dicts with (date:price) entries.
-
-               b) For each date in the current item's entry of the class lookup
-                  table, the price is first sought in the class price dict to
-                  avoid parsing duplicate URLS. If the price cannot be found in
-                  the class price dict, then each date's price is searched for
-                  in the parsed Price API page. If the date is not found on the
-                  page, a method is deployed to find the nearest date on the
-                  page to the requested date, and that date's price is grabbed.
-                  If the price still cannot be obtained, a string with the item
+                  requested, or the class price history dict has the whole
+                  price history of the item, that price is multiplied by the
+                  quantity_dropped or quantity_destroyed integer of each item
+                  of the group, and the total price is added to that item's
+                  info sub-list in the page data list.
+
+               b) If neither has the price for the item on the date
+                  requested, the positions of the items of the group are
+                  recorded in a page lookup dict, keyed by the item id, then
+                  date.
+
+        3) Once all items have been parsed, and lists updated, the page lookup
+           table is attempted to be iterated over by item ID. If the lookup
+           table is empty, then no prices need to be looked up, and the
+           algorithm proceeeds to step 4. Else, the algorithm enters the
+           'Price Lookup' protocol below:
+
+               a) GET Requests are made to the Price API pages of the item IDs
+                  in the lookup table at
+                  'https://zkillboard.com/api/prices/item_id/', up to
+                  `price_concurrency` at a time, so that the price pages of a
+                  killmail page are downloaded concurrently. Each response is
+                  parsed and converted from a JSON string to a list of dicts
+                  with (date:price) entries.
+
+               b) The whole date -> price history on the Price API page is
+                  stored, sorted by date, in the class price history dict (and
+                  the persistent price store), so the price page of an item
+                  is never needed again. For each date in the current item's
+                  entry of the page lookup table, the price is binary
+                  searched for in the history. If the date is not found in
+                  the history, the nearest date's price is used instead. If
+                  the history is empty, or the nearest date is further than
+                  PRICE_MAX_DATE_DISTANCE days away, a string with the item
                   ID, date, and URL parsed is used in place of a price.
 
                c) The value obtained from any of the above processes is added
                   to the class price dict, then to the class data set. The
-                  location indexes in the class lookup table for the current
-                  item on the current date are used to place the price in each
-                  sub-list of the class data list at the location indexes.
+                  positions in the page lookup table for the current item on
+                  the current date are used to place the price in each item
+                  of the page data list at those positions.
 
-               d) The next item is attempted to be grabbed from the class
-                  lookup table. If an item is available, the protocol repeats.
-                  Else, the protocol ends and the algorithm continues to step 4.
+               d) Each time a price page lands (or fails after retrying), the
+                  next item still waiting in the page lookup table is
+                  requested. When the last outstanding price page of the
+                  killmail page has landed, the protocol ends and the
+                  algorithm continues to step 4.
 
-        4) Each dict in the class data list is sent to an Item Pipeline for
+        4) Each dict in the page data list is sent to an Item Pipeline for
            processing, then appended to a CSV output file. The page modifier
            for the Killmail API URL is then incremented by 1, and the algorithm
-           repeats back to step 1.
+           repeats back to step 1. In a tail crawl (`min_killmail_id` set),
+           parsing stops at the first killmail already exported by an earlier
+           run, and the spider finishes after exporting the newer ones.
 
-        5) When the class data list is empty, no more pages exist for the
+        5) When the page data list is empty, no more pages exist for the
            current /regionID/#/year/#/month/#/ path modifier. At this point,
-           the 'Retry Protocol' is enabled. The same URL that produced the
-           empty API page will be requested a maximum of 10 times to ensure the
-           page did not load slowly. If the page produces data while being
+           the 'Retry Protocol' is enabled. With EMPTY_PAGE_DETECTION set to
+           'retry', the same URL that produced the empty API page will be
+           requested a maximum of 10 times to ensure the page did not load
+           slowly. With 'conditional', the previous page's size and last
+           killmail time are used to tell if the empty page is the expected
+           end of the month; only if they can't tell is the URL requested
+           again, after a backoff. If the page produces data while being
            requested, the algorithm starts back at Step 1. Otherwise, the page
            is assumed to be the end of the API, and the Spider finishes
            crawling.
@@ -119,6 +138,131 @@ class ZKBSpider(Spider):
     # price information!
     itemprice_db = None
 
+    # Whole price history of every item whose price page has been parsed
+    # (e.g. pricehistory_db[item_id] = PriceHistory). Any date of an item in
+    # here is answered locally, without requesting the price page again.
+    # Also shared b/w instances of spiders!
+    pricehistory_db = None
+
+    # Persistent copy of itemprice_db on disk (see prices.py), opened by the
+    # first spider of the process using the PRICE_STORE_URI setting, and
+    # closed by the last one to close. Also shared b/w instances of spiders!
+    price_store = None
+
+    # Number of spiders of the process that are open (see spider_closed)
+    open_spiders = 0
+
+    # Maximum number of Price API requests a spider keeps in flight at once
+    # for a single killmail page. Can be overridden per spider by passing
+    # `price_concurrency=#` as a kwarg to `CrawlerProcess.crawl()`
+    price_concurrency = 8
+
+    # Root of the ZKillBoard APIs, set from ZKB_API_ROOT in settings.py (e.g.
+    # pointed at the local stand-in of zkbstub.py for benchmarks)
+    api_root = 'https://zkillboard.com/api/'
+
+    # Newest killmail ID exported by an earlier run, for tail crawls (see
+    # CrawlTailPP.py). Pages list killmails newest first, so the spider stops
+    # at the first killmail at or below this ID instead of crawling the rest
+    # of the month. Passed as `min_killmail_id=#` to `CrawlerProcess.crawl()`
+    min_killmail_id = None
+
+    # Set once a page reaches `min_killmail_id`; the page is the spider's last
+    tail_reached = False
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        """Creates the spider and connects it to the `spider_opened` signal,
+        so that the class price database is warmed up before crawling, and to
+        the `spider_closed` signal.
+
+        """
+        spider = super(ZKBSpider, cls).from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.spider_opened,
+                                signal=signals.spider_opened)
+        crawler.signals.connect(spider.spider_closed,
+                                signal=signals.spider_closed)
+        return spider
+
+    def spider_opened(self, spider):
+        """Opens the persistent price store (once per process) and loads all
+        previously scraped prices into the class price database.
+
+        """
+        self.__class__.open_spiders += 1
+        # Prices are only loaded once per process, a store reopened after
+        # every spider closed has nothing new for the class price database
+        # (prices stored by other processes are read as they are needed)
+        first = self.__class__.itemprice_db is None
+        if first:
+            self.__class__.itemprice_db = {}
+        if self.__class__.pricehistory_db is None:
+            self.__class__.pricehistory_db = {}
+
+        # Furthest (in days) a price history date may be from the requested
+        # date and still be used as the nearest price, None for no cutoff
+        self.price_max_distance = self.settings.get('PRICE_MAX_DATE_DISTANCE')
+        if self.price_max_distance is not None:
+            self.price_max_distance = int(self.price_max_distance)
+
+        self.api_root = self.settings.get('ZKB_API_ROOT', self.api_root)
+        if self.min_killmail_id is not None:  # Kwargs may be strings
+            self.min_killmail_id = int(self.min_killmail_id)
+
+        uri = self.settings.get('PRICE_STORE_URI')
+        if uri and self.__class__.price_store is None:
+            self.__class__.price_store = PriceStore(uri)
+            if not first:
+                return
+            histories = self.__class__.price_store.load_histories()
+            self.__class__.pricehistory_db.update(histories)
+            info(f"Loaded {len(histories)} item price histories from {uri}")
+
+            stored = self.__class__.price_store.load()
+            for item_id in stored:
+                try:
+                    self.__class__.itemprice_db[item_id].update(
+                        stored[item_id])
+                except KeyError:  # item_id has no date dict yet
+                    self.__class__.itemprice_db[item_id] = stored[item_id]
+            info(f"Loaded {sum(len(d) for d in stored.values())} item prices "
+                 f"from {uri}")
+
+    def spider_closed(self, spider):
+        """Closes the persistent price store once no spider of the process is
+        open anymore.
+
+        """
+        self.__class__.open_spiders -= 1
+        if (self.__class__.open_spiders == 0
+                and self.__class__.price_store is not None):
+            self.__class__.price_store.close()
+            self.__class__.price_store = None
+
+    def start_requests(self):
+        """Starts crawling from `start_urls`, or resumes from the page after
+        the spider's last checkpoint in the crawl journal (see
+        checkpoints.py), if there is one.
+
+        """
+        uri = self.settings.get('CHECKPOINT_JOURNAL')
+        checkpoint = CrawlJournal(uri).get(self.name) if uri else None
+
+        if checkpoint is None:  # Fresh crawl
+            for request in super(ZKBSpider, self).start_requests():
+                yield request
+        elif checkpoint['done']:
+            info(f"{self.name} already finished crawling in a previous run!")
+        else:
+            info(f"Resuming {self.name} after {checkpoint['url']}")
+            request = Request(url=self.update_url(checkpoint['url']),
+                              callback=self.parse)
+            # Size of the checkpointed page, to tell if an empty next page is
+            # the end of the month (see confirm_empty_page)
+            if checkpoint.get('killmails') is not None:
+                request.meta['prev_count'] = checkpoint['killmails']
+            yield request
+
     # ======================================================================= #
     # Required Callback Methods
     # ======================================================================= #
@@ -128,139 +272,288 @@ class ZKBSpider(Spider):
         and requests new Killmail API page, if any are left to scrape.
 
         """
-        # Populate self.price_table and self.data with info from killmail API
-        self.parse_killmails(response)
+        # Populate price_table and data with info from killmail API
+        data, price_table, page_items = self.parse_killmails(response)
         main_url = response.url
 
-        # self.price_table is non-empty dict, begin 'Price Lookup' Protocol
-        if self.price_table:
-            lookup = iter(self.price_table)  # Convert price table to iterator
-            item_id = next(lookup)  # Get first item
-            # For debugging; to enable set LOG_LEVEL to 'DEBUG'
-            debug(f"Looking up item ID {item_id}...")
-            price_url = f'https://zkillboard.com/api/prices/{item_id}/'
-            request = Request(
-                url=price_url,
-                callback=self.parse_prices,
-                dont_filter=True  # Visit a price page multiple times if need be
-            )
-            request.meta['lookup_table'] = lookup
-            request.meta['main_url'] = main_url
-            yield request
+        # price_table is non-empty dict, begin 'Price Lookup' Protocol
+        if price_table:
+            lookup = PriceLookup(main_url, data, price_table, page_items)
+            for request in self.request_prices(lookup):
+                yield request
 
         # No prices needed to be looked up (prices added already from db), or
-        # Killmail API was empty, meaning self.data will be an empty list
+        # Killmail API was empty, meaning data will be an empty list
         else:
-            if self.data:
-                # Send data to ProcessBasedExportPipeline for writing to CSV
-                for line in self.data:
-                    # For debugging; to enable set LOG_LEVEL to 'DEBUG'
-                    debug(f"Yielded killmail #{line['killmail_id']}!")
-                    yield line
-
-                # Update main URL to new killmail API /page/ while self.data
-                next_url = self.update_url(main_url)  # Update URL
-                yield Request(url=next_url, callback=self.parse)
-
-            else:  # Follow 'Retry' Protocol in case page loaded slowly
-                try:
-                    retries = response.meta['retries']
-                    retries += 1
-                except KeyError:  # Begin 'Retry Protocol'
-                    retries = 1
-
-                info(f"No killmails found at {main_url}.")
-                info(f"Attempting retry... Attempted Retries so far: "
-                     f"{retries}")
-
-                if retries < 10:  # Try it 10 times before quitting
-                    request = Request(
-                        url=main_url,
-                        callback=self.parse,
-                        dont_filter=True  # Allow multiple visits to same URL
-                    )
-                    request.meta['retries'] = retries
-                    yield request
+            if data:
+                for output in self.export_page(data, main_url):
+                    yield output
 
-                else:
-                    info("All pages scraped for "
-                         f"{'/'.join(main_url.split('/')[:-2])}/! "
-                         "Closing spider...")
+            elif self.tail_reached:  # Every killmail was already exported
+                self.finish_tail(main_url)
+
+            else:  # Page is either the end of the month or loaded slowly
+                for request in self.confirm_empty_page(response):
+                    yield request
 
     def parse_prices(self, response):
-        """Parses the price page of one item, collects price information by
-        requested date, stores it to the class database, and adds that price
-        info to the class data list. Requests next price page or new killmail
-        API page.
+        """Parses the price page of one item, stores its whole price history
+        to the class database, and adds the price info of every requested
+        date to the page data list. Requests the next price page still
+        waiting in the lookup table, or the new killmail API page once the
+        last outstanding price page of the current killmail page has landed.
 
         """
         api_prices = json.loads(response.text)
         price_url = response.url
         item_id = price_url.split('/')[-2]
 
+        lookup = response.meta['lookup']
+        history = PriceHistory.from_api(api_prices)
+        if not history:
+            # Empty histories are not kept (or stored), so later pages (and
+            # future runs) try the item again
+            info(f"No price history found at {price_url}.")
+            self.price_not_found(lookup, item_id, price_url)
+            for output in self.finish_price(lookup):
+                yield output
+            return
+
+        # Keep the whole price history of the item, so that any later date
+        # of this item is answered without visiting the price page again
+        self.__class__.pricehistory_db[item_id] = history
+        if self.__class__.price_store is not None:
+            self.__class__.price_store.save_history(item_id, history)
+
         # Look up price for each date in the price table
-        for km_date in self.price_table[item_id]:
+        for km_date in lookup.price_table[item_id]:
             item_info = (item_id, km_date, price_url)  # (str, str, str)
-            price = f"Item ID: {item_id}, Date: {km_date}, URL: {price_url}"
+            # Add the price info to the data set!
+            self.add_price(lookup, self.get_price(item_id, km_date), item_info)
 
-            # If price page has already been visited, grab existing entry
-            try:
-                price = self.__class__.itemprice_db[item_id][km_date]
+        for output in self.finish_price(lookup):
+            yield output
 
-            # If entry doesn't exist, populate with price info
-            except KeyError:
-                if api_prices:  # API Prices returned non-empty list
-                    try:
-                        datetime.strptime(km_date, '%Y-%m-%d')
-                        price = api_prices[km_date]  # Grab price from API
+    def price_failed(self, failure):
+        """Errback for Price API requests that failed even after retrying.
 
-                    except ValueError:
-                        # If datetime.strptime() throws ValueError, don't
-                        # bother getting nearest price or looking km_date up!
-                        pass
+        The items on the page still need a value, so every date requested for
+        the item gets the usual 'price not found' string (which is NOT stored
+        to the class database, so later pages will try the item again), and
+        the page is joined as if the price page had been parsed.
 
-                    except KeyError:  # No price information for specific date
-                        price = self.get_nearest_price(item_info, api_prices)
+        """
+        request = failure.request
+        item_id = request.url.split('/')[-2]
+        warning(f"Price lookup failed for item ID {item_id}: "
+                f"{failure.getErrorMessage()}")
 
-                # Add price info to database
-                try:
-                    self.__class__.itemprice_db[item_id][km_date] = \
-                        price
-                except KeyError:  # item_id has no date dict yet
-                    self.__class__.itemprice_db[item_id] = \
-                        {km_date: price}
+        lookup = request.meta['lookup']
+        self.price_not_found(lookup, item_id, request.url)
+        for output in self.finish_price(lookup):
+            yield output
 
-            finally:
-                # Finally add the price info to the data set!
-                self.add_price(price, item_info)
+    def price_not_found(self, lookup, item_id, price_url):
+        """Gives every date requested for the item on the page of `lookup` the
+        usual 'price not found' string, without storing it to the class
+        database.
+
+        """
+        for km_date in lookup.price_table[item_id]:
+            item_info = (item_id, km_date, price_url)
+            price = f"Item ID: {item_id}, Date: {km_date}, URL: {price_url}"
+            self.add_price(lookup, price, item_info)
+
+    # ======================================================================= #
+    # Price Lookup Fan-out Methods
+    # ======================================================================= #
+    def request_prices(self, lookup):
+        """Creates Price API requests for the items of `lookup` that have not
+        been requested yet, until `self.price_concurrency` requests are in
+        flight for the page.
+
+        """
+        while lookup.in_flight < self.price_concurrency:
+            try:
+                item_id = next(lookup.items)
+            except StopIteration:  # Every item has been requested
+                break
+
+            # Another spider may have landed the item's price page since this
+            # page was parsed, so answer it from the class database instead
+            if item_id in self.__class__.pricehistory_db:
+                for km_date in lookup.price_table[item_id]:
+                    item_info = (item_id, km_date, None)
+                    self.add_price(lookup, self.get_price(item_id, km_date),
+                                   item_info)
+                continue
 
-        # Create new Request for the next item in the lookup table
-        try:
-            lookup = response.meta['lookup_table']  # Grab lookup table
-            item_id = next(lookup)  # Get next item
             # For debugging; to enable set LOG_LEVEL to 'DEBUG'
             debug(f"Looking up item ID {item_id}...")
-            price_url = f'https://zkillboard.com/api/prices/{item_id}/'
+            price_url = self.get_price_url(item_id)
             request = Request(
                 url=price_url,
                 callback=self.parse_prices,
+                errback=self.price_failed,
                 dont_filter=True  # Visit a price page multiple times if need be
             )
-            request.meta['lookup_table'] = lookup
-            request.meta['main_url'] = response.meta['main_url']
+            request.meta['lookup'] = lookup
+            # Share the download with other spiders requesting the item now
+            # (see PriceRequestCoalescingMiddleware)
+            request.meta['coalesce'] = True
+            lookup.in_flight += 1
+            yield request
+
+    def finish_price(self, lookup):
+        """Marks one Price API request of `lookup` as landed, refills the
+        in-flight window, and when the last price page of the killmail page
+        has landed, sends the page's killmails to the Item Pipeline and
+        requests the next killmail API page.
+
+        """
+        lookup.in_flight -= 1
+
+        for request in self.request_prices(lookup):
             yield request
 
         # No more prices to look up, all items have price data
-        except StopIteration:
-            # Send data to ProcessBasedExportPipeline for writing to CSV
-            for line in self.data:
-                # For debugging; to enable set LOG_LEVEL to 'DEBUG'
-                debug(f"Yielded killmail #{line['killmail_id']}!")
-                yield line
+        if lookup.in_flight == 0:
+            # Release the page's data as it is sent to the pipeline, so it is
+            # not kept alive by the lookup while the next page is crawled
+            data, lookup.data = lookup.data, None
+            lookup.price_table = lookup.page_items = None
+
+            for output in self.export_page(data, lookup.main_url):
+                yield output
+
+    def confirm_empty_page(self, response):
+        """Decides whether an empty Killmail API page is the end of the
+        spider's month, or should be requested again in case it loaded
+        slowly.
+
+        If EMPTY_PAGE_DETECTION is 'retry', the same URL is requested a
+        maximum of 10 times before the month is assumed to be finished.
+
+        If EMPTY_PAGE_DETECTION is 'conditional' (see settings.py), the
+        previous page is used to tell: if it held fewer killmails than a full
+        page (KILLMAIL_PAGE_SIZE), the empty page is the expected end of the
+        month and no retry is needed. Otherwise the empty page is ambiguous,
+        and the URL is requested again after an exponential backoff, at most
+        EMPTY_PAGE_MAX_RETRIES times. If it is still empty, the month is
+        assumed to be finished (a month ending on a full page, or with no
+        killmails at all, would be crawled again by every run otherwise).
+
+        """
+        main_url = response.url
+        retries = response.meta.get('retries', 0) + 1
+        info(f"No killmails found at {main_url}.")
+
+        mode = self.settings.get('EMPTY_PAGE_DETECTION')
+        conditional = mode == 'conditional'
+        expected = True  # The 'retry' protocol can't tell
+        if conditional:
+            expected = self.is_end_of_month(response.meta)
+            max_retries = self.settings.getint('EMPTY_PAGE_MAX_RETRIES', 1)
+            retry = not expected and retries <= max_retries
+        else:  # Follow 'Retry' Protocol in case page loaded slowly
+            retry = retries < 10  # Try it 10 times before quitting
+
+        if retry:
+            info(f"Attempting retry... Attempted Retries so far: {retries}")
+            self.crawler.stats.inc_value('zkb/empty_page/retries')
+            request = Request(
+                url=main_url,
+                callback=self.parse,
+                dont_filter=True  # Allow multiple visits to same URL
+            )
+            # Keep the previous page's info for the next decision
+            if 'prev_count' in response.meta:
+                request.meta['prev_count'] = response.meta['prev_count']
+            request.meta['retries'] = retries
+            if conditional:
+                # Wait longer after every retry (see RequestDelayMiddleware)
+                backoff = self.settings.getfloat('EMPTY_PAGE_BACKOFF', 1.0)
+                request.meta['delay'] = backoff * 2 ** (retries - 1)
+            yield request
+
+        else:
+            if not expected:
+                warning(f"STILL NO KILLMAILS AT {main_url} AFTER "
+                        f"{retries - 1} RETRIES! ASSUMING THE MONTH IS "
+                        f"FINISHED...")
+                self.crawler.stats.inc_value('zkb/empty_page/assumed_done')
+            info("All pages scraped for "
+                 f"{'/'.join(main_url.split('/')[:-2])}/! "
+                 "Closing spider...")
+            # Checkpoint the month as done, so it is not re-crawled
+            self.crawler.signals.send_catch_log(
+                signal=page_exported, spider=self, url=main_url, done=True
+            )
+
+    def is_end_of_month(self, meta):
+        """Uses the info of the page before an empty page (kept in `meta` by
+        `export_page`, or by `start_requests` from the crawl journal) to tell
+        whether the empty page is the expected end of the month.
+
+        Only a short previous page tells: pages come newest killmail first,
+        so the dates of its killmails can't show that the month is done.
 
-            # Update main URL to next killmail API /page/
-            next_url = self.update_url(response.meta['main_url'])
-            yield Request(url=next_url, callback=self.parse)
+        """
+        if 'prev_count' not in meta:  # No page before, or resumed crawl
+            return False
+
+        # Last page of the month is rarely exactly a full page
+        return meta['prev_count'] < self.settings.getint('KILLMAIL_PAGE_SIZE',
+                                                         200)
+
+    def export_page(self, data, main_url):
+        """Sends the killmails of a finished page to the Item Pipeline, lets
+        the pipeline checkpoint the page, and requests the next killmail API
+        page.
+
+        """
+        # Send data to ProcessBasedExportPipeline for writing to CSV
+        for line in data:
+            # For debugging; to enable set LOG_LEVEL to 'DEBUG'
+            debug(f"Yielded killmail #{line['killmail_id']}!")
+            yield line
+
+        self.crawler.stats.inc_value('zkb/pages')
+        self.crawler.stats.inc_value('zkb/killmails', len(data))
+
+        # Killmails on the page, to tell if an empty next page is the end of
+        # the month (not known if the page could not be parsed, see
+        # parse_killmails)
+        count = len(data) if data[-1].get('victim') != "ERR" else None
+
+        # Every killmail of the page has gone through the pipeline by the
+        # time this generator is resumed, so the page can be checkpointed
+        self.crawler.signals.send_catch_log(
+            signal=page_exported, spider=self, url=main_url, done=False,
+            killmails=count
+        )
+
+        if self.tail_reached:  # The rest of the month was already exported
+            self.finish_tail(main_url)
+            return
+
+        # Update main URL to next killmail API /page/
+        next_url = self.update_url(main_url)
+        request = Request(url=next_url, callback=self.parse)
+        if count is not None:
+            request.meta['prev_count'] = count
+        yield request
+
+    def finish_tail(self, main_url):
+        """Ends a tail crawl at `main_url`, the page where killmails exported
+        by an earlier run start.
+
+        """
+        info(f"Reached killmail #{self.min_killmail_id} at {main_url}, "
+             f"already exported! Closing spider...")
+        self.crawler.signals.send_catch_log(
+            signal=page_exported, spider=self, url=main_url, done=True
+        )
 
     # ======================================================================= #
     # Data-updating Methods
@@ -269,22 +562,28 @@ class ZKBSpider(Spider):
         """Turns response into a list of Python dicts and adds available price
         information to dicts by killmail date and item id, while compiling a
         list of item id, date, and location of missing price information in
-        the dicts.
+        the dicts. Returns the list of dicts (`data`), the lookup dict of
+        missing prices (`price_table`) and the flattened items of the page
+        (`page_items`).
 
         Parses `response.text`, a multi-leveled json string, and produces a
-        list of dicts containing key-value pairs from the json string. If list
-        is non-empty, then for the i-th victim of every killmail, the price of
-        the j-th item in their ship's inventory is gathered by the following
-        algorithm:
-
-        First, `itemprice_db` is checked to see if the j-th item price
-        info already exists; if it does, it uses that price times the quantity
-        of that item to calculate total price, then stores total price in the
-        j-th item dictionary of the i-th killmail victim.
-
-        If the j-th item id and/or date does not exist in `itemprice_db`,
-        then the j-th item id + date, quantity, and location pair (i, j) within
-        the list of killmail dicts is stored in `self.price_table`.
+        list of dicts containing key-value pairs from the json string. If the
+        KILLMAIL_STREAMING_PARSE setting is enabled, the page is decoded one
+        killmail at a time, only as far as it is needed, and only the fields
+        exported by the Item Pipeline are kept for each killmail (see
+        killmails.py). If list is non-empty, the items in every victim's ship
+        inventory are flattened into `page_items` (see PageItems) and grouped
+        by item id and killmail date, and the price of each group is gathered
+        by the following algorithm:
+
+        First, `itemprice_db` is checked to see if the item price info
+        already exists; if it does, it uses that price times the quantity of
+        each item of the group to calculate total price, then stores total
+        price in each item dictionary.
+
+        If the item id and/or date does not exist in `itemprice_db`, then the
+        positions of the items of the group in `page_items` are stored in
+        `price_table`.
 
         If at any point during parsing of the list of dicts an unchecked
         Exception is caught (one not checked for in the inner try-catch blocks)
@@ -296,120 +595,144 @@ class ZKBSpider(Spider):
         """
         # Initialize data container (list) for each killmail (dict). Example...
         # data = [ {`first killmail`}, {`second killmail`}, ... ]
-        self.data = json.loads(response.text)
+        data = []
 
         # Initialize price-lookup dict. Example...
-        # price_table[item_id][date] = [
-        #   (killmail#, item#, quantity),
-        #   (...),
-        # ]
-        # where killmail# and item# are indexes of self.data and
-        # self.data[killmail#]['victim']['items'], respectively.
-        self.price_table = {}
+        # price_table[item_id][date] = [item#, item#, ...]
+        # where item# are positions in `page_items` (see PageItems).
+        price_table = {}
+        page_items = None
 
         # Initialize class Item Price database. Example...
         # itemprice_db[item_id][date] = price
         if self.__class__.itemprice_db is None:
             self.__class__.itemprice_db = {}
 
-        if self.data:  # Page returned non-empty list of killmail dicts
+        try:
+            if self.settings.getbool('KILLMAIL_STREAMING_PARSE'):
+                killmails = iter_killmails(response.text, KILLMAIL_FIELDS)
+            else:
+                killmails = iter(json.loads(response.text))
+
+            for killmail in killmails:
+                if (self.min_killmail_id is not None
+                        and killmail['killmail_id'] <= self.min_killmail_id):
+                    # Exported by an earlier run, as is every killmail after
+                    self.tail_reached = True
+                    break
+                data.append(killmail)
+
+            # Flatten every item of the page, then look up each item ID and
+            # date once, however many killmails it is on
+            page_items = PageItems(data)
+            hits = misses = 0  # Price cache hits/misses, for CrawlTelemetry
+            for key, positions in page_items.group().items():
+                item_id, date = key
+                try:
+                    price = self.get_price(item_id, date)
+                except KeyError:  # item_id or date not in any price database
+                    misses += len(positions)
+                    try:
+                        price_table[item_id][date] = positions
+                    except KeyError:  # item_id key error
+                        price_table[item_id] = {date: positions}
+                else:
+                    hits += len(positions)
+                    page_items.scatter(positions, price)
+
+            stats = self.crawler.stats
+            stats.inc_value('zkb/price_cache/hits', hits)
+            stats.inc_value('zkb/price_cache/misses', misses)
+
+        except Exception as e:  # Exception is caught, didn't account for
+            url = response.url
+            status = response.status
+            # Empty price_table so no price page requests made
+            price_table = {}
+            page_items = None
+
+            # Format killmails list for appending with information
+            data = [{
+                'killmail_id':
+                    f"Unable to retrieve JSON data located at {url}",
+                'killmail_time':
+                    f"Recieved status code: {status}",
+                'victim': "ERR",
+                'attackers': "ERR",
+                'solar_system_id': "ERR",
+                'moon_id': "ERR",
+                'war_id': "ERR",
+                'zkb': "ERR"
+            }]
+
+            # Log exception thrown, URL and status
+            warning(str(e))  # Print Exception to log
+            warning(f"Unable to parse JSON data located at: {url}")
+            warning(f"Recieved status code: {status}")
+
+        return data, price_table, page_items
+
+    def get_price(self, item_id, date):
+        """Returns the price of an item on a date.
+
+        Looks in the class price database first, then in the whole price
+        history of the item (exact date, or nearest date), then reads through
+        to the persistent price store on a miss (another process may have
+        stored it since this spider opened). Raises KeyError if the price page
+        of the item still needs to be requested.
+
+        """
+        cls = self.__class__
+        try:
+            return cls.itemprice_db[item_id][date]
+        except KeyError:
+            pass
+
+        try:
+            history = cls.pricehistory_db[item_id]
+        except KeyError:
+            if cls.price_store is None:
+                raise
+            try:  # Whole history stored by another spider/process?
+                history = cls.price_store.get_history(item_id)
+                cls.pricehistory_db[item_id] = history
+            except KeyError:  # Single date stored by an older spider?
+                history = None
+                price = cls.price_store.get(item_id, date)
+
+        if history is not None:
             try:
-                # Calculate all prices for the i-th killmail
-                for i in range(len(self.data)):
-                    date = self.data[i]['killmail_time'].split('T')[0]
-                    item_list = self.data[i]['victim']['items']  # list
-
-                    # Calculate price for the j-th item of the i-th killmail
-                    for j in range(len(item_list)):
-                        item_id = str(item_list[j]['item_type_id'])
-
-                        # Item is either destroyed or dropped, always one of
-                        # those keys in the list
-                        try:
-                            quantity = item_list[j]['quantity_destroyed']
-                        except KeyError:
-                            try:
-                                quantity = item_list[j]['quantity_dropped']
-                            except KeyError:  # No quantity info?? :O
-                                quantity = 0
-
-                        # Look up item price in class dictionary
-                        try:
-                            price = self.__class__.itemprice_db[item_id][date]
-                            add_price = price
-
-                            # Compute total price of j-th item of i-th killmail
-                            # If price wasn't found in price API previously,
-                            # price will be a string with info about attempted
-                            # scrape. Otherwise, it will be a float
-                            if type(price) is float or type(price) is int:
-                                add_price = price * quantity
-
-                            # Add price!
-                            item_list[j]['total_price'] = add_price
-                            # For debugging; to enable set LOG_LEVEL to 'DEBUG'
-                            debug(f"Updated: Killmail #{i}, Item #{j},"
-                                  f"Price: {price}")
-
-                        # item_id or date not in self.__class__.itemprice_db
-                        except KeyError:
-                            # Add i-th killmail, j-th item, quantity to lookup
-                            lq = (i, j, quantity)
-                            try:
-                                self.price_table[item_id][date].append(lq)
-                            except KeyError:  # item_id or date key error
-                                try:
-                                    self.price_table[item_id][date] = [lq]
-                                except KeyError:  # item_id key error
-                                    self.price_table[item_id] = {date: [lq]}
-
-            except Exception as e:  # Exception is caught, didn't account for
-                url = response.url
-                status = response.status
-                # Empty self.price_table so no price page requests made
-
-                # Format killmails list for appending with information
-                self.data = [{
-                    'killmail_id':
-                        f"Unable to retrieve JSON data located at {url}",
-                    'killmail_time':
-                        f"Recieved status code: {status}",
-                    'victim': "ERR",
-                    'attackers': "ERR",
-                    'solar_system_id': "ERR",
-                    'moon_id': "ERR",
-                    'war_id': "ERR",
-                    'zkb': "ERR"
-                }]
-
-                # Log exception thrown, URL and status
-                warning(str(e))  # Print Exception to log
-                warning(f"Unable to parse JSON data located at: {url}")
-                warning(f"Recieved status code: {status}")
-
-    def add_price(self, price, item_info):
+                price = history.get(date, self.price_max_distance)
+            except KeyError:  # No price information near the date
+                price = (f"Item ID: {item_id}, Date: {date}, "
+                         f"URL: {self.get_price_url(item_id)}")
+
+        try:
+            cls.itemprice_db[item_id][date] = price
+        except KeyError:  # item_id has no date dict yet
+            cls.itemprice_db[item_id] = {date: price}
+        return price
+
+    def add_price(self, lookup, price, item_info):
         """Adds the price information of a single item, on a single date, to
-        all killmails from the scraped page that still need it.
+        all killmails from the scraped page of `lookup` that still need it.
 
         """
         item_id = item_info[0]
         km_date = item_info[1]
 
-        for location in self.price_table[item_id][km_date]:
-            i, j = location[0], location[1]
-            add_price = price
+        # Add price info to every item waiting for it on the page :)
+        positions = lookup.price_table[item_id][km_date]
+        lookup.page_items.scatter(positions, price)
+        # For debugging; to enable set LOG_LEVEL to 'DEBUG'
+        debug(f"Updated: {len(positions)} items, Item ID: {item_id}, "
+              f"Date: {km_date}, Price: {price}")
 
-            # Compute total price of j-th item of i-th killmail
-            # If price wasn't found in price API previously,
-            # price will be a string with info about attempted
-            # scrape. Otherwise, it will be a float or int
-            if type(price) is float or type(price) is int:
-                add_price = price * location[2]
+    def get_price_url(self, item_id):
+        """Creates the Price API URL string of an item.
 
-            # Add price info to data set :)
-            self.data[i]['victim']['items'][j]['total_price'] = add_price
-            # For debugging; to enable set LOG_LEVEL to 'DEBUG'
-            debug(f"Updated: Killmail #{i}, Item #{j}, Price: {price}")
+        """
+        return f'{self.api_root}prices/{item_id}/'
 
     # ======================================================================= #
     # Static Calculation Methods
@@ -425,46 +748,22 @@ class ZKBSpider(Spider):
         info(f"Next page -> {path_elem[-2]} | {new_url}")
         return new_url
 
-    @staticmethod
-    def get_nearest_price(item_info, api_prices):
-        """Finds the nearest date to the requested date, for a single item
-        which does not have price information available for the requested date
-        on the API, and collects the nearest date's price information instead.
 
-        """
-        price = (f"Item ID: {item_info[0]}, Date: {item_info[1]},"
-                 f" URL: {item_info[2]}")
-        req_date = datetime.strptime(item_info[1], '%Y-%m-%d')  # Requested Date
-        prev_date = req_date
-        max_diff = timedelta().max
-
-        # Walk through all dates listed in API and compare to kmail date
-        count = 1
-        end = len(api_prices)  # If count hits end, use prev date in list
-        for date in api_prices:
-            try:
-                # Keep computing difference b/w req_date and cur_date
-                # until smallest difference is found (dates are checked in
-                # chronological order, so diff should get smaller until
-                # cur_date passes closest date!)
-                cur_date = datetime.strptime(date, '%Y-%m-%d')
-                diff = req_date - cur_date
-
-                # Difference b/w dates increased above max or end is reached
-                if max_diff < diff or count == end:
-                    final_date = datetime.strftime(prev_date, '%Y-%m-%d')
-                    try:
-                        price = api_prices[final_date]
-                    finally:  # If price cannot be obtained, still break
-                        break
-                else:  # Difference b/w dates can be smaller
-                    max_diff = diff
-                    prev_date = cur_date
+class PriceLookup(object):
+    """Killmails and join state of the Price API requests issued for one
+    killmail page.
 
-            except ValueError:  # key in API could not be processed as date
-                pass  # Skip that row!!
+    Travels with every price request in `request.meta['lookup']`, so that
+    whichever price page lands last knows the page is complete. The page's
+    data lives here (not on the spider) only until it is sent to the Item
+    Pipeline.
 
-            finally:
-                count += 1  # Increment counter
+    """
 
-        return price
+    def __init__(self, main_url, data, price_table, page_items):
+        self.main_url = main_url  # Killmail API page the prices belong to
+        self.data = data  # Killmails parsed from the page
+        self.price_table = price_table  # Positions of the missing prices
+        self.page_items = page_items  # Items of the page (see PageItems)
+        self.items = iter(price_table)  # Item IDs not requested yet
+        self.in_flight = 0  # Price requests sent but not landed yet
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""Local ZKillBoard API Stand-in for Offline Crawl Benchmarks
+
+`ZKBStubServer` is a small HTTP server (Python standard library only) that
+answers the same URLs ZKBSpider requests from zkillboard.com, from JSON
+fixture files on disk:
+
+    <api_root>kills/region_id/10000002/year/2015/month/05/page/1/
+        -> <fixtures>/kills/region_id/10000002/year/2015/month/05/page/1.json
+    <api_root>prices/34/
+        -> <fixtures>/prices/34.json
+
+A Killmail API page without a fixture is answered with an empty list (the
+end of the month, as on the real API) and a Price API page without one with
+an empty dict. Recorded API pages can be saved at the paths above, or
+synthetic ones made with `make_fixtures`.
+
+Every response can be held back by `latency` (+/- `jitter`) seconds, and a
+`error_rate` fraction of them answered with one of `error_codes` instead,
+to see how the crawl copes with a slow or flaky API. With `capacity`, at
+most that many requests are answered per second, and the rest get a 429
+with a Retry-After header, like a rate-limited API.
+
+Point the spiders at the stand-in by setting ZKB_API_ROOT in settings.py to
+the URL returned by `ZKBStubServer.start()`. See BenchCrawl.py.
+
+To serve a fixture folder on its own, run from the Killmail_Fetching project
+folder:
+    $python -m Killmail_Fetching.zkbstub <fixtures> --port 8000
+
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """HTTPServer answering every request on its own thread.
+
+    """
+    daemon_threads = True
+    # Connections waiting to be accepted. The default of 5 overflows with
+    # dozens of spiders connecting at once, and the overflow waits for TCP
+    # retransmits, so the benchmark would measure the stand-in, not the crawl
+    request_queue_size = 1024
+
+
+class ZKBStubHandler(BaseHTTPRequestHandler):
+    """Answers one request from the fixtures of `self.server.stub`.
+
+    """
+
+    def do_GET(self):
+        stub = self.server.stub
+        status, body = stub.respond(self.path)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if status == 429:
+            self.send_header('Retry-After', str(stub.retry_after))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Don't print a line for every request
+
+
+class ZKBStubServer(object):
+    """Serves the fixtures in the `fixtures` folder on `host`:`port` (a free
+    port if 0) from a background thread. See the module docstring.
+
+    """
+
+    def __init__(self, fixtures, host='127.0.0.1', port=0, latency=0.0,
+                 jitter=0.0, error_rate=0.0, error_codes=(503,), seed=0,
+                 capacity=None, retry_after=1):
+        self.fixtures = fixtures
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_codes = list(error_codes)
+        self.rng = random.Random(seed)
+        self.capacity = capacity  # Requests answered per second, or None
+        self.retry_after = retry_after  # Seconds, sent with every 429
+        self.recent = deque()  # Times of the requests of the last second
+        self.lock = threading.Lock()  # Requests are answered on many threads
+        self.counts = {'requests': 0, 'kills': 0, 'prices': 0, 'errors': 0,
+                       'missing': 0, 'throttled': 0}
+        self.httpd = None
+        self.thread = None
+
+    def start(self):
+        """Starts serving. Returns the root URL of the stand-in APIs, for
+        ZKB_API_ROOT.
+
+        """
+        self.httpd = ThreadingHTTPServer((self.host, self.port),
+                                         ZKBStubHandler)
+        self.httpd.stub = self
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       name='zkbstub', daemon=True)
+        self.thread.start()
+        return f"http://{self.host}:{self.port}/api/"
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def respond(self, path):
+        """Returns the (status code, body) answering a request for `path`.
+
+        """
+        with self.lock:
+            self.counts['requests'] += 1
+            if self.capacity is not None:
+                now = time.monotonic()
+                while self.recent and self.recent[0] <= now - 1:
+                    self.recent.popleft()
+                if len(self.recent) >= self.capacity:
+                    self.counts['throttled'] += 1
+                    return 429, b'{"error": "too many requests"}'
+                self.recent.append(now)
+            delay = self.latency + self.rng.uniform(-self.jitter, self.jitter)
+            error = self.rng.random() < self.error_rate
+            status = self.rng.choice(self.error_codes) if error else 200
+        if delay > 0:
+            time.sleep(delay)
+        if error:
+            with self.lock:
+                self.counts['errors'] += 1
+            return status, b'{"error": "injected"}'
+
+        # /api/kills/.../page/1/ -> kills/.../page/1
+        parts = [part for part in path.split('?')[0].split('/') if part]
+        if parts[:1] == ['api']:
+            parts = parts[1:]
+        kind = parts[0] if parts else ''
+        if kind not in ('kills', 'prices'):
+            return 404, b'{"error": "not found"}'
+
+        uri = os.path.join(self.fixtures, *parts) + '.json'
+        with self.lock:
+            self.counts[kind] += 1
+        try:
+            with open(uri, 'rb') as fixture:
+                return 200, fixture.read()
+        except OSError:  # No fixture: end of the month, or unknown item
+            with self.lock:
+                self.counts['missing'] += 1
+            return 200, b'[]' if kind == 'kills' else b'{}'
+
+
+# =========================================================================== #
+# Synthetic Fixtures
+# =========================================================================== #
+
+def make_killmail(rng, killmail_id, killmail_time, item_ids,
+                  items_per_killmail):
+    """Creates a fake killmail shaped like the Killmail API's.
+
+    """
+    items = []
+    for _ in range(rng.randint(0, 2 * items_per_killmail)):
+        item = {'item_type_id': rng.choice(item_ids),
+                'flag': rng.randint(5, 200), 'singleton': 0}
+        quantity = 'quantity_destroyed' if rng.random() < 0.5 \
+            else 'quantity_dropped'
+        item[quantity] = rng.randint(1, 100)
+        items.append(item)
+    return {
+        'killmail_id': killmail_id,
+        'killmail_time': killmail_time.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'victim': {
+            'character_id': rng.randint(90000000, 99999999),
+            'corporation_id': rng.randint(98000000, 98999999),
+            'ship_type_id': rng.randint(580, 30000),
+            'damage_taken': rng.randint(100, 100000),
+            'items': items,
+            'position': {'x': rng.uniform(-1e12, 1e12),
+                         'y': rng.uniform(-1e12, 1e12),
+                         'z': rng.uniform(-1e12, 1e12)},
+        },
+        'attackers': [{
+            'character_id': rng.randint(90000000, 99999999),
+            'corporation_id': rng.randint(98000000, 98999999),
+            'ship_type_id': rng.randint(580, 30000),
+            'weapon_type_id': rng.randint(580, 30000),
+            'damage_done': rng.randint(1, 10000),
+            'final_blow': n == 0,
+            'security_status': round(rng.uniform(-10, 5), 1),
+        } for n in range(rng.randint(1, 5))],
+        'solar_system_id': rng.randint(30000001, 30005000),
+        'zkb': {
+            'locationID': rng.randint(40000001, 40500000),
+            'hash': f"{rng.getrandbits(160):040x}",
+            'fittedValue': round(rng.uniform(1e5, 1e9), 2),
+            'totalValue': round(rng.uniform(1e5, 1e9), 2),
+            'points': rng.randint(1, 100),
+            'npc': False, 'solo': rng.random() < 0.1, 'awox': False,
+        },
+    }
+
+
+def make_fixtures(fixtures, start_urls, pages=3, page_size=200,
+                  items_per_killmail=5, item_count=300, full_last_every=0,
+                  seed=0):
+    """Writes synthetic fixtures for crawls starting at `start_urls` (page 1
+    Killmail API URLs): `pages` pages per URL (or `pages[url]`, if a dict),
+    all full (`page_size` killmails) but the last, which is half full, plus
+    a Price API page for each of `item_count` item IDs. Returns the number of
+    killmails written.
+
+    The last page of every `full_last_every`-th URL is full too (none if 0),
+    like a month ending exactly on a page boundary, which the spider can't
+    tell from a page that loaded slowly (see EMPTY_PAGE_DETECTION).
+
+    """
+    rng = random.Random(seed)
+    item_ids = list(range(1000, 1000 + item_count))
+    killmail_id = 50000000
+    written = 0
+
+    for number, url in enumerate(start_urls, 1):
+        # .../kills/region_id/#/year/#/month/#/page/1/ -> kills/.../page
+        path_elem = url.rstrip('/').split('/')
+        year, month = int(path_elem[-5]), int(path_elem[-3])
+        month_dir = os.path.join(fixtures, *path_elem[-9:-1])
+        os.makedirs(month_dir, exist_ok=True)
+        # Killmails go back in time (and down in ID) through the month, as
+        # on the real API
+        end = (datetime(year + month // 12, month % 12 + 1, 1)
+               - timedelta(seconds=1))
+        seconds = (end - datetime(year, month, 1)).total_seconds()
+        url_pages = pages[url] if isinstance(pages, dict) else pages
+        last_size = (page_size if full_last_every
+                     and number % full_last_every == 0 else page_size // 2)
+        count = page_size * (url_pages - 1) + last_size
+        step = seconds / (count + 1)
+
+        n = 0
+        for page in range(1, url_pages + 1):
+            size = page_size if page < url_pages else last_size
+            killmails = []
+            for _ in range(size):
+                n += 1
+                killmails.append(make_killmail(
+                    rng, killmail_id + count - n + 1,
+                    end - timedelta(seconds=step * n), item_ids,
+                    items_per_killmail))
+            with open(os.path.join(month_dir, f"{page}.json"), 'w') as f:
+                json.dump(killmails, f)
+            written += size
+        killmail_id += count
+
+    # One price per day over every year of the crawl
+    prices_dir = os.path.join(fixtures, 'prices')
+    os.makedirs(prices_dir, exist_ok=True)
+    first, last = date(2015, 1, 1), date(2018, 12, 31)
+    days = (last - first).days + 1
+    for item_id in item_ids:
+        base = rng.uniform(1, 1e6)
+        prices = {(first + timedelta(days=d)).isoformat():
+                  round(base * rng.uniform(0.9, 1.1), 2)
+                  for d in range(days)}
+        prices['currentPrice'] = round(base, 2)
+        with open(os.path.join(prices_dir, f"{item_id}.json"), 'w') as f:
+            json.dump(prices, f)
+
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Serve ZKillBoard API fixtures locally.')
+    parser.add_argument('fixtures', help='folder of JSON fixture files')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds to hold back every response')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='+/- seconds of random latency')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests answered with an error')
+    parser.add_argument('--capacity', type=int, default=None,
+                        help='requests answered per second, 429 after that')
+    args = parser.parse_args()
+
+    stub = ZKBStubServer(args.fixtures, args.host, args.port, args.latency,
+                         args.jitter, args.error_rate, capacity=args.capacity)
+    print(f"Serving {args.fixtures} at {stub.start()} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stub.stop()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""Module providing typed column buffers for building DataFrames row by row.
+
+Building a one-row DataFrame for every unpacked victim and attacker, then
+concatenating hundreds of thousands of them, spends almost all of its time in
+pandas overhead. Instead, rows are appended to one typed buffer per column
+(see https://docs.python.org/3/library/array.html), and a single DataFrame is
+built from the buffers at the end.
+
+Every column has a kind, which sets how it is buffered and the dtype it ends
+up with:
+
+    'int'    - int64, e.g. IDs. Values must be present.
+    'float'  - float64, missing values are NaN.
+    'int?'   - int64 if no value is missing, float64 with NaN otherwise.
+    'bool?'  - bool if no value is missing, object with NaN otherwise.
+    'time'   - datetime64[ns], from pandas Timestamps (NaT if missing).
+    'object' - any Python object, e.g. lists.
+
+'int?' and 'bool?' give the same dtypes that pd.concat gives when
+concatenating one-row frames, so the CSV files written are the same.
+
+Utilizes the pandas library -
+See https://pandas.pydata.org/pandas-docs/stable/api.html
+
+"""
+from array import array
+
+import numpy as np
+import pandas as pd
+
+# Array typecode each column kind is buffered as (None for a list)
+TYPECODES = {'int': 'q', 'float': 'd', 'int?': 'd', 'bool?': 'd',
+             'time': 'q', 'object': None}
+
+
+class ColumnBuffers(object):
+    """Typed buffers for the index levels and columns of one DataFrame.
+
+    `index` and `columns` are lists of (name, kind) pairs, see the module
+    docstring. Rows are added with `append`, and the DataFrame is built with
+    `to_frame`, e.g.
+
+    >> victims = ColumnBuffers([('killmail_id', 'int')],
+    ..                         [('character_id', 'int'),
+    ..                          ('ship_type_id', 'int?')])
+    >> victims.append((72000000,), (90000001, 670))
+    >> df_victims = victims.to_frame()
+
+    """
+
+    def __init__(self, index, columns):
+        self.index = list(index)
+        self.columns = list(columns)
+        self.buffers = [array(TYPECODES[kind]) if TYPECODES[kind] else []
+                        for _, kind in self.index + self.columns]
+        # Bind every buffer's append method once, along with its kind
+        self.appenders = [(buffer.append, kind)
+                          for buffer, (_, kind) in zip(
+                              self.buffers, self.index + self.columns)]
+
+    def __len__(self):
+        return len(self.buffers[0]) if self.buffers else 0
+
+    def append(self, index, values):
+        """Adds one row: `index` holds the value of every index level, and
+        `values` the value of every column, in order. Missing values are NaN
+        (or NaT, or None for 'object' columns).
+
+        """
+        row = tuple(index) + tuple(values)
+        if len(row) != len(self.appenders):
+            raise ValueError(f"Expected {len(self.appenders)} values, got "
+                             f"{len(row)}: {row}")
+        for (append, kind), value in zip(self.appenders, row):
+            if kind == 'time':
+                append(pd.Timestamp(value).value)  # NaT -> min int64
+            else:
+                append(value)
+
+    def to_frame(self):
+        """Builds the DataFrame of every row appended so far.
+
+        """
+        arrays = [to_array(buffer, kind) for buffer, (_, kind) in zip(
+            self.buffers, self.index + self.columns)]
+        n_index = len(self.index)
+        names = [name for name, _ in self.index]
+        if n_index == 1:
+            index = pd.Index(arrays[0], name=names[0])
+        else:
+            index = pd.MultiIndex.from_arrays(arrays[:n_index], names=names)
+        return pd.DataFrame(
+            dict(zip([name for name, _ in self.columns], arrays[n_index:])),
+            index=index,
+            columns=[name for name, _ in self.columns]
+        )
+
+
+def to_array(buffer, kind):
+    """Converts one column buffer to a NumPy array of the dtype of its kind.
+
+    """
+    if kind == 'object':
+        values = np.empty(len(buffer), dtype=object)
+        for n, value in enumerate(buffer):  # Keep lists as single values
+            values[n] = value
+        return values
+
+    values = np.frombuffer(buffer, dtype=buffer.typecode).copy()
+    if kind == 'time':
+        return values.view('datetime64[ns]')
+    if kind in ('int?', 'bool?'):
+        missing = np.isnan(values)
+        if not missing.any():
+            return values.astype(np.int64 if kind == 'int?' else bool)
+        if kind == 'bool?':
+            values = values.astype(bool).astype(object)
+            values[missing] = np.nan
+    return values
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""Compiles the SDE typeIDs/groupIDs YAML files into a small binary table.
+
+Loading typeIDs.yaml and groupIDs.yaml takes ~20s every run, only to look up
+the English name and groupID of every type and the English name of every
+group. `build` reads the YAML files once and writes just that into one
+binary file, which `SDETables` memory-maps and answers look-ups from
+directly, in milliseconds:
+
+>> with open_tables('../docs/eve_files') as tables:
+..     tables.type_name(11317)   # '800mm Rolled Tungsten Compact Plates'
+..     tables.type_group(11317)  # 329
+..     tables.group_name(329)    # 'Armor Reinforcer'
+
+`open_tables` (re)builds the table first if it is missing or older than the
+YAML files, or run this script to build it:
+
+    $python sde_tables.py ../docs/eve_files
+
+File layout (little-endian), after a header of magic, type count, group count
+and name bytes:
+
+    type IDs (uint32, sorted) | group ID of every type (int32, -1 if none) |
+    name offset of every type (uint32) | group IDs (uint32, sorted) |
+    name offset of every group (uint32) | names (UTF-8, NUL-terminated)
+
+Name offsets are NO_NAME if the YAML has no English name.
+
+"""
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+
+import yaml
+
+# Default table file name, next to the YAML files (ignored by git, it is
+# rebuilt from them)
+TABLE_FILE = 'sde_tables.bin'
+
+MAGIC = b'SDE1'
+HEADER = struct.Struct('<4sIII')  # magic, types, groups, name bytes
+NO_NAME = 0xFFFFFFFF  # Name offset of types/groups with no English name
+
+
+def load_yaml(file_loc, encoding='utf-8'):
+    """Loads yaml file at file_loc and returns Python object based on yaml
+    structure. Uses the LibYAML parser if PyYAML was built with it.
+
+    """
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    with open(file_loc, 'r', encoding=encoding) as stream:
+        return yaml.load(stream, Loader=loader)
+
+
+def build(yaml_dir, path=None):
+    """Compiles typeIDs.yaml and groupIDs.yaml in `yaml_dir` into the table
+    file at `path` (TABLE_FILE in `yaml_dir` by default). Returns `path`.
+
+    """
+    if path is None:
+        path = os.path.join(yaml_dir, TABLE_FILE)
+    typeIDs = load_yaml(os.path.join(yaml_dir, 'typeIDs.yaml'))
+    groupIDs = load_yaml(os.path.join(yaml_dir, 'groupIDs.yaml'))
+
+    names = bytearray()
+
+    def add_name(info):
+        """Adds the English name in `info` to `names`, returns its offset."""
+        try:
+            name = info['name']['en']
+        except (KeyError, TypeError):
+            return NO_NAME
+        offset = len(names)
+        names.extend(str(name).encode('utf-8') + b'\0')
+        return offset
+
+    type_ids, type_groups, type_names = array('I'), array('i'), array('I')
+    for type_id in sorted(typeIDs):
+        info = typeIDs[type_id]
+        type_ids.append(type_id)
+        try:
+            type_groups.append(info['groupID'])
+        except (KeyError, TypeError):
+            type_groups.append(-1)
+        type_names.append(add_name(info))
+
+    group_ids, group_names = array('I'), array('I')
+    for group_id in sorted(groupIDs):
+        group_ids.append(group_id)
+        group_names.append(add_name(groupIDs[group_id]))
+
+    # Written to a temporary file first, so a crash never leaves a
+    # half-written table behind
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(type_ids), len(group_ids),
+                            len(names)))
+        for values in (type_ids, type_groups, type_names, group_ids,
+                       group_names):
+            if sys.byteorder == 'big':
+                values.byteswap()
+            f.write(values.tobytes())
+        f.write(names)
+    os.replace(tmp_path, path)
+    return path
+
+
+def open_tables(yaml_dir, path=None):
+    """Returns the `SDETables` of the YAML files in `yaml_dir`, building the
+    table file at `path` (TABLE_FILE in `yaml_dir` by default) first if it is
+    missing or older than the YAML files.
+
+    """
+    if path is None:
+        path = os.path.join(yaml_dir, TABLE_FILE)
+    sources = [os.path.join(yaml_dir, f'{name}.yaml')
+               for name in ('typeIDs', 'groupIDs')]
+    if (not os.path.exists(path)
+            or any(os.path.getmtime(source) > os.path.getmtime(path)
+                   for source in sources if os.path.exists(source))):
+        print(f'Compiling SDE tables to {path}...')
+        build(yaml_dir, path)
+    return SDETables(path)
+
+
+class SDETables(object):
+    """Memory-mapped look-ups of type names, type groups and group names, from
+    a table file written by `build`. Raise KeyError if the SDE doesn't have
+    the ID (or the name) looked up.
+
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.columns = []
+        magic, n_types, n_groups, n_names = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not an SDE table file")
+
+        position = HEADER.size
+        for typecode, count in (('I', n_types), ('i', n_types),
+                                ('I', n_types), ('I', n_groups),
+                                ('I', n_groups)):
+            end = position + 4 * count
+            if sys.byteorder == 'big':  # Copy and swap, can't map as is
+                column = array(typecode, self.map[position:end])
+                column.byteswap()
+            else:
+                column = memoryview(self.map)[position:end].cast(typecode)
+            self.columns.append(column)
+            position = end
+        (self.type_ids, self.type_groups, self.type_names, self.group_ids,
+         self.group_names) = self.columns
+        self.names_start = position
+
+    def __len__(self):
+        return len(self.type_ids)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Unmaps and closes the table file.
+
+        """
+        for column in self.columns:
+            if isinstance(column, memoryview):
+                column.release()  # mmap can't close while views exist
+        self.map.close()
+        self.file.close()
+
+    def type_name(self, type_id):
+        """Returns the English name of a type.
+
+        """
+        offset = self.type_names[self.find(self.type_ids, type_id)]
+        if offset == NO_NAME:
+            raise KeyError(type_id)
+        return self.name(offset)
+
+    def type_group(self, type_id):
+        """Returns the groupID of a type.
+
+        """
+        group_id = self.type_groups[self.find(self.type_ids, type_id)]
+        if group_id < 0:
+            raise KeyError(type_id)
+        return group_id
+
+    def group_name(self, group_id):
+        """Returns the English name of a group.
+
+        """
+        offset = self.group_names[self.find(self.group_ids, group_id)]
+        if offset == NO_NAME:
+            raise KeyError(group_id)
+        return self.name(offset)
+
+    def item_names(self, missing='Missing'):
+        """Returns the (itemName, groupName) pair of every type, e.g.
+        names[11317] == ('800mm Rolled Tungsten Compact Plates',
+        'Armor Reinforcer'). Types with no group have no name either; both
+        are `missing` if not found.
+
+        """
+        group_names = {}
+        for group_id, offset in zip(self.group_ids, self.group_names):
+            if offset != NO_NAME:
+                group_names[group_id] = self.name(offset)
+
+        names = {}
+        for type_id, group_id, offset in zip(self.type_ids, self.type_groups,
+                                             self.type_names):
+            if group_id < 0 or offset == NO_NAME:
+                names[type_id] = (missing, missing)
+            else:
+                names[type_id] = (self.name(offset),
+                                  group_names.get(group_id, missing))
+        return names
+
+    def name(self, offset):
+        """Returns the name at `offset` in the names of the file.
+
+        """
+        start = self.names_start + offset
+        return self.map[start:self.map.find(b'\0', start)].decode('utf-8')
+
+    @staticmethod
+    def find(ids, id_):
+        """Returns the position of `id_` in the sorted `ids` column.
+
+        """
+        position = bisect_left(ids, id_)
+        if position == len(ids) or ids[position] != id_:
+            raise KeyError(id_)
+        return position
+
+
+if __name__ == '__main__':
+    yaml_dir = sys.argv[1] if len(sys.argv) > 1 else '../docs/eve_files'
+    print(f'Compiled {build(yaml_dir)}')
@@ -1,10 +1,13 @@
-import yaml
+import os
+import sys
 
-with open('../docs/eve_files/typeIDs.yaml', 'r', encoding='utf-8') as stream:
-    try:
-        data = yaml.safe_load(stream)
-    except yaml.YAMLError as exc:
-        print(exc)
+# sde_tables.py is in Bag_of_Words
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from sde_tables import open_tables
+
+# Compiled from typeIDs.yaml and groupIDs.yaml on the first run
+data = open_tables('../docs/eve_files')
 
 try:
     print(f"Type: {type(data)}")
@@ -16,35 +19,25 @@ try:
 except Exception:
     print("Unable to find Length.")
 
-if 11317 in data:
-    try:
-        print(f"Object 11317: {data[11317]}")
-    except Exception:
-        print("Unable to find Object 11317.")
-
-    try:
-        print(f"Type of Object 11317: {type(data[11317])}")
-    except Exception:
-        print("Unable to find Type of Object 11317.")
-
-    try:
-        print(f"Length of Object 11317: {len(data[11317])}")
-    except Exception:
-        print("Unable to find Length of Object 11317.")
-
-    try:
-        print(f"Name of Object 11317: {data[11317]['name']['en']}")
-    except Exception:
-        print("Unable to find Name of Object 11317.")
-
-    try:
-        print(f"Type of Name of Object 11317: {type(data[11317]['name']['en'])}")
-    except Exception:
-        print("Unable to find Type of Name of Object 11317.")
-
-    try:
-        print(f"Length of Name of Object 11317: {len(data[11317]['name']['en'])}")
-    except Exception:
-        print("Unable to find Length of Name of Object 11317.")
-else:
-    print("Unable to find Object 11317.")
+try:
+    print(f"Name of Object 11317: {data.type_name(11317)}")
+except KeyError:
+    print("Unable to find Name of Object 11317.")
+
+try:
+    print(f"Group of Object 11317: {data.type_group(11317)}")
+except KeyError:
+    print("Unable to find Group of Object 11317.")
+
+try:
+    print(f"Name of Group of Object 11317: "
+          f"{data.group_name(data.type_group(11317))}")
+except KeyError:
+    print("Unable to find Name of Group of Object 11317.")
+
+try:
+    print(f"Length of Name of Object 11317: {len(data.type_name(11317))}")
+except KeyError:
+    print("Unable to find Length of Name of Object 11317.")
+
+data.close()
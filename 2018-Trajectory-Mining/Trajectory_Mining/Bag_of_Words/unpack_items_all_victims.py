@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
 """Unpacks Raw API data from zkillboard into victim files that contain 
 
+Every CSV file is read and unpacked on its own, so files are fanned out to a
+pool of WORKERS processes, and the victims of each file are joined in file
+order once all are done. Progress and the time each file took are printed as
+files finish.
+
 TEST - 10/02/2019
 Params: 10000002201505.csv | 61MB | 28208 rows x 8 columns
 Output:
@@ -43,29 +48,38 @@ def lap(msg):
         else:
             print(f'(+{elapsed:.3f}s|t:{total:.3f}s) {msg}')
 
-lap("Importing modules...")
+if __name__ == '__main__':  # Not again in every worker process
+    lap("Importing modules...")
 
-from ast import literal_eval
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy as np
 import pandas as pd
-import yaml
 
+from columns import ColumnBuffers
+from literals import decode
+from sde_tables import open_tables
 
-def load_yaml(file_loc, encoding='utf-8'):
-    """Loads yaml file at file_loc and returns Python object based on yaml
-    structure.
+# Number of worker processes unpacking files at once
+WORKERS = os.cpu_count()
 
-    """
-    data = None
-    with open(file_loc, 'r', encoding=encoding) as stream:
-        try:
-            data = yaml.safe_load(stream)
-        except yaml.YAMLError as exc:
-            print(exc)
-    return data
+# (itemName, groupName) of items with no name or group info
+MISSING = ('Missing', 'Missing')
+
+# (itemName, groupName) of every typeID, see SDETables.item_names. Set in
+# every worker process by init_worker
+item_names = {}
+
+# Output index levels and columns, with their kinds (see columns.py)
+a_idx = [('killmail_id', 'int'), ('character_id', 'int')]
+a_col = [('final_blow', 'bool?'), ('damage_done', 'int?'),
+         ('ship_type_id', 'int?')]
+v_idx = [('killmail_id', 'int')]
+v_col = [('killmail_time', 'time'), ('solar_system_id', 'int?'),
+         ('character_id', 'int'), ('ship_type_id', 'int?'),
+         ('items', 'object')]
 
 
 def unpack(data: pd.DataFrame):
@@ -78,28 +92,8 @@ def unpack(data: pd.DataFrame):
         # lo_flags = {11, 12, 13, 14, 15, 16, 17, 18}
         # mi_flags = {19, 20, 21, 22, 23, 24, 25, 26}
         # hi_flags = {27, 28, 29, 30, 31, 32, 33, 34}
-        itemList=[]
-        for item in items:
-            itemName, groupName = 'Missing', 'Missing'
-            try:
-                item_type_id = item['item_type_id']
-                try:
-                    item_group_id = typeIDs[item_type_id]['groupID']
-                    try:
-                        itemName = typeIDs[item_type_id]['name']['en']
-                        try:
-                            groupName = groupIDs[item_group_id]['name']['en']
-                        except:
-                            pass
-                    except:
-                        pass
-                except:
-                    pass
-            except:
-                pass
-            finally:
-                itemList.append((itemName, groupName))
-        return itemList
+        return [item_names.get(item.get('item_type_id'), MISSING)
+                for item in items]
 
     def parse_attackers(attackers):
         attacker_keys = ('final_blow', 'damage_done', 'ship_type_id')
@@ -144,103 +138,140 @@ def unpack(data: pd.DataFrame):
         yield victim_row, attacker_rows, row.killmail_id
 
 
-# Specify S3 parameters and SQL query
-bucket='dilabevetrajectorymining'
-key='eve-trajectory-mining/Killmail_Fetching/killmail_scrapes/byregion/10000002/10000002201505.csv'
-query="""
-SELECT * 
-  FROM s3Object s
- LIMIT 5
-"""
-# Let amazon do the api calls
-# print('Querying s3 bucket...')
-# df = select(bucket, key, query)
-
-#
-# Open YAML file of typeIDs to get names of items
-# typeIDs.yaml -> dictionary of typeID keys which contain attributes
-# ex. typeIDs[11317] -> {'description': {'en': 'blah', ...}, ...}
-#     typeIDs[11317]['name']['en'] == '800mm Rolled Tungsten Compact Plates'
-#     typeIDs[11317]['groupID'] == 329
-#     groupIDs[329] -> {'name': {'en': 'blah', ...}, ...}
-#     groupIDs[329]['name']['en'] == 'Armor Reinforcer'
-#     
-lap("Loading YAML files into memory...")
-root = "../Trajectory_Mining/docs/eve files"  # YAML file location
-typeIDs = load_yaml(os.path.join(root, 'typeIDs.yaml'))
-groupIDs = load_yaml(os.path.join(root, 'groupIDs.yaml'))
-# invFlags = load_yaml(os.path.join(root, 'invFlags.yaml'))
-# invMarketGroups = load_yaml(os.path.join(root, 'invMarketGroups.yaml'))
-# categoryIDs = load_yaml(os.path.join(root, 'categoryIDs.yaml'))
-
-# Sequentially load CSV's from file
-lap("Loading CSV data from killmail_scrapes...")
-victims = []  # list of victim dataframes generated from CSV's
-attackers = []  # list of victim dataframes generated from CSV's
-for root, dirs, files in os.walk("../Killmail_Fetching/killmail_scrapes/byregion", topdown=False):
-    count = 0
-    num_files = len(files)  # number of CSV files
-    for file in sorted(files):
-        print(f"Progress {count/num_files:2.1%} ", end="\r")
-        df = pd.read_csv(os.path.join(root, file), encoding='utf-8')
-
-        # Convert all timestamp strings to numpy.datetime64
-        # print("> Converting DataFrame column value types ", end="")
-        df['killmail_time'] = pd.to_datetime(df['killmail_time'],
-                                             # Turn errors into NaT
-                                             errors='coerce',
-                                             # Use this format to parse str
-                                             format='%Y-%m-%dT%H:%M:%SZ')
-
-        # Convert all numeric values in 'solar_system_id' to smallest int type
-        # Convert all non-numeric values in 'solar_system_id' to NaN
-        df['solar_system_id'] = pd.to_numeric(df['solar_system_id'],
-                                              # Turn errors into NaN
-                                              errors='coerce',
-                                              # Convert to smallest int type
-                                              downcast='integer')
-
-        # Convert values in columns to python objects
-        df['victim'] = df['victim'].apply(literal_eval)
-        df['attackers'] = df['attackers'].apply(literal_eval)
-        df['zkb'] = df['zkb'].apply(literal_eval)
-
-        # Unpack DataFrame subset containing lists and dicts
-        # print("> Unpacking DataFrame values ", end="")
-        victim_rows = []
-        attacker_rows = []
-        a_col = ['final_blow', 'damage_done', 'ship_type_id']
-        v_col = ['killmail_time', 'solar_system_id', 'character_id', 
-                 'ship_type_id', 'items']
-        for v_row, a_rows, k_id in unpack(df):
-            if v_row is not None:  # If no character ID, don't append victim
-                victim_rows.append(pd.DataFrame(
-                                       [v_row], 
-                                       columns=v_col,
-                                       index=pd.Index([k_id], name='killmail_id')
-                                   ))
-            if a_rows:
-                attacker_rows.extend([pd.DataFrame(
-                                          [a_row], 
-                                          columns=a_col,
-                                          index=pd.MultiIndex.from_tuples(
-                                                    [(k_id, a_id)],
-                                                    names=('killmail_id', 
-                                                           'character_id')
-                                                )
-                                      ) for a_id, a_row in a_rows])
-
-        # Concat victim_rows together
-        # print("> Concating victim rows ", end="\r")
-        victims.append(pd.concat(victim_rows, sort=False))
-        # attackers.append(pd.concat(attacker_rows, sort=False))
-        count += 1
-
-# Save victim and attacker info to CSV
-lap("Writing results to CSV...")
-df_victims = pd.concat(victims)
-df_victims.to_csv('data/all_victims_items.csv')
-# df_attackers = pd.concat(attackers)
-# df_attackers.to_csv('data/all_attackers.csv')
-
-lap("Exit")
+def init_worker(names):
+    """Sets the item names used by `unpack` in a worker process.
+
+    """
+    global item_names
+    item_names = names
+
+
+def unpack_file(path):
+    """Reads and unpacks one CSV file of killmails. Runs in a worker process
+    (see `unpack_all`).
+
+    Returns the DataFrame of the file's victims, and the seconds spent
+    reading and unpacking it.
+
+    """
+    timings = {}
+    lap_start = time.time()
+    df = pd.read_csv(path, encoding='utf-8')
+
+    # Convert all timestamp strings to numpy.datetime64
+    df['killmail_time'] = pd.to_datetime(df['killmail_time'],
+                                         # Turn errors into NaT
+                                         errors='coerce',
+                                         # Use this format to parse str
+                                         format='%Y-%m-%dT%H:%M:%SZ')
+
+    # Convert all numeric values in 'solar_system_id' to smallest int type
+    # Convert all non-numeric values in 'solar_system_id' to NaN
+    df['solar_system_id'] = pd.to_numeric(df['solar_system_id'],
+                                          # Turn errors into NaN
+                                          errors='coerce',
+                                          # Convert to smallest int type
+                                          downcast='integer')
+
+    # Convert values in columns to python objects, the same as
+    # literal_eval but faster (see literals.py)
+    df['victim'] = df['victim'].apply(decode)
+    df['attackers'] = df['attackers'].apply(decode)
+    df['zkb'] = df['zkb'].apply(decode)
+    timings['read'] = time.time() - lap_start
+
+    # Unpack DataFrame subset containing lists and dicts into typed
+    # column buffers, then build one DataFrame per file from them
+    lap_start = time.time()
+    victim_rows = ColumnBuffers(v_idx, v_col)
+    attacker_rows = ColumnBuffers(a_idx, a_col)
+    for v_row, a_rows, k_id in unpack(df):
+        if v_row is not None:  # If no character ID, don't append victim
+            victim_rows.append((k_id,), v_row)
+        for a_id, a_row in a_rows:
+            attacker_rows.append((k_id, a_id), a_row)
+    df_victims = victim_rows.to_frame()
+    # df_attackers = attacker_rows.to_frame()
+    timings['unpack'] = time.time() - lap_start
+
+    return df_victims, timings
+
+
+def unpack_all(paths, names, workers=WORKERS):
+    """Unpacks every CSV file in `paths` with a pool of `workers` processes,
+    given the item names of `SDETables.item_names`. Prints progress and
+    per-file timings as files finish. A file that fails is reported and
+    skipped, so the files already unpacked are kept.
+
+    Returns the victims of every file unpacked, in the order of `paths`, and
+    the paths of the files that failed.
+
+    """
+    results = {}
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(names,)) as pool:
+        futures = {pool.submit(unpack_file, path): path for path in paths}
+        for done, future in enumerate(as_completed(futures), 1):
+            path = futures[future]
+            try:
+                results[path], timings = future.result()
+            except Exception as e:  # Keep unpacking the other files
+                print(f"Progress {done/len(paths):2.1%} | "
+                      f"UNABLE TO UNPACK {path}: {e}")
+                failed.append(path)
+                continue
+            print(f"Progress {done/len(paths):2.1%} | "
+                  f"{os.path.basename(path)}: read {timings['read']:.1f}s, "
+                  f"unpack {timings['unpack']:.1f}s")
+    return [results[path] for path in paths if path in results], failed
+
+
+if __name__ == '__main__':
+    # Specify S3 parameters and SQL query
+    bucket='dilabevetrajectorymining'
+    key='eve-trajectory-mining/Killmail_Fetching/killmail_scrapes/byregion/10000002/10000002201505.csv'
+    query="""
+    SELECT * 
+      FROM s3Object s
+     LIMIT 5
+    """
+    # Let amazon do the api calls
+    # print('Querying s3 bucket...')
+    # df = select(bucket, key, query)
+
+    #
+    # Open the SDE tables compiled from typeIDs.yaml and groupIDs.yaml to get
+    # names of items (compiled on the first run, see sde_tables.py)
+    # ex. tables.type_name(11317) == '800mm Rolled Tungsten Compact Plates'
+    #     tables.type_group(11317) == 329
+    #     tables.group_name(329) == 'Armor Reinforcer'
+    #
+    lap("Loading SDE tables into memory...")
+    root = "../Trajectory_Mining/docs/eve_files"  # YAML file location
+    with open_tables(root) as tables:
+        names = tables.item_names(missing=MISSING[0])
+
+    # Load and unpack CSV's from file, WORKERS at a time
+    lap("Loading CSV data from killmail_scrapes...")
+    paths = []
+    for root, dirs, files in os.walk("../Killmail_Fetching/killmail_scrapes/byregion", topdown=False):
+        for file in sorted(files):
+            paths.append(os.path.join(root, file))
+    # list of victim dataframes, and paths of CSV's that failed
+    victims, failed = unpack_all(paths, names)
+    if failed:
+        print(f"{len(failed)}/{len(paths)} files failed and were skipped:")
+        for path in failed:
+            print(f"  {path}")
+    if not victims:
+        sys.exit("No files were unpacked!")
+
+    # Save victim and attacker info to CSV
+    lap("Writing results to CSV...")
+    df_victims = pd.concat(victims)
+    df_victims.to_csv('data/all_victims_items.csv')
+    # df_attackers = pd.concat(attackers)
+    # df_attackers.to_csv('data/all_attackers.csv')
+
+    lap("Exit")
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""Module providing a fast decoder for the Python literals in killmail scrapes.
+
+The 'victim', 'attackers' and 'zkb' columns of the CSV files written by
+Killmail_Fetching hold the repr() of Python dicts and lists, e.g.
+
+    {'character_id': 90000001, 'items': [{'flag': 5, 'singleton': 0}]}
+
+`ast.literal_eval` reads them back by building a full syntax tree of every
+cell, which makes loading a month of killmails take minutes. Almost every
+cell is also valid JSON once its quotes and True/False/None are swapped, and
+`json.loads` parses that many times faster.
+
+`decode` does that swap whenever it can be done safely, i.e. when the cell
+has no double quotes or backslashes, so every single quote starts or ends a
+string and everything between strings is numbers, punctuation and
+True/False/None. Any other cell, or a cell that still isn't JSON (tuples,
+sets, non-string dict keys...), is handed to `ast.literal_eval`, so `decode`
+returns exactly what `literal_eval` would, and raises what it would.
+
+`decode` is a plain module-level function, so it can be passed to
+`pd.read_csv(converters=...)`, `Series.apply` or a process pool.
+
+"""
+import json
+from ast import literal_eval
+
+# Python words outside strings and the JSON words they become
+WORDS = (('True', 'true'), ('False', 'false'), ('None', 'null'))
+
+# Joins the parts of a cell outside strings, so they are translated at once
+SEPARATOR = '\x00'
+
+
+def decode(text):
+    """Returns the Python object of the literal in `text`, the same as
+    `ast.literal_eval(text)`.
+
+    """
+    if '"' in text or '\\' in text or SEPARATOR in text:
+        return literal_eval(text)
+
+    # Even parts are outside strings, odd parts are the strings' contents
+    parts = text.split("'")
+    if len(parts) % 2 == 0:  # Unbalanced quotes, not a literal
+        return literal_eval(text)
+
+    outside = SEPARATOR.join(parts[::2])
+    for word, json_word in WORDS:
+        outside = outside.replace(word, json_word)
+    if 'N' in outside or 'I' in outside:  # NaN and Infinity aren't Python
+        return literal_eval(text)
+    parts[::2] = outside.split(SEPARATOR)
+
+    try:
+        return json.loads('"'.join(parts))
+    except ValueError:  # Not JSON after all, e.g. a tuple or a set
+        return literal_eval(text)
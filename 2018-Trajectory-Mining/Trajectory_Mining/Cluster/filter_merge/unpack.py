@@ -4,6 +4,18 @@
 Creates new CSV files from Raw CSV Data with only specific columns and cleans
 unnecessary data from Web APIs scrapes.
 
+Every region-month CSV file is unpacked on its own, so files are fanned out
+to a pool of WORKERS processes, each writing the victims and attackers files
+of the file it unpacked. Progress and the time each file took are logged as
+files finish.
+
+Files are read CHUNK_SIZE killmails at a time, and the victims and attackers
+of every chunk are appended to the output files before the next chunk is
+read, so memory use is bounded by the chunk size rather than by the busiest
+month. Set CHUNK_SIZE to None to read every file whole. When chunked, an
+integer column with missing values (e.g. a victim's ship_type_id) is only
+written as floats in the chunks that have missing values.
+
 Utilizes the pandas library -
 See https://pandas.pydata.org/pandas-docs/stable/api.html
 
@@ -26,11 +38,31 @@ Last Updated: 07/25/2018
 import logging
 import os
 import sys
-from ast import literal_eval
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy as np
 import pandas as pd
 
+from columns import ColumnBuffers
+from literals import decode
+
+# Number of worker processes unpacking files at once
+WORKERS = os.cpu_count()
+
+# Killmails read from a file at a time, None to read whole files
+CHUNK_SIZE = 10000
+
+# Output file index levels and columns, with their kinds (see columns.py)
+a_idx = [('killmail_id', 'int'), ('character_id', 'int')]
+a_col = [('final_blow', 'bool?'), ('damage_done', 'int?'),
+         ('ship_type_id', 'int?')]
+v_idx = [('killmail_id', 'int')]
+v_col = [('killmail_time', 'time'), ('solar_system_id', 'int?'),
+         ('character_id', 'int'), ('ship_type_id', 'int?'),
+         ('HighSlotISK', 'float'), ('MidSlotISK', 'float'),
+         ('LowSlotISK', 'float')]
+
 
 def file_gen(top_dir, out_root):
     """Creates list of file name, path to file, output
@@ -173,43 +205,43 @@ def unpack(data: pd.DataFrame):
         yield victim_row, attacker_rows, row.Index
 
 
-# ============================================================================ #
-directory = '..\..\Killmail_Fetching\scrapes\AR'
-output_root = '..\data\AR'
-files = [file_set for file_set in file_gen(directory, output_root)]
-
-start = input('Start Conversion? (y/n) >')
-if start != 'y':
-    sys.exit(0)  # Early exit
-
-# Set logger
-logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s',
-                    datefmt='%Y/%m/%d %H:%M:%S',
-                    level='DEBUG')
-
-# Output file columns
-a_col = ['final_blow', 'damage_done', 'ship_type_id']
-v_col = ['killmail_time', 'solar_system_id', 'character_id', 'ship_type_id',
-         'HighSlotISK', 'MidSlotISK', 'LowSlotISK']
-
-# Clean and reformat every CSV at the file location
-for name, in_path, out_folder in files:
-    logging.info(f"Reading -> {in_path}")
+def read_scrape(in_path, chunksize=None):
+    """Reads a raw CSV file of killmails into a DataFrame, decoding nested
+    columns and converting value types. If ``chunksize`` is given, returns an
+    iterator of DataFrames of ``chunksize`` killmails each instead.
+
+    :param in_path:
+    :param chunksize:
+    :return:
+    """
     df = pd.read_csv(in_path,  # Path to CSV File
                      header=0,  # Use this row number as header
                      index_col=0,  # Use killmail_id as index
                      usecols=lambda x: x not in ('moon_id', 'war_id'),
                      # Apply str to 'killmail_time' for post-process
                      dtype={'killmail_time': str},
-                     # Apply literal_eval to these columns
+                     # Decode the Python literals in these columns, the
+                     # same as literal_eval but faster (see literals.py)
                      converters={
-                         'victim': literal_eval,
-                         'attackers': literal_eval,
-                         'zkb': literal_eval
+                         'victim': decode,
+                         'attackers': decode,
+                         'zkb': decode
                      },
                      # Skip lines with extra columns, don't throw error!
-                     error_bad_lines=False)
+                     error_bad_lines=False,
+                     # Read this many rows at a time, if not None
+                     chunksize=chunksize)
+    if chunksize is None:
+        return convert_types(df)
+    return (convert_types(chunk) for chunk in df)
+
 
+def convert_types(df):
+    """Converts the value types of a DataFrame read by `read_scrape`.
+
+    :param df:
+    :return:
+    """
     # Convert all timestamp strings to numpy.datetime64
     df['killmail_time'] = pd.to_datetime(df['killmail_time'],
                                          # Turn errors into NaT
@@ -228,37 +260,130 @@ for name, in_path, out_folder in files:
     # Check type casting by passing check=True
     # check_type_cast(df)
 
+    return df
+
+
+def unpack_frames(df):
+    """Unpacks the killmails of a DataFrame read by `read_scrape` into one
+    DataFrame of victims and one of attackers.
+
+    :param df:
+    :return:
+    """
     # Unpack DataFrame subset containing lists and dicts
-    logging.info(f"Unpacking -> {name}.csv")
-    victim_rows = []
-    attacker_rows = []
+    # Rows are appended to typed column buffers, and one DataFrame is built
+    # from each of them at the end
+    victims = ColumnBuffers(v_idx, v_col)
+    attackers = ColumnBuffers(a_idx, a_col)
     for v_row, a_rows, k_id in unpack(df):
         if v_row is not None:  # If no character ID, don't append victim
-            victim_rows.append(
-                pd.DataFrame([v_row],
-                             columns=v_col,
-                             index=pd.Index([k_id], name='killmail_id'))
-            )
-        if a_rows:
-            attacker_rows.extend(
-                [pd.DataFrame([a_row],
-                              columns=a_col,
-                              index=pd.MultiIndex.from_tuples(
-                                  [(k_id, a_id)],
-                                  names=('killmail_id', 'character_id')
-                              )) for a_id, a_row in a_rows]
-            )
+            victims.append((k_id,), v_row)
+        for a_id, a_row in a_rows:
+            attackers.append((k_id, a_id), a_row)
+    return victims.to_frame(), attackers.to_frame()
 
-    logging.debug(f"Concatenating Victims in {name}.csv")
-    df_victims = pd.concat(victim_rows, sort=False)
 
-    logging.debug(f"Concatenating Attackers in {name}.csv")
-    df_attackers = pd.concat(attacker_rows, sort=False)
+def unpack_file(name, in_path, out_folder, chunksize=CHUNK_SIZE):
+    """Unpacks one raw CSV file and writes its victims and attackers CSV
+    files to `out_folder`, ``chunksize`` killmails at a time (or all at once
+    if None). Runs in a worker process (see `unpack_all`).
 
-    v_out = os.path.join(*(out_folder, 'Victims', f'{name}_victims.csv'))
-    logging.info(f"Writing Victims to {name}_victims.csv")
-    df_victims.to_csv(v_out)
+    Returns the number of victims and attackers written, and the seconds
+    spent reading, unpacking and writing the file.
 
+    :param name:
+    :param in_path:
+    :param out_folder:
+    :param chunksize:
+    :return:
+    """
+    v_out = os.path.join(*(out_folder, 'Victims', f'{name}_victims.csv'))
     a_out = os.path.join(*(out_folder, 'Attackers', f'{name}_attackers.csv'))
-    logging.info(f"Writing Attackers to {name}_attackers.csv")
-    df_attackers.to_csv(a_out, float_format='%g')
+    n_victims = n_attackers = 0
+    timings = {'read': 0.0, 'unpack': 0.0, 'write': 0.0}
+
+    lap = time.time()
+    if chunksize is None:
+        chunks = [read_scrape(in_path)]
+    else:
+        chunks = read_scrape(in_path, chunksize)
+
+    written = False  # First chunk creates the files and writes the headers
+    for df in chunks:
+        timings['read'] += time.time() - lap
+
+        lap = time.time()
+        df_victims, df_attackers = unpack_frames(df)
+        timings['unpack'] += time.time() - lap
+
+        # Append every chunk to the output files as soon as it is unpacked
+        lap = time.time()
+        mode = 'a' if written else 'w'
+        df_victims.to_csv(v_out, mode=mode, header=not written)
+        df_attackers.to_csv(a_out, mode=mode, header=not written,
+                            float_format='%g')
+        timings['write'] += time.time() - lap
+
+        n_victims += len(df_victims)
+        n_attackers += len(df_attackers)
+        written = True
+        lap = time.time()
+
+    if not written:  # No killmails in the file, still write the headers
+        ColumnBuffers(v_idx, v_col).to_frame().to_csv(v_out)
+        ColumnBuffers(a_idx, a_col).to_frame().to_csv(a_out)
+
+    return n_victims, n_attackers, timings
+
+
+def unpack_all(files, workers=WORKERS):
+    """Unpacks every (name, in_path, out_folder) in ``files`` with a pool of
+    ``workers`` processes, logging progress and per-file timings as files
+    finish. A file that fails is logged and skipped.
+
+    :param files:
+    :param workers:
+    :return: names of the files that failed
+    """
+    failed = []
+    begin = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(unpack_file, *file_set): file_set
+                   for file_set in files}
+        for done, future in enumerate(as_completed(futures), 1):
+            name, in_path, _ = futures[future]
+            try:
+                n_victims, n_attackers, timings = future.result()
+            except Exception as e:  # Keep unpacking the other files
+                logging.error(f"UNABLE TO UNPACK {in_path}: {e}")
+                failed.append(name)
+                continue
+            logging.info(
+                f"[{done}/{len(futures)}] {name}.csv -> {n_victims} victims, "
+                f"{n_attackers} attackers | read {timings['read']:.1f}s, "
+                f"unpack {timings['unpack']:.1f}s, "
+                f"write {timings['write']:.1f}s"
+            )
+
+    logging.info(f"Unpacked {len(files) - len(failed)}/{len(files)} files in "
+                 f"{time.time() - begin:.1f}s with {workers} workers")
+    return failed
+
+
+# ============================================================================ #
+if __name__ == '__main__':
+    directory = '..\..\Killmail_Fetching\scrapes\AR'
+    output_root = '..\data\AR'
+    files = [file_set for file_set in file_gen(directory, output_root)]
+
+    start = input('Start Conversion? (y/n) >')
+    if start != 'y':
+        sys.exit(0)  # Early exit
+
+    # Set logger
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s',
+                        datefmt='%Y/%m/%d %H:%M:%S',
+                        level='DEBUG')
+
+    # Clean and reformat every CSV at the file location, WORKERS at a time
+    unpack_all(files)